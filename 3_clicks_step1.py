@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 import sys
 
@@ -5,7 +6,20 @@ import detection
 # import gen_mask
 
 if __name__ == "__main__":
+    # Needed by the multi-process detection in the packed exe
+    multiprocessing.freeze_support()
+
     argv = sys.argv[1:]
+
+    # "--process" / "--thread" can be given to choose how the detection is
+    # run in parallel. settings.DETECTION_BACKEND is used if not given.
+    backend = None
+    if "--process" in argv:
+        backend = "process"
+    elif "--thread" in argv:
+        backend = "thread"
+    argv = [arg for arg in argv if arg not in ["--process", "--thread"]]
+
     if len(argv) == 0:
         print("\nUsage: 3_clicks_step1 <equatorial_mount option: Y/N> <folder name>")
         print(
@@ -14,6 +28,10 @@ if __name__ == "__main__":
         print(
             "                         N (Choose this for images taken on fixed tripod)"
         )
+        print(
+            "\noption: --process (Run the detection in processes, faster on many-core CPUs)"
+        )
+        print("        --thread  (Run the detection in threads)")
         sys.exit(1)
 
     equatorial_mount_option = argv[0]
@@ -26,6 +44,10 @@ if __name__ == "__main__":
         print(
             "                         N (Choose this for images taken on fixed tripod)"
         )
+        print(
+            "\noption: --process (Run the detection in processes, faster on many-core CPUs)"
+        )
+        print("        --thread  (Run the detection in threads)")
         sys.exit(1)
 
     original_dir = argv[1]
@@ -59,6 +81,7 @@ if __name__ == "__main__":
         # subtraction=False,
         equatorial_mount=is_equatorial_mount,
         verbose=1,
+        backend=backend,
     )
 
     # meteor_detector.filter_possible_not_meteor_objects(extracted_dir, keep_dir, not_sure_dir, removed_dir)
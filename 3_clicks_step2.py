@@ -45,14 +45,11 @@ if __name__ == "__main__":
     FINAL_w_label_dir = os.path.join(process_dir, "10_FINAL_w_label")
     FINAL_combined_dir = os.path.join(process_dir, "11_FINAL_combined")
 
-    my_gen_mask.convert_cropped_image_folder_to_mosaic_for_big_files(
-        keep_dir, mosaic_dir
-    )
-    my_gen_mask.convert_image_folder_to_gray_256(mosaic_dir, gray_256_dir)
-    my_gen_mask.gen_meteor_mask_from_folder(gray_256_dir, mask_256_dir)
-    my_gen_mask.resize_mask_to_original_cropped_size(mask_256_dir, mask_resize_back_dir)
-    my_gen_mask.mosaic_mask_files_merge_back(
-        mask_resize_back_dir, mosaic_merge_back_dir
+    # The folders in between are written only with settings.MASK_DEBUG_DUMP
+    my_gen_mask.gen_meteor_mask_from_cropped_folder(
+        keep_dir,
+        mosaic_merge_back_dir,
+        debug_dirs=(mosaic_dir, gray_256_dir, mask_256_dir, mask_resize_back_dir),
     )
 
     print(
@@ -49,14 +49,11 @@ if __name__ == "__main__":
         original_dir, mosaic_merge_back_dir, object_extracted_dir, verbose=1
     )
 
-    my_gen_mask.extend_extracted_objects_to_original_photo_size_by_multi_threading(
-        object_extracted_dir, FINAL_dir, FINAL_w_label_dir
-    )
-
-    my_gen_mask.combine_meteor_images_to_one(
-        FINAL_dir, FINAL_combined_dir, "final.png", verbose=1
-    )
-    my_gen_mask.combine_meteor_images_to_one(
-        FINAL_w_label_dir, FINAL_combined_dir, "final_w_label.png", verbose=1
+    my_gen_mask.combine_extracted_objects_to_one(
+        object_extracted_dir,
+        FINAL_combined_dir,
+        FINAL_dir,
+        FINAL_w_label_dir,
+        verbose=1,
     )
     print("\nProcess finished!")
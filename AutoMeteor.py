@@ -1,8 +1,10 @@
 # -*- coding: UTF-8 -*-
 import sys
 import os
+import multiprocessing
 import shutil
 import threading
+import logging
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import QApplication, QMainWindow, QDialog, QFileDialog, QMessageBox
@@ -14,13 +16,15 @@ from main_ui_chn import Ui_MainWindow
 
 # from numba import cuda
 # import keras
-import tensorflow as tf
-from tensorflow import keras
 
 import detection
 import gen_mask
+import model_host
+import settings
 
-tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+# TensorFlow is imported only when it is needed (or by the warm-up below).
+# Same as tf.compat.v1.logging.set_verbosity(), without importing it here
+logging.getLogger("tensorflow").setLevel(logging.ERROR)
 
 
 def get_folder_list(processFolder):
@@ -59,7 +63,8 @@ def get_folder_list(processFolder):
     )
 
 
-def Step_1_Process_Detection(processFolder, is_equatorial_mount):
+# backend: "thread" / "process", see settings.DETECTION_BACKEND
+def Step_1_Process_Detection(processFolder, is_equatorial_mount, backend=None):
     original_dir = processFolder
 
     # process_dir = os.path.join(original_dir, 'process')
@@ -96,6 +101,7 @@ def Step_1_Process_Detection(processFolder, is_equatorial_mount):
         # subtraction=False,
         equatorial_mount=is_equatorial_mount,
         verbose=1,
+        backend=backend,
     )
 
     detection.filter_possible_not_meteor_objects(extracted_dir, keep_dir, removed_dir)
@@ -105,9 +111,9 @@ def Step_1_Process_Detection(processFolder, is_equatorial_mount):
     # cuda.select_device(0)
     # cuda.close()
 
-    # Need to clean up the keras session
-    # to allow it to be run in the 2nd time
-    keras.backend.clear_session()
+    # The models are kept for the next steps / folders, unless the
+    # settings.MODEL_RELEASE_POLICY says to release them now
+    model_host.end_of_step()
 
     print("\n==========================================================")
     print("Possible objects extraction finished.")
@@ -122,14 +128,17 @@ def Step_1_Process_Detection(processFolder, is_equatorial_mount):
 class Detection_sub_thread_called_by_main(threading.Thread, QObject):
     detection_finish_signal = pyqtSignal()
 
-    def __init__(self, processFolder, is_equatorial_mount):
+    def __init__(self, processFolder, is_equatorial_mount, backend=None):
         threading.Thread.__init__(self)
         QObject.__init__(self)
         self.processFolder = processFolder
         self.is_equatorial_mount = is_equatorial_mount
+        self.backend = backend
 
     def run(self):
-        Step_1_Process_Detection(self.processFolder, self.is_equatorial_mount)
+        Step_1_Process_Detection(
+            self.processFolder, self.is_equatorial_mount, self.backend
+        )
         self.detection_finish_signal.emit()
 
 
@@ -173,21 +182,18 @@ def Step_3_Generate_Mask(processFolder):
 
     my_gen_mask = gen_mask.Gen_mask()
 
-    my_gen_mask.convert_cropped_image_folder_to_mosaic_for_big_files(
-        keep_dir, mosaic_dir
-    )
-    my_gen_mask.convert_image_folder_to_gray_256(mosaic_dir, gray_256_dir)
-    my_gen_mask.gen_meteor_mask_from_folder(gray_256_dir, mask_256_dir)
-    my_gen_mask.resize_mask_to_original_cropped_size(mask_256_dir, mask_resize_back_dir)
-    my_gen_mask.mosaic_mask_files_merge_back(
-        mask_resize_back_dir, mosaic_merge_back_dir
+    # The folders in between are written only with settings.MASK_DEBUG_DUMP
+    my_gen_mask.gen_meteor_mask_from_cropped_folder(
+        keep_dir,
+        mosaic_merge_back_dir,
+        debug_dirs=(mosaic_dir, gray_256_dir, mask_256_dir, mask_resize_back_dir),
     )
 
     # del my_gen_mask
 
-    # Need to clean up the keras session
-    # to allow it to be run in the 2nd time
-    keras.backend.clear_session()
+    # The models are kept for the next steps / folders, unless the
+    # settings.MODEL_RELEASE_POLICY says to release them now
+    model_host.end_of_step()
 
     print("\n==========================================================")
     print("Mask generation finished.")
@@ -254,15 +260,12 @@ def Step_5_Generate_Final(processFolder):
         original_dir, mosaic_merge_back_dir, object_extracted_dir, verbose=1
     )
 
-    my_gen_mask.extend_extracted_objects_to_original_photo_size_by_multi_threading(
-        object_extracted_dir, FINAL_dir, FINAL_w_label_dir
-    )
-
-    my_gen_mask.combine_meteor_images_to_one(
-        FINAL_dir, FINAL_combined_dir, "final.png", verbose=1
-    )
-    my_gen_mask.combine_meteor_images_to_one(
-        FINAL_w_label_dir, FINAL_combined_dir, "final_w_label.png", verbose=1
+    my_gen_mask.combine_extracted_objects_to_one(
+        object_extracted_dir,
+        FINAL_combined_dir,
+        FINAL_dir,
+        FINAL_w_label_dir,
+        verbose=1,
     )
 
     print("\n==========================================================")
@@ -307,6 +310,16 @@ class EmittingStream(QtCore.QObject):
         pass
 
 
+# Loads TensorFlow (settings.GUI_WARM_UP) while the user is selecting the
+# folder, so that the filter / mask step doesn't need to wait for it
+class Warm_up_sub_thread_called_by_main(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+
+    def run(self):
+        model_host.warm_up(load_models=settings.GUI_WARM_UP == "models")
+
+
 class MyMainForm(QMainWindow):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -335,6 +348,8 @@ class MyMainForm(QMainWindow):
         self.ui.generateFinalButton.clicked.connect(self.Step_5_DoFinalGeneration)
         self.ui.openFinalFolderButton.clicked.connect(self.Step_6_OpenFinalFolders)
 
+        self.ui.useProcessCheckBox.setChecked(settings.DETECTION_BACKEND == "process")
+
         self.ui.folderNameText.setText("(No folder selected)")
         self.processFolder = ""
         # self.ui.doDetectionButton.setEnabled(False)
@@ -411,6 +426,7 @@ class MyMainForm(QMainWindow):
     def change_GUI_control_status(self, status):
         self.ui.selectFolderButton.setEnabled(status)
         self.ui.isEQmountCheckBox.setEnabled(status)
+        self.ui.useProcessCheckBox.setEnabled(status)
         self.ui.doDetectionButton.setEnabled(status)
         self.ui.openDetectionFolderButton.setEnabled(status)
         self.ui.generateMaskButton.setEnabled(status)
@@ -576,8 +592,12 @@ class MyMainForm(QMainWindow):
             if self.ui.isEQmountCheckBox.checkState() == QtCore.Qt.Checked:
                 is_equatorial_mount = True
 
+            backend = "thread"
+            if self.ui.useProcessCheckBox.checkState() == QtCore.Qt.Checked:
+                backend = "process"
+
             process_thread = Detection_sub_thread_called_by_main(
-                self.processFolder, is_equatorial_mount
+                self.processFolder, is_equatorial_mount, backend
             )
             process_thread.detection_finish_signal.connect(
                 self.Step_1_Detection_Process_Finsihed
@@ -962,11 +982,9 @@ class MyMainForm(QMainWindow):
             FINAL_combined_dir,
         ) = get_folder_list(self.processFolder)
 
-        if (
-            not os.path.exists(FINAL_dir)
-            or not os.path.exists(FINAL_w_label_dir)
-            or not os.path.exists(FINAL_combined_dir)
-        ):
+        # The full size file for each object ('10_FINAL' and '10_FINAL_w_label')
+        # is only generated when settings.FINAL_SAVE_FULL_SIZE_OBJECT_FILES is set
+        if not os.path.exists(FINAL_combined_dir):
             # QMessageBox.information(self, "Info",
             #                         "Seems the final output files are not generated yet. \n\nPlease try step 5 first.",
             #                         QMessageBox.Ok)
@@ -984,15 +1002,23 @@ class MyMainForm(QMainWindow):
 
             return
 
-        os.startfile(FINAL_dir)
-        os.startfile(FINAL_w_label_dir)
+        if os.path.exists(FINAL_dir):
+            os.startfile(FINAL_dir)
+        if os.path.exists(FINAL_w_label_dir):
+            os.startfile(FINAL_w_label_dir)
         os.startfile(FINAL_combined_dir)
 
 
 if __name__ == "__main__":
+    # Needed by the multi-process detection in the packed exe
+    multiprocessing.freeze_support()
+
     app = QtWidgets.QApplication(sys.argv)
 
     myWin = MyMainForm()
     myWin.show()
 
+    if settings.GUI_WARM_UP in ["import", "models"]:
+        Warm_up_sub_thread_called_by_main().start()
+
     sys.exit(app.exec_())
@@ -1,92 +1,15 @@
+import multiprocessing
 import os
 import sys
 
 import detection
 import gen_mask
+import model_host
 
-if __name__ == "__main__":
-    # NOTE: parse the CLI arguments the hard way.
-    argv = sys.argv[1:]
-    if len(argv) < 2:
-        print(
-            "\nUsage: auto_meteor_shower <operation> <equatorial_mount option: Y/N> <folder name>"
-        )
-        print("operation: all (Do for both detection and extraction)")
-        print("           detection  (This is the step 1. Detection only)")
-        print("           gen-mask   (This is the step 2. Generate the mask file only)")
-        print("           extraction (This is the step 3. Extraction only)")
-        print(
-            "                      (The equatorial_mount option is not needed for the extraction-only operation)"
-        )
-        print(
-            "\nequatorial_mount option: Y (If the images were taken on equatorial mount)"
-        )
-        print(
-            "                         N (Choose this for images taken on fixed tripod)"
-        )
-        sys.exit(1)
-
-    do_option = argv[0]
-    do_option = do_option.lower()
-    if (
-        do_option != "all"
-        and do_option != "detection"
-        and do_option != "gen-mask"
-        and do_option != "extraction"
-    ):
-        print(
-            "\nUsage: auto_meteor_shower <operation> <equatorial_mount option: Y/N> <folder name>"
-        )
-        print("operation: all (Do for both detection and extraction)")
-        print("           detection  (This is the step 1. Detection only)")
-        print("           gen-mask   (This is the step 2. Generate the mask file only)")
-        print("           extraction (This is the step 3. Extraction only)")
-        print(
-            "                      (The equatorial_mount option is not needed for the extraction-only operation)"
-        )
-        print(
-            "\nequatorial_mount option: Y (If the images were taken on equatorial mount)"
-        )
-        print(
-            "                         N (Choose this for images taken on fixed tripod)"
-        )
-        sys.exit(1)
-
-    equatorial_mount_option = "N"
-
-    if do_option == "all" or do_option == "detection":
-        equatorial_mount_option = argv[1]
-        equatorial_mount_option = equatorial_mount_option.upper()
-        if equatorial_mount_option != "Y" and equatorial_mount_option != "N":
-            if do_option != "gen-mask" or do_option != "extraction":
-                print(
-                    "\nUsage: auto_meteor_shower <operation> <equatorial_mount option: Y/N> <folder name>"
-                )
-                print("operation: all (Do for both detection and extraction)")
-                print("           detection  (This is the step 1. Detection only)")
-                print(
-                    "           gen-mask   (This is the step 2. Generate the mask file only)"
-                )
-                print("           extraction (This is the step 3. Extraction only)")
-                print(
-                    "                      (The equatorial_mount option is not needed for the extraction-only operation)"
-                )
-                print(
-                    "\nequatorial_mount option: Y (If the images were taken on equatorial mount)"
-                )
-                print(
-                    "                         N (Choose this for images taken on fixed tripod)"
-                )
-                sys.exit(1)
-
-        original_dir = argv[2]
-    else:
-        original_dir = argv[1]
-
-    if not os.path.exists(original_dir):
-        print("\nNo such directory: {}".format(original_dir))
-        sys.exit(1)
 
+# Process one folder. The folders given in the command line are processed
+# one by one, sharing the loaded models (see model_host.py)
+def process_folder(original_dir, do_option, equatorial_mount_option, backend):
     meteor_detector = detection.MeteorDetector()
     my_gen_mask = gen_mask.Gen_mask()
 
@@ -127,6 +50,7 @@ if __name__ == "__main__":
             subtraction=True,
             equatorial_mount=is_equatorial_mount,
             verbose=1,
+            backend=backend,
         )
 
         # meteor_detector.filter_possible_not_meteor_objects(extracted_dir, keep_dir, not_sure_dir, removed_dir)
@@ -162,16 +86,11 @@ if __name__ == "__main__":
         print("    " "auto_meteor_shower gen-mask {}" "".format(original_dir))
 
     if do_option == "all" or do_option == "gen-mask":
-        my_gen_mask.convert_cropped_image_folder_to_mosaic_for_big_files(
-            keep_dir, mosaic_dir
-        )
-        my_gen_mask.convert_image_folder_to_gray_256(mosaic_dir, gray_256_dir)
-        my_gen_mask.gen_meteor_mask_from_folder(gray_256_dir, mask_256_dir)
-        my_gen_mask.resize_mask_to_original_cropped_size(
-            mask_256_dir, mask_resize_back_dir
-        )
-        my_gen_mask.mosaic_mask_files_merge_back(
-            mask_resize_back_dir, mosaic_merge_back_dir
+        # The folders in between are written only with settings.MASK_DEBUG_DUMP
+        my_gen_mask.gen_meteor_mask_from_cropped_folder(
+            keep_dir,
+            mosaic_merge_back_dir,
+            debug_dirs=(mosaic_dir, gray_256_dir, mask_256_dir, mask_resize_back_dir),
         )
         my_gen_mask.extract_meteor_from_original_folder_with_mask(
             original_dir, mosaic_merge_back_dir, object_extracted_dir, verbose=1
@@ -195,14 +114,97 @@ if __name__ == "__main__":
         print("    " "auto_meteor_shower extraction {}" "".format(original_dir))
 
     if do_option == "all" or do_option == "extraction":
-        my_gen_mask.extend_extracted_objects_to_original_photo_size_by_multi_threading(
-            object_extracted_dir, FINAL_dir, FINAL_w_label_dir
-        )
-        my_gen_mask.combine_meteor_images_to_one(
-            FINAL_dir, FINAL_combined_dir, "final.png", verbose=1
-        )
-        my_gen_mask.combine_meteor_images_to_one(
-            FINAL_w_label_dir, FINAL_combined_dir, "final_w_label.png", verbose=1
+        my_gen_mask.combine_extracted_objects_to_one(
+            object_extracted_dir,
+            FINAL_combined_dir,
+            FINAL_dir,
+            FINAL_w_label_dir,
+            verbose=1,
         )
 
         print("\nProcess finished!")
+
+
+def print_usage():
+    print(
+        "\nUsage: auto_meteor_shower <operation> <equatorial_mount option: Y/N> <folder name> [more folder names]"
+    )
+    print("operation: all (Do for both detection and extraction)")
+    print("           detection  (This is the step 1. Detection only)")
+    print("           gen-mask   (This is the step 2. Generate the mask file only)")
+    print("           extraction (This is the step 3. Extraction only)")
+    print(
+        "                      (The equatorial_mount option is not needed for the extraction-only operation)"
+    )
+    print(
+        "\nequatorial_mount option: Y (If the images were taken on equatorial mount)"
+    )
+    print(
+        "                         N (Choose this for images taken on fixed tripod)"
+    )
+    print(
+        "\noption: --process (Run the detection in processes, faster on many-core CPUs)"
+    )
+    print("        --thread  (Run the detection in threads)")
+
+
+if __name__ == "__main__":
+    # Needed by the multi-process detection in the packed exe
+    multiprocessing.freeze_support()
+
+    # NOTE: parse the CLI arguments the hard way.
+    argv = sys.argv[1:]
+
+    # "--process" / "--thread" can be given to choose how the detection is
+    # run in parallel. settings.DETECTION_BACKEND is used if not given.
+    backend = None
+    if "--process" in argv:
+        backend = "process"
+    elif "--thread" in argv:
+        backend = "thread"
+    argv = [arg for arg in argv if arg not in ["--process", "--thread"]]
+
+    if len(argv) < 2:
+        print_usage()
+        sys.exit(1)
+
+    do_option = argv[0]
+    do_option = do_option.lower()
+    if (
+        do_option != "all"
+        and do_option != "detection"
+        and do_option != "gen-mask"
+        and do_option != "extraction"
+    ):
+        print_usage()
+        sys.exit(1)
+
+    equatorial_mount_option = "N"
+
+    if do_option == "all" or do_option == "detection":
+        equatorial_mount_option = argv[1]
+        equatorial_mount_option = equatorial_mount_option.upper()
+        if equatorial_mount_option != "Y" and equatorial_mount_option != "N":
+            if do_option != "gen-mask" or do_option != "extraction":
+                print_usage()
+                sys.exit(1)
+
+        folder_list = argv[2:]
+    else:
+        folder_list = argv[1:]
+
+    if len(folder_list) == 0:
+        print_usage()
+        sys.exit(1)
+
+    for original_dir in folder_list:
+        if not os.path.exists(original_dir):
+            print("\nNo such directory: {}".format(original_dir))
+            sys.exit(1)
+
+    # The models are loaded once and used for all the folders
+    for original_dir in folder_list:
+        process_folder(original_dir, do_option, equatorial_mount_option, backend)
+
+    if len(folder_list) > 1:
+        print(model_host.get_model_host().get_stats_string())
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Benchmark for the CNN classification of the cropped images
+# (filter_possible_not_meteor_objects)
+#
+# Classifies the same crops with:
+# - The ImageDataGenerator with batch_size = 1 (the old way)
+# - The tf.data pipeline, with each of the batch sizes given
+# and compares the crops/s. The scores are checked to give the same
+# results. No file is copied or moved.
+#
+# Usage:
+#     python benchmark_cnn_filter.py <crop folder> [batch sizes]
+#
+#     crop folder: the folder with the crops in its sub-folders, normally
+#                  the "process/02_cropped" folder after the step 1
+#     batch sizes: like "1,8,32" (default "1,8,32,64")
+import os
+import sys
+import time
+
+import numpy as np
+from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+import model_host
+import settings
+from crop_classifier import get_crop_dataset, get_crop_file_list, is_meteor
+
+
+def predict_with_image_data_generator(cnn_model, crop_folder):
+    test_datagen = ImageDataGenerator(rescale=1.0 / 255)
+    test_generator = test_datagen.flow_from_directory(
+        crop_folder,
+        target_size=(settings.CNN_IMAGE_SIZE, settings.CNN_IMAGE_SIZE),
+        batch_size=1,
+        shuffle=False,
+        class_mode=None,
+    )
+    return cnn_model.predict(test_generator, len(test_generator.filenames), verbose=0)
+
+
+def predict_with_dataset(cnn_model, file_list, batch_size):
+    test_dataset = get_crop_dataset(
+        file_list,
+        batch_size=batch_size,
+        decode_threads=settings.CNN_DECODE_THREADS,
+        prefetch_batches=settings.CNN_PREFETCH_BATCHES,
+    )
+    return cnn_model.predict(test_dataset, verbose=0)
+
+
+def run(name, predict_func, num_of_crops, reference_scores=None):
+    start_time = time.perf_counter()
+    scores = np.asarray(predict_func())
+    used_time = time.perf_counter() - start_time
+
+    result = ""
+    if reference_scores is not None:
+        num_of_diff = sum(
+            is_meteor(s1) != is_meteor(s2) for s1, s2 in zip(scores, reference_scores)
+        )
+        result = "{} different, max score delta {:.6f}".format(
+            num_of_diff, float(np.max(np.abs(scores - reference_scores)))
+        )
+
+    print(
+        "{:>16} {:>9.2f}s {:>10.1f}  {}".format(
+            name, used_time, num_of_crops / used_time, result
+        )
+    )
+    return scores
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if len(argv) < 1:
+        print("\nUsage: benchmark_cnn_filter <crop folder> [batch sizes]")
+        print("batch sizes: like 1,8,32 (default 1,8,32,64)")
+        sys.exit(1)
+
+    crop_folder = argv[0]
+    if not os.path.exists(crop_folder):
+        print("No such directory: {}".format(crop_folder))
+        sys.exit(1)
+
+    batch_sizes = [1, 8, 32, 64]
+    if len(argv) > 1:
+        batch_sizes = [int(batch_size) for batch_size in argv[1].split(",")]
+
+    file_list = get_crop_file_list(crop_folder)
+    if len(file_list) == 0:
+        print("No crops found in the sub-folders of {}".format(crop_folder))
+        sys.exit(1)
+
+    cnn_model = model_host.get_model(model_host.CNN_MODEL)
+
+    # Warm up, so that the first run doesn't include the model building
+    predict_with_dataset(cnn_model, file_list[:1], 1)
+
+    print("\n{} crops".format(len(file_list)))
+    print("{:>16} {:>10} {:>10}".format("pipeline", "time", "crops/s"))
+
+    reference_scores = run(
+        "generator, bs=1",
+        lambda: predict_with_image_data_generator(cnn_model, crop_folder),
+        len(file_list),
+    )
+    for batch_size in batch_sizes:
+        run(
+            "tf.data, bs={}".format(batch_size),
+            lambda: predict_with_dataset(cnn_model, file_list, batch_size),
+            len(file_list),
+            reference_scores,
+        )
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# Benchmark for the CNN models which can be selected by
+# settings.CNN_MODEL_TYPE
+#
+# For each model: the # of parameters, the time to build the model and
+# load the weights, the crops/s, and how the crops are classified:
+# - The accuracy, if the test folder has the "others" / "star" sub-folders
+#   (same as the training data, see train_cnn.py)
+# - The decisions the same as the cnn_11 model (settings.CNN_SAVED_MODEL)
+#
+# Usage:
+#     python benchmark_cnn_models.py <test folder> [model types]
+#
+#     model types: like "cnn_11,cnn_11_gap" (default, all of them)
+import os
+import sys
+import time
+
+import numpy as np
+
+import model_host
+import settings
+from crop_classifier import get_crop_dataset, get_crop_file_list, is_meteor
+from train_cnn import CLASSES
+
+
+def run_model(model_type, file_list):
+    weights_file = getattr(settings, model_host.CNN_MODEL_TYPES[model_type][1])
+    if not os.path.exists(weights_file):
+        print("{}: {} not found, skipped".format(model_type, weights_file))
+        return None
+
+    start_time = time.perf_counter()
+    cnn_model = model_host.build_cnn_model(model_type)
+    cnn_model.load_weights(weights_file)
+    load_time = time.perf_counter() - start_time
+
+    # Warm up, so that the speed doesn't include the first call overhead
+    cnn_model.predict(get_crop_dataset(file_list[:1], batch_size=1), verbose=0)
+
+    start_time = time.perf_counter()
+    scores = np.asarray(
+        cnn_model.predict(
+            get_crop_dataset(file_list, batch_size=settings.CNN_BATCH_SIZE), verbose=0
+        )
+    )
+    predict_time = time.perf_counter() - start_time
+
+    return {
+        "params": cnn_model.count_params(),
+        "size": os.path.getsize(weights_file),
+        "load_time": load_time,
+        "crops_per_second": len(file_list) / predict_time,
+        "decisions": [is_meteor(score) for score in scores],
+    }
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if len(argv) < 1:
+        print("\nUsage: benchmark_cnn_models <test folder> [model types]")
+        print("model types: like {}".format(",".join(model_host.CNN_MODEL_TYPES)))
+        sys.exit(1)
+
+    test_folder = argv[0]
+    if not os.path.exists(test_folder):
+        print("No such directory: {}".format(test_folder))
+        sys.exit(1)
+
+    model_types = list(model_host.CNN_MODEL_TYPES)
+    if len(argv) > 1:
+        model_types = argv[1].split(",")
+
+    file_list = get_crop_file_list(test_folder)
+    if len(file_list) == 0:
+        print("No crops found in the sub-folders of {}".format(test_folder))
+        sys.exit(1)
+
+    # The labels from the sub-folder names, if it is a labelled set.
+    # True means a meteor (star)
+    labels = None
+    sub_folders = [os.path.basename(os.path.dirname(f)) for f in file_list]
+    if all(sub_folder in CLASSES for sub_folder in sub_folders):
+        labels = [sub_folder == "star" for sub_folder in sub_folders]
+
+    results = {}
+    for model_type in model_types:
+        result = run_model(model_type, file_list)
+        if result is not None:
+            results[model_type] = result
+
+    reference = results.get("cnn_11")
+
+    print("\n{} crops{}".format(len(file_list), "" if labels else " (not labelled)"))
+    print(
+        "{:>12} {:>12} {:>9} {:>8} {:>9} {:>9} {:>11}".format(
+            "model", "params", "size", "load", "crops/s", "accuracy", "vs cnn_11"
+        )
+    )
+    for model_type, result in results.items():
+        accuracy = "-"
+        if labels is not None:
+            accuracy = "{:.2%}".format(
+                np.mean([d == l for d, l in zip(result["decisions"], labels)])
+            )
+
+        agreement = "-"
+        if reference is not None:
+            agreement = "{:.2%}".format(
+                np.mean(
+                    [
+                        d == r
+                        for d, r in zip(result["decisions"], reference["decisions"])
+                    ]
+                )
+            )
+
+        print(
+            "{:>12} {:>12,} {:>7.1f}MB {:>7.2f}s {:>9.1f} {:>9} {:>11}".format(
+                model_type,
+                result["params"],
+                result["size"] / 1024 / 1024,
+                result["load_time"],
+                result["crops_per_second"],
+                accuracy,
+                agreement,
+            )
+        )
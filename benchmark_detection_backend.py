@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Benchmark for the detection backends (settings.DETECTION_BACKEND)
+#
+# Runs the step 1 detection on the same folder with the thread backend and
+# the process backend, and compares the time used. The output files
+# (boxes and cropped images) are checked to be identical.
+#
+# The output is written to temporary folders, which are removed after the
+# run. The "process" folder of the photos is not touched.
+#
+# Usage:
+#     python benchmark_detection_backend.py <equatorial_mount option: Y/N> <folder name> [backends]
+#
+#     backends: the backends to run, like "thread,process" (default)
+import hashlib
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import detection
+
+
+def get_output_digest(save_dir):
+    digest = {}
+    for sub_dir in ["01_detection", "02_cropped"]:
+        for root, _, files in os.walk(os.path.join(save_dir, sub_dir)):
+            for filename in files:
+                filename_w_path = os.path.join(root, filename)
+                with open(filename_w_path, "rb") as f:
+                    digest[os.path.relpath(filename_w_path, save_dir)] = hashlib.md5(
+                        f.read()
+                    ).hexdigest()
+    return digest
+
+
+def run_backend(file_dir, equatorial_mount, backend):
+    save_dir = tempfile.mkdtemp(prefix="detection_{}_".format(backend))
+    try:
+        start_time = time.perf_counter()
+        detection.multi_thread_process_detect_n_extract_meteor_from_folder(
+            file_dir,
+            save_dir,
+            subtraction=True,
+            equatorial_mount=equatorial_mount,
+            verbose=0,
+            backend=backend,
+        )
+        used_time = time.perf_counter() - start_time
+
+        return used_time, get_output_digest(save_dir)
+    finally:
+        shutil.rmtree(save_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+
+    argv = sys.argv[1:]
+    if len(argv) < 2 or argv[0].upper() not in ["Y", "N"]:
+        print(
+            "\nUsage: benchmark_detection_backend <equatorial_mount option: Y/N> <folder name> [backends]"
+        )
+        print("backends: the backends to run, like thread,process (default)")
+        sys.exit(1)
+
+    original_dir = argv[1]
+    if not os.path.exists(original_dir):
+        print("No such directory: {}".format(original_dir))
+        sys.exit(1)
+
+    backends = ["thread", "process"]
+    if len(argv) > 2:
+        backends = argv[2].split(",")
+
+    results = {}
+    for backend in backends:
+        results[backend] = run_backend(original_dir, argv[0].upper() == "Y", backend)
+
+    print("\nCPU core # = {}".format(multiprocessing.cpu_count()))
+    print("{:>10} {:>10} {:>8} {:>10}".format("backend", "time", "files", "speedup"))
+
+    reference_time, reference_digest = results[backends[0]]
+    for backend in backends:
+        used_time, digest = results[backend]
+        print(
+            "{:>10} {:>9.2f}s {:>8} {:>9.2f}x".format(
+                backend, used_time, len(digest), reference_time / used_time
+            )
+        )
+
+    for backend in backends[1:]:
+        if results[backend][1] == reference_digest:
+            print("{}: output identical to {}".format(backend, backends[0]))
+        else:
+            print("{}: output DIFFERENT from {}".format(backend, backends[0]))
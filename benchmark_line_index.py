@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Benchmark for the line spatial index (settings.DETECTION_USE_LINE_SPATIAL_INDEX)
+#
+# Generates random line segments (like the HoughLinesP output of a noisy
+# tripod image), then runs the line merging and the satellite checking with
+# and without the index. The results are checked to be identical.
+#
+# Usage:
+#     python benchmark_line_index.py [--full]
+#
+# Without the index, the time grows quadratically. By default it is only run
+# up to 3000 lines. Use --full to run it for all sizes (could take minutes).
+import copy
+import math
+import random
+import sys
+import time
+
+import numpy as np
+
+import settings
+from detection import MeteorDetector
+
+IMAGE_WIDTH = 6000
+IMAGE_HEIGHT = 4000
+LINE_NUMBERS = [10, 100, 1000, 3000, 10000]
+MAX_LINES_WITHOUT_INDEX = 3000
+
+
+# Lines in the format of the detection_lines_filtering() input:
+#     [[x1, y1], [x2, y2]]
+# Some of them are the broken pieces of long lines, to have some merging
+def generate_lines(num_of_lines, seed=0):
+    rnd = random.Random(seed)
+    lines = []
+    while len(lines) < num_of_lines:
+        x = rnd.randint(20, IMAGE_WIDTH - 420)
+        y = rnd.randint(20, IMAGE_HEIGHT - 420)
+        angle = rnd.uniform(-math.pi / 2, math.pi / 2)
+        length = rnd.randint(30, 120)
+
+        for _ in range(rnd.choice([1, 1, 1, 2, 3])):
+            x2 = int(x + length * math.cos(angle))
+            y2 = int(y + length * math.sin(angle))
+            if 0 <= x2 < IMAGE_WIDTH and 0 <= y2 < IMAGE_HEIGHT:
+                lines.append([np.array([x, y]), np.array([x2, y2])])
+
+            # The next piece, with a small gap and angle change
+            gap = rnd.randint(2, 40)
+            x = int(x2 + gap * math.cos(angle))
+            y = int(y2 + gap * math.sin(angle))
+            angle += rnd.uniform(-0.05, 0.05)
+
+    return lines[:num_of_lines]
+
+
+def run(lines, previous_lines, orig_image, use_index):
+    settings.DETECTION_USE_LINE_SPATIAL_INDEX = use_index
+    detector = MeteorDetector("Benchmark")
+
+    start_time = time.perf_counter()
+    merged_lines = detector.detection_lines_filtering(copy.deepcopy(lines), orig_image)
+    merge_time = time.perf_counter() - start_time
+
+    detector.Previous_Image_Detection_Lines = copy.deepcopy(previous_lines)
+    detector.Current_Image_Detection_Lines = copy.deepcopy(merged_lines)
+
+    start_time = time.perf_counter()
+    detector.check_satellite_with_previous_detection_list(verbose=0)
+    satellite_time = time.perf_counter() - start_time
+
+    result = (
+        merged_lines,
+        detector.Previous_Image_Satellites,
+        detector.Current_Image_Satellites,
+    )
+    return result, merge_time, satellite_time
+
+
+def main():
+    run_full = "--full" in sys.argv
+
+    # A plain gray image, no line would be removed as image border
+    orig_image = np.full((IMAGE_HEIGHT, IMAGE_WIDTH, 3), 128, dtype=np.uint8)
+
+    print(
+        "{:>8} {:>12} {:>12} {:>12} {:>12} {:>9}".format(
+            "lines", "merge(old)", "merge(idx)", "sat(old)", "sat(idx)", "same"
+        )
+    )
+
+    for num_of_lines in LINE_NUMBERS:
+        lines = generate_lines(num_of_lines, seed=num_of_lines)
+
+        # The lines from the "previous image" for the satellite checking.
+        # Take some of the same lines (as satellites), plus other lines
+        previous_result, _, _ = run(
+            generate_lines(num_of_lines, seed=num_of_lines + 1)[: num_of_lines // 2]
+            + lines[: num_of_lines // 2],
+            [],
+            orig_image,
+            use_index=True,
+        )
+        previous_lines = previous_result[0]
+
+        result_idx, merge_idx, sat_idx = run(
+            lines, previous_lines, orig_image, use_index=True
+        )
+
+        if run_full or num_of_lines <= MAX_LINES_WITHOUT_INDEX:
+            result_old, merge_old, sat_old = run(
+                lines, previous_lines, orig_image, use_index=False
+            )
+            same = str(result_old == result_idx)
+            merge_old = "{:.3f}s".format(merge_old)
+            sat_old = "{:.3f}s".format(sat_old)
+        else:
+            same = "-"
+            merge_old = "-"
+            sat_old = "-"
+
+        print(
+            "{:>8} {:>12} {:>12} {:>12} {:>12} {:>9}".format(
+                num_of_lines,
+                merge_old,
+                "{:.3f}s".format(merge_idx),
+                sat_old,
+                "{:.3f}s".format(sat_idx),
+                same,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
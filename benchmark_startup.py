@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Benchmark for the startup time of the entry points: the time to import
+# the entry module in a new Python process, and whether TensorFlow / Keras /
+# skimage were imported by it (they should be imported only by the steps
+# using the models).
+#
+# The main code of the entry points is not run (it is under
+# 'if __name__ == "__main__"'), so this is the time before the program can
+# start to work, or before the GUI window can be shown.
+#
+# Usage:
+#     python benchmark_startup.py [runs] [entry points]
+#
+#     runs        : 3 by default, the median time is reported
+#     entry points: like "3_clicks_step1,AutoMeteor" (default, all of them)
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ENTRY_POINTS = [
+    "3_clicks_step1",
+    "3_clicks_step2",
+    "3_clicks_step3",
+    "auto_meteor_shower",
+    "AutoMeteor",
+]
+
+# For reference, the time of importing TensorFlow itself
+REFERENCE_MODULES = ["tensorflow"]
+
+HEAVY_MODULES = ["tensorflow", "keras", "skimage"]
+
+# Run in the new process. Prints the import time and the heavy modules
+# imported, as JSON in the last line.
+IMPORT_CODE = """
+import importlib, json, sys, time
+start_time = time.perf_counter()
+importlib.import_module({module!r})
+used_time = time.perf_counter() - start_time
+print(json.dumps([used_time, [m for m in {heavy!r} if m in sys.modules]]))
+"""
+
+
+def time_import(module_name):
+    code = IMPORT_CODE.format(module=module_name, heavy=HEAVY_MODULES)
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        error_lines = result.stderr.strip().splitlines()
+        return None, error_lines[-1] if error_lines else "failed"
+
+    used_time, heavy_modules = json.loads(result.stdout.strip().splitlines()[-1])
+    return used_time, heavy_modules
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if len(argv) > 0 and not argv[0].isdigit():
+        print("\nUsage: benchmark_startup [runs] [entry points]")
+        print("    entry points: like {}".format(",".join(ENTRY_POINTS)))
+        sys.exit(1)
+
+    runs = 3
+    if len(argv) > 0:
+        runs = int(argv[0])
+    entry_points = ENTRY_POINTS
+    if len(argv) > 1:
+        entry_points = argv[1].split(",")
+
+    print("{:>20} {:>9}  {}".format("import", "time", "heavy modules imported"))
+    for module_name in entry_points + REFERENCE_MODULES:
+        time_list = []
+        heavy_modules = []
+        for i in range(runs):
+            used_time, heavy_modules = time_import(module_name)
+            if used_time is None:
+                break
+            time_list.append(used_time)
+
+        if len(time_list) == 0:
+            # Like PyQt5 not installed for the GUI
+            print("{:>20} {:>9}  {}".format(module_name, "-", heavy_modules))
+            continue
+
+        print(
+            "{:>20} {:>8.2f}s  {}".format(
+                module_name,
+                statistics.median(time_list),
+                ", ".join(heavy_modules) if heavy_modules else "-",
+            )
+        )
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Benchmark for the UNET++ mask generation from a folder of gray 256x256
+# images (gen_meteor_mask_from_folder), in tiles/s
+#
+# Predicts the same images with:
+# - unet_proc.testGenerator(), one image at a time in float64 (the old way)
+# - unet_proc.testDataset(), with each of the batch sizes given
+# The time of only preparing the inputs (no prediction) is also shown.
+# The masks are checked to be the same as the old way. No file is written.
+#
+# Usage:
+#     python benchmark_unet.py <gray 256 folder> [batch sizes]
+#
+#     gray 256 folder: normally the "process/05_gray_256" folder (written
+#                      with settings.MASK_DEBUG_DUMP)
+#     batch sizes    : like "1,4,8" (default "1,4,8,16")
+import os
+import sys
+import time
+
+import numpy as np
+
+import model_host
+import settings
+import unet_proc
+
+
+def get_generator_inputs(gray_256_folder):
+    return unet_proc.testGenerator(gray_256_folder, as_gray=True)
+
+
+def get_dataset_inputs(file_list, batch_size):
+    return unet_proc.testDataset(
+        file_list,
+        batch_size=batch_size,
+        decode_threads=settings.UNET_DECODE_THREADS,
+        prefetch_batches=settings.UNET_PREFETCH_BATCHES,
+    )
+
+
+def run(name, get_inputs, unet_model, num_of_tiles, reference_masks=None):
+    # Only the input pipeline
+    start_time = time.perf_counter()
+    for batch in get_inputs():
+        pass
+    input_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    masks = np.asarray(unet_model.predict(get_inputs(), verbose=0))
+    used_time = time.perf_counter() - start_time
+
+    result = ""
+    if reference_masks is not None:
+        num_of_diff = int(
+            np.sum((masks > 0.5) != (reference_masks > 0.5), dtype=np.int64)
+        )
+        result = "{} mask pixels different, max delta {:.6f}".format(
+            num_of_diff, float(np.max(np.abs(masks - reference_masks)))
+        )
+
+    print(
+        "{:>18} {:>10.1f} {:>9.2f}s {:>10.2f}  {}".format(
+            name, num_of_tiles / input_time, used_time, num_of_tiles / used_time, result
+        )
+    )
+    return masks
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if len(argv) < 1:
+        print("\nUsage: benchmark_unet <gray 256 folder> [batch sizes]")
+        print("batch sizes: like 1,4,8 (default 1,4,8,16)")
+        sys.exit(1)
+
+    gray_256_folder = argv[0]
+    if not os.path.exists(gray_256_folder):
+        print("No such directory: {}".format(gray_256_folder))
+        sys.exit(1)
+
+    batch_sizes = [1, 4, 8, 16]
+    if len(argv) > 1:
+        batch_sizes = [int(batch_size) for batch_size in argv[1].split(",")]
+
+    file_list = unet_proc.get_test_file_list(gray_256_folder)
+    if len(file_list) == 0:
+        print("No images found in {}".format(gray_256_folder))
+        sys.exit(1)
+
+    unet_model = model_host.get_model(model_host.UNET_MODEL)
+
+    # Warm up, so that the first run doesn't include the model building
+    unet_model.predict(get_dataset_inputs(file_list[:1], 1), verbose=0)
+
+    print("\n{} tiles".format(len(file_list)))
+    print(
+        "{:>18} {:>10} {:>10} {:>10}".format(
+            "pipeline", "input/s", "time", "tiles/s"
+        )
+    )
+
+    reference_masks = run(
+        "generator, bs=1",
+        lambda: get_generator_inputs(gray_256_folder),
+        unet_model,
+        len(file_list),
+    )
+    for batch_size in batch_sizes:
+        run(
+            "tf.data, bs={}".format(batch_size),
+            lambda: get_dataset_inputs(file_list, batch_size),
+            unet_model,
+            len(file_list),
+            reference_masks,
+        )
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Accuracy check of the TFLite models (model_export.py) against the Keras
+# models, before switching settings.INFERENCE_BACKEND to "tflite".
+#
+# - CNN: the crops are classified by both models. The decisions (kept or
+#   removed) should be the same.
+# - UNET++: the masks are generated by both models. The IoU of the masks
+#   (pixels > 0.5) should be close to 1.
+#
+# Better to use a set of images not used for training the models, like
+# the "02_cropped" and "05_gray_256" folders of a night not seen before.
+#
+# Usage:
+#     python check_inference_accuracy.py <fp32|fp16|int8> <crop folder> [gray 256 folder]
+#
+#     crop folder    : the folder with the crops in its sub-folders, normally
+#                      "process/02_cropped". "-" to skip the CNN check
+#     gray 256 folder: the 256x256 gray images for the UNET++, normally
+#                      "process/05_gray_256"
+import os
+import sys
+import time
+
+import numpy as np
+
+import model_host
+import settings
+import unet_proc
+from crop_classifier import get_crop_dataset, get_crop_file_list, is_meteor
+from model_export import TFLiteModel, get_tflite_model_file
+
+# The TFLite model is taken as good enough if:
+# - Not more than this ratio of the crops are classified differently
+MAX_DECISION_DIFF_RATIO = 0.01
+
+# - The mean IoU of the masks is at least this, and no mask is below
+#   MIN_MASK_IOU
+MIN_MEAN_MASK_IOU = 0.95
+MIN_MASK_IOU = 0.8
+
+
+def predict_n_time(predict_model, x):
+    start_time = time.perf_counter()
+    results = np.asarray(predict_model.predict(x, verbose=0))
+    return results, time.perf_counter() - start_time
+
+
+def get_tflite_model(name, quantization):
+    tflite_model_file = get_tflite_model_file(
+        model_host.get_weights_file(name), quantization
+    )
+    if not os.path.exists(tflite_model_file):
+        print("{} not found. Export it first by:".format(tflite_model_file))
+        print("    python model_export.py {} {}".format(name, quantization))
+        sys.exit(1)
+    return TFLiteModel(tflite_model_file, settings.INFERENCE_TFLITE_THREADS)
+
+
+def check_cnn(crop_folder, quantization):
+    file_list = get_crop_file_list(crop_folder)
+    if len(file_list) == 0:
+        print("No crops found in the sub-folders of {}".format(crop_folder))
+        return False
+
+    def get_dataset():
+        return get_crop_dataset(file_list, batch_size=settings.CNN_BATCH_SIZE)
+
+    keras_model, _ = model_host.load_keras_model(model_host.CNN_MODEL)
+    keras_scores, keras_time = predict_n_time(keras_model, get_dataset())
+
+    tflite_model = get_tflite_model(model_host.CNN_MODEL, quantization)
+    tflite_scores, tflite_time = predict_n_time(tflite_model, get_dataset())
+
+    diff_list = [
+        os.path.basename(file_list[i])
+        for i in range(len(file_list))
+        if is_meteor(keras_scores[i]) != is_meteor(tflite_scores[i])
+    ]
+    diff_ratio = len(diff_list) / len(file_list)
+
+    print("\nCNN, {} crops:".format(len(file_list)))
+    print(
+        "    Keras : {:.2f}s, {:.1f} crops/s".format(
+            keras_time, len(file_list) / keras_time
+        )
+    )
+    print(
+        "    TFLite: {:.2f}s, {:.1f} crops/s ({})".format(
+            tflite_time, len(file_list) / tflite_time, quantization
+        )
+    )
+    print(
+        "    {} decisions different ({:.2%}), max score delta {:.6f}".format(
+            len(diff_list),
+            diff_ratio,
+            float(np.max(np.abs(keras_scores - tflite_scores))),
+        )
+    )
+    for filename in diff_list:
+        print("        {}".format(filename))
+
+    return diff_ratio <= MAX_DECISION_DIFF_RATIO
+
+
+def get_mask_iou(mask_1, mask_2):
+    mask_1 = mask_1 > 0.5
+    mask_2 = mask_2 > 0.5
+    union = np.logical_or(mask_1, mask_2).sum()
+    if union == 0:
+        # Both are empty
+        return 1.0
+    return np.logical_and(mask_1, mask_2).sum() / union
+
+
+def check_unet(gray_256_folder, quantization):
+    file_list = unet_proc.get_test_file_list(gray_256_folder)
+    image_list = [os.path.basename(f) for f in file_list]
+    if len(image_list) == 0:
+        print("No images found in {}".format(gray_256_folder))
+        return False
+
+    def get_dataset():
+        return unet_proc.testDataset(file_list, batch_size=settings.UNET_BATCH_SIZE)
+
+    keras_model, _ = model_host.load_keras_model(model_host.UNET_MODEL)
+    keras_masks, keras_time = predict_n_time(keras_model, get_dataset())
+
+    tflite_model = get_tflite_model(model_host.UNET_MODEL, quantization)
+    tflite_masks, tflite_time = predict_n_time(tflite_model, get_dataset())
+
+    iou_list = [
+        get_mask_iou(keras_mask, tflite_mask)
+        for keras_mask, tflite_mask in zip(keras_masks, tflite_masks)
+    ]
+    mean_iou = float(np.mean(iou_list))
+    min_iou = float(np.min(iou_list))
+
+    print("\nUNET++, {} images:".format(len(image_list)))
+    print(
+        "    Keras : {:.2f}s, {:.1f} images/s".format(
+            keras_time, len(image_list) / keras_time
+        )
+    )
+    print(
+        "    TFLite: {:.2f}s, {:.1f} images/s ({})".format(
+            tflite_time, len(image_list) / tflite_time, quantization
+        )
+    )
+    print("    Mask IoU: mean {:.4f}, min {:.4f}".format(mean_iou, min_iou))
+    for image_file, iou in zip(image_list, iou_list):
+        if iou < MIN_MASK_IOU:
+            print("        {}: {:.4f}".format(image_file, iou))
+
+    return mean_iou >= MIN_MEAN_MASK_IOU and min_iou >= MIN_MASK_IOU
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if len(argv) < 2 or argv[0] not in ["fp32", "fp16", "int8"]:
+        print(
+            "\nUsage: check_inference_accuracy <fp32|fp16|int8> <crop folder> [gray 256 folder]"
+        )
+        print('    crop folder: "-" to skip the CNN check')
+        sys.exit(1)
+
+    quantization = argv[0]
+    results = {}
+    if argv[1] != "-":
+        results["CNN"] = check_cnn(argv[1], quantization)
+    if len(argv) > 2:
+        results["UNET++"] = check_unet(argv[2], quantization)
+
+    print()
+    for name, passed in results.items():
+        print("{}: {}".format(name, "PASSED" if passed else "FAILED"))
+
+    sys.exit(0 if all(results.values()) else 1)
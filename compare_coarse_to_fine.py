@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Compare the coarse-to-fine detection (settings.DETECTION_PYRAMID_LEVEL)
+# with the full resolution detection on a folder of photos.
+#
+# For each photo, the difference image is made in the same way as the
+# detection step (subtract the next photo). The lines detected with the
+# full resolution are taken as the reference. The recall is how many of
+# them are also found by the coarse-to-fine detection.
+#
+# Usage:
+#     python compare_coarse_to_fine.py <equatorial_mount option: Y/N> <folder name> [levels]
+#
+#     levels: pyramid levels to compare, like "1,2". Default is "1,2"
+import math
+import os
+import sys
+import time
+
+import cv2
+
+import settings
+from detection import MeteorDetector
+from frame_store import load_frame
+from utils import filter_images
+
+# A reference line is considered found if a line detected by the coarse-to-
+# fine method has a similar angle, and its distance to the mid point of the
+# reference line is within this value (in pixels)
+MATCH_DISTANCE = 10
+MATCH_ANGLE = 0.2
+
+
+def get_point_to_line_distance(px, py, line):
+    x1, y1, x2, y2 = [float(v) for v in line[0:4]]
+    line_length_square = (x2 - x1) ** 2 + (y2 - y1) ** 2
+    if line_length_square == 0:
+        return math.sqrt((px - x1) ** 2 + (py - y1) ** 2)
+
+    u = ((px - x1) * (x2 - x1) + (py - y1) * (y2 - y1)) / line_length_square
+    u = min(max(u, 0), 1)
+    return math.sqrt((px - x1 - u * (x2 - x1)) ** 2 + (py - y1 - u * (y2 - y1)) ** 2)
+
+
+def is_line_found(reference_line, detection_lines):
+    for line in detection_lines:
+        angle_delta = abs(reference_line[6] - line[6])
+        if angle_delta > math.pi / 2:
+            angle_delta = math.pi - angle_delta
+        if angle_delta > MATCH_ANGLE:
+            continue
+
+        if (
+            get_point_to_line_distance(reference_line[4], reference_line[5], line)
+            <= MATCH_DISTANCE
+        ):
+            return True
+    return False
+
+
+def detect_lines(detection_img, orig_img, equatorial_mount, pyramid_level):
+    settings.DETECTION_PYRAMID_LEVEL = pyramid_level
+    meteor_detector = MeteorDetector("Compare")
+
+    start_time = time.perf_counter()
+    detection_lines = meteor_detector.detect_meteor_from_image(
+        detection_img, orig_img, equatorial_mount=equatorial_mount
+    )
+    used_time = time.perf_counter() - start_time
+
+    if detection_lines is None:
+        detection_lines = []
+    return detection_lines, used_time
+
+
+def compare_folder(file_dir, equatorial_mount, levels):
+    image_list = filter_images(os.listdir(file_dir))
+    if len(image_list) < 2:
+        print("At least two photos are needed")
+        return
+
+    # For each level: [# of reference lines found, # of lines, time]
+    total_reference_lines = 0
+    total_reference_time = 0
+    level_results = {level: [0, 0, 0] for level in levels}
+
+    for index, image_file in enumerate(image_list):
+        if index <= len(image_list) - 2:
+            next_image_file = image_list[index + 1]
+        else:
+            next_image_file = image_list[index - 1]
+
+        orig_img = load_frame(os.path.join(file_dir, image_file))
+        img_for_subtraction = load_frame(os.path.join(file_dir, next_image_file))
+        detection_img = cv2.subtract(orig_img, img_for_subtraction)
+
+        reference_lines, reference_time = detect_lines(
+            detection_img, orig_img, equatorial_mount, 0
+        )
+        total_reference_lines += len(reference_lines)
+        total_reference_time += reference_time
+
+        result_str = "{}: full resolution {} lines ({:.2f}s)".format(
+            image_file, len(reference_lines), reference_time
+        )
+
+        for level in levels:
+            detection_lines, used_time = detect_lines(
+                detection_img, orig_img, equatorial_mount, level
+            )
+            num_of_found = sum(
+                1 for line in reference_lines if is_line_found(line, detection_lines)
+            )
+
+            level_results[level][0] += num_of_found
+            level_results[level][1] += len(detection_lines)
+            level_results[level][2] += used_time
+
+            result_str += ", level {}: found {}/{} ({} lines, {:.2f}s)".format(
+                level, num_of_found, len(reference_lines), len(detection_lines), used_time
+            )
+
+        print(result_str)
+
+    print("\nSummary for {} photos:".format(len(image_list)))
+    print(
+        "    full resolution: {} lines, {:.2f}s".format(
+            total_reference_lines, total_reference_time
+        )
+    )
+    for level in levels:
+        num_of_found, num_of_lines, used_time = level_results[level]
+        if total_reference_lines > 0:
+            recall = num_of_found / total_reference_lines * 100
+        else:
+            recall = 100
+        print(
+            "    level {} ({}x): recall {:.1f}% ({}/{}), {} lines, {:.2f}s".format(
+                level,
+                2**level,
+                recall,
+                num_of_found,
+                total_reference_lines,
+                num_of_lines,
+                used_time,
+            )
+        )
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if len(argv) < 2 or argv[0].upper() not in ["Y", "N"]:
+        print(
+            "\nUsage: compare_coarse_to_fine <equatorial_mount option: Y/N> <folder name> [levels]"
+        )
+        print("levels: pyramid levels to compare, like 1,2 (default)")
+        sys.exit(1)
+
+    original_dir = argv[1]
+    if not os.path.exists(original_dir):
+        print("No such directory: {}".format(original_dir))
+        sys.exit(1)
+
+    levels = [1, 2]
+    if len(argv) > 2:
+        levels = [int(level) for level in argv[2].split(",")]
+
+    compare_folder(original_dir, argv[0].upper() == "Y", levels)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+# Same fixed-point precision as the Pillow Image.alpha_composite()
+# implementation (AlphaComposite.c), so that the "alpha" mode gives the
+# same result as chaining Image.alpha_composite() on full size images
+ALPHA_COMPOSITE_PRECISION_BITS = 7
+
+BLEND_MODES = ["alpha", "lighten", "max"]
+
+
+def _shift_for_div_255(value):
+    return ((value >> 8) + value) >> 8
+
+
+# The src layer is put over the dst, both are uint8 RGBA arrays with the
+# same shape. Integer math is the same as Image.alpha_composite(dst, src)
+def alpha_composite_over(dst, src):
+    src_a = src[:, :, 3].astype(np.uint32)
+    dst_a = dst[:, :, 3].astype(np.uint32)
+
+    blend = dst_a * (255 - src_a)
+    out_a_255 = src_a * 255 + blend
+
+    # When src_a == 0, the dst pixel is kept. Avoid the division by zero
+    coef_1 = (src_a * 255 * 255 * (1 << ALPHA_COMPOSITE_PRECISION_BITS)) // np.maximum(
+        out_a_255, 1
+    )
+    coef_2 = 255 * (1 << ALPHA_COMPOSITE_PRECISION_BITS) - coef_1
+
+    tmp = (
+        src[:, :, :3].astype(np.uint32) * coef_1[:, :, np.newaxis]
+        + dst[:, :, :3].astype(np.uint32) * coef_2[:, :, np.newaxis]
+        + (0x80 << ALPHA_COMPOSITE_PRECISION_BITS)
+    )
+
+    out = np.empty_like(dst)
+    out[:, :, :3] = _shift_for_div_255(tmp) >> ALPHA_COMPOSITE_PRECISION_BITS
+    out[:, :, 3] = _shift_for_div_255(out_a_255 + 0x80)
+
+    return np.where((src_a == 0)[:, :, np.newaxis], dst, out)
+
+
+# The brighter pixel (by luminance) wins. Fully transparent pixels
+# in the src layer are ignored
+def lighten_composite(dst, src):
+    weights = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    src_luminance = src[:, :, :3].astype(np.float32) @ weights
+    dst_luminance = dst[:, :, :3].astype(np.float32) @ weights
+
+    use_src = (src[:, :, 3] > 0) & (
+        (dst[:, :, 3] == 0) | (src_luminance > dst_luminance)
+    )
+    return np.where(use_src[:, :, np.newaxis], src, dst)
+
+
+# Per-channel maximum. Fully transparent pixels in the src layer are
+# ignored, otherwise their (255, 255, 255, 0) value would turn the
+# result into white
+def max_composite(dst, src):
+    use_src = (src[:, :, 3] > 0)[:, :, np.newaxis]
+    return np.where(use_src, np.maximum(dst, src), dst)
+
+
+# Keep each extracted meteor object as a small (crop, offset) layer, and
+# blend it into one canvas directly.
+#
+# This is to avoid extending every meteor object to the full photo size
+# (which could be 45M+ pixels each) before combining them.
+class MeteorCompositor:
+    def __init__(self, width, height, blend_mode="alpha"):
+        if blend_mode not in BLEND_MODES:
+            raise ValueError(
+                "Unsupported blend mode '{}'. Should be one of {}".format(
+                    blend_mode, BLEND_MODES
+                )
+            )
+
+        self.Width = width
+        self.Height = height
+        self.Blend_Mode = blend_mode
+
+        # Same as the padding of cv2.copyMakeBorder() used for the full
+        # size files, the area without any meteor is (0, 0, 0, 0)
+        self.Canvas = np.zeros((height, width, 4), dtype=np.uint8)
+        self.Layer_Count = 0
+
+    # layer_rgba: uint8 (h, w, 4) array
+    # (x, y): the position of the layer's top-left corner in the canvas
+    def add_layer(self, layer_rgba, x, y):
+        layer_height, layer_width = layer_rgba.shape[:2]
+
+        # Clip the layer to the canvas, just in case
+        canvas_x1 = max(x, 0)
+        canvas_y1 = max(y, 0)
+        canvas_x2 = min(x + layer_width, self.Width)
+        canvas_y2 = min(y + layer_height, self.Height)
+
+        if canvas_x1 >= canvas_x2 or canvas_y1 >= canvas_y2:
+            return
+
+        layer = layer_rgba[
+            canvas_y1 - y : canvas_y2 - y, canvas_x1 - x : canvas_x2 - x
+        ]
+        canvas_roi = self.Canvas[canvas_y1:canvas_y2, canvas_x1:canvas_x2]
+
+        if self.Layer_Count == 0:
+            # The first image was used as the base image when combining
+            # the full size files. Just take it as it is.
+            canvas_roi[...] = layer
+        elif self.Blend_Mode == "alpha":
+            canvas_roi[...] = alpha_composite_over(canvas_roi, layer)
+        elif self.Blend_Mode == "lighten":
+            canvas_roi[...] = lighten_composite(canvas_roi, layer)
+        else:
+            canvas_roi[...] = max_composite(canvas_roi, layer)
+
+        self.Layer_Count += 1
+
+    def get_canvas(self):
+        return self.Canvas
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+import csv
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import model_host
+import output_writer
+import settings
+
+# The per-crop scores of the classification, under '03_filtered'
+SCORE_REPORT_NAME = "scores.csv"
+
+# The files taken as crops, same as ImageDataGenerator.flow_from_directory()
+CROP_FILE_EXTENSIONS = [".png", ".jpg", ".jpeg", ".bmp", ".ppm", ".tif", ".tiff"]
+
+
+# Classifies the cropped images with the CNN model while the detection is
+# still going on (settings.DETECTION_STREAM_TO_CLASSIFIER).
+#
+# Without this, the crops are written to '02_cropped/un-classified' by
+# the detection, read back and classified after the detection is done,
+# and then copied to '03_filtered/good' or '03_filtered/removed'.
+#
+# Here the crops are put to a queue in memory. A worker thread takes them
+# in batches, classifies them and writes each crop once, directly to the
+# final folder.
+#
+# - The queue is bounded. When the classifier cannot catch up, put() will
+#   wait, so that the crops waiting would not use up the memory.
+# - If the classification of a batch failed, the crops are written to the
+#   'un-classified' folder instead, to be classified after the detection
+#   by filter_possible_not_meteor_objects().
+class CropClassifier:
+    def __init__(
+        self,
+        keep_folder,
+        removed_folder,
+        unclassified_folder,
+        batch_size=32,
+        max_queue_size=64,
+        name="Classifier",
+    ):
+        self.Keep_Folder = keep_folder
+        self.Removed_Folder = removed_folder
+        self.Unclassified_Folder = unclassified_folder
+        self.Batch_Size = max(batch_size, 1)
+        self.Name = name
+
+        # [file name, 'others' score, 'star' score, result]
+        self.Score_List = []
+
+        for folder in [self.Keep_Folder, self.Removed_Folder]:
+            os.makedirs(folder, exist_ok=True)
+
+        self.Queue = queue.Queue(maxsize=max(max_queue_size, 1))
+
+        # Statistics
+        self.Num_Of_Kept = 0
+        self.Num_Of_Removed = 0
+        self.Num_Of_Unclassified = 0
+        self.Num_Of_Batches = 0
+        self.Predict_Time = 0.0
+        self.Errors = []
+
+        self.Worker = threading.Thread(
+            target=self.__worker_loop, name=name, daemon=True
+        )
+        self.Worker.start()
+
+    # The crop is copied, so that the whole frame it was cut from is not
+    # kept in the memory while the crop is waiting in the queue
+    def put(self, file_ext, crop_img, file_basename):
+        self.Queue.put((file_ext, np.ascontiguousarray(crop_img), file_basename))
+
+    def __worker_loop(self):
+        batch = []
+        while True:
+            item = self.Queue.get()
+            if item is not None:
+                batch.append(item)
+
+            # Classify when the batch is full, or no more crop is waiting
+            if len(batch) > 0 and (
+                item is None or len(batch) >= self.Batch_Size or self.Queue.empty()
+            ):
+                self.__classify_batch(batch)
+                batch = []
+
+            if item is None:
+                return
+
+    def __classify_batch(self, batch):
+        try:
+            input_batch = np.stack(
+                [get_classifier_input(crop_img) for _, crop_img, _ in batch]
+            )
+
+            start_time = time.perf_counter()
+            scores_predict = np.asarray(
+                model_host.get_model(model_host.CNN_MODEL).predict_on_batch(
+                    input_batch
+                )
+            )
+            self.Predict_Time += time.perf_counter() - start_time
+            self.Num_Of_Batches += 1
+        except Exception as e:
+            print("{}: classification failed: {}".format(self.Name, e))
+            self.Errors.append(e)
+
+            os.makedirs(self.Unclassified_Folder, exist_ok=True)
+            for file_ext, crop_img, file_basename in batch:
+                output_writer.write_image(
+                    file_ext,
+                    crop_img,
+                    os.path.join(self.Unclassified_Folder, file_basename),
+                )
+            self.Num_Of_Unclassified += len(batch)
+            return
+
+        # Same as filter_possible_not_meteor_objects(), see is_meteor()
+        for (file_ext, crop_img, file_basename), scores in zip(batch, scores_predict):
+            if is_meteor(scores):
+                # Star image, keep
+                dest_file_w_path = os.path.join(self.Keep_Folder, file_basename)
+                self.Num_Of_Kept += 1
+            else:
+                dest_file_w_path = os.path.join(self.Removed_Folder, file_basename)
+                self.Num_Of_Removed += 1
+
+            self.Score_List.append(get_score_row(file_basename, scores))
+            output_writer.write_image(file_ext, crop_img, dest_file_w_path)
+
+    # Wait until all the crops put are classified, and stop the worker
+    def close(self):
+        self.Queue.put(None)
+        self.Worker.join()
+
+        update_score_report(
+            os.path.join(os.path.dirname(self.Keep_Folder), SCORE_REPORT_NAME),
+            self.Score_List,
+        )
+
+    def get_stats_string(self):
+        stats_string = "{}: {} kept, {} removed, {} batches, {:.2f}s predicting".format(
+            self.Name,
+            self.Num_Of_Kept,
+            self.Num_Of_Removed,
+            self.Num_Of_Batches,
+            self.Predict_Time,
+        )
+        if self.Num_Of_Unclassified > 0:
+            stats_string += ", {} left un-classified ({} errors)".format(
+                self.Num_Of_Unclassified, len(self.Errors)
+            )
+        return stats_string
+
+
+# The crop in BGR (as loaded by OpenCV) to the input of the CNN model.
+# The same as what ImageDataGenerator.flow_from_directory() gives for
+# the crop file: RGB, resized with the nearest neighbour, rescaled to 0~1
+def get_classifier_input(crop_img):
+    if crop_img.dtype == np.uint16:
+        crop_img = (crop_img // 257).astype(np.uint8)
+
+    if crop_img.ndim == 2:
+        rgb_img = cv2.cvtColor(crop_img, cv2.COLOR_GRAY2RGB)
+    elif crop_img.shape[2] == 4:
+        rgb_img = cv2.cvtColor(crop_img, cv2.COLOR_BGRA2RGB)
+    else:
+        rgb_img = cv2.cvtColor(crop_img, cv2.COLOR_BGR2RGB)
+
+    image_size = settings.CNN_IMAGE_SIZE
+    rgb_img = Image.fromarray(rgb_img).resize((image_size, image_size), Image.NEAREST)
+    return np.asarray(rgb_img, dtype=np.float32) / 255
+
+
+# Decode the crop file to the input of the CNN model.
+# The decoding also works for the file names with Chinese characters.
+def load_classifier_input(filename_w_path):
+    crop_img = cv2.imdecode(
+        np.fromfile(filename_w_path, dtype=np.uint8), cv2.IMREAD_UNCHANGED
+    )
+    if crop_img is None:
+        raise OSError("Failed to decode {}".format(filename_w_path))
+    return get_classifier_input(crop_img)
+
+
+# The crop files in the sub-folders of the folder, in the same order as
+# ImageDataGenerator.flow_from_directory() (sub-folder, then file name)
+def get_crop_file_list(crop_folder):
+    file_list = []
+    for sub_folder in sorted(os.listdir(crop_folder)):
+        sub_folder_w_path = os.path.join(crop_folder, sub_folder)
+        if not os.path.isdir(sub_folder_w_path):
+            continue
+
+        for filename in sorted(os.listdir(sub_folder_w_path)):
+            if os.path.splitext(filename)[1].lower() in CROP_FILE_EXTENSIONS:
+                file_list.append(os.path.join(sub_folder_w_path, filename))
+    return file_list
+
+
+# The tf.data input pipeline for the classification:
+# - The crops are decoded and resized by decode_threads threads at the
+#   same time (0 means decided by TensorFlow)
+# - Put to batches of batch_size
+# - prefetch_batches batches are prepared while the model is predicting
+#   the current one (0 means decided by TensorFlow)
+def get_crop_dataset(file_list, batch_size=32, decode_threads=0, prefetch_batches=0):
+    # Imported here, so that the detection doesn't need to wait for
+    # TensorFlow to be loaded
+    import tensorflow as tf
+
+    image_size = settings.CNN_IMAGE_SIZE
+
+    def load_crop(filename_w_path):
+        crop = tf.numpy_function(
+            lambda f: load_classifier_input(f.decode("utf-8")),
+            [filename_w_path],
+            tf.float32,
+        )
+        crop.set_shape((image_size, image_size, 3))
+        return crop
+
+    dataset = tf.data.Dataset.from_tensor_slices(file_list)
+    dataset = dataset.map(
+        load_crop,
+        num_parallel_calls=decode_threads if decode_threads > 0 else tf.data.AUTOTUNE,
+        deterministic=True,
+    )
+    dataset = dataset.batch(max(batch_size, 1))
+    dataset = dataset.prefetch(
+        prefetch_batches if prefetch_batches > 0 else tf.data.AUTOTUNE
+    )
+    return dataset
+
+
+# There will be three values in each score:
+#   [0]: 'meteor'   : 0.xxxxx
+#   [1]: 'others'   : 0.yyyyy
+#   [2]: 'satellite': 0.zzzzz
+#
+#  2020-5-13: Changed to this
+#   [0]: 'others'   : 0.xxxxx
+#   [1]: 'star'     : 0.yyyyy
+#
+# If the maximum value is scores[1], take it as a meteor
+def is_meteor(scores):
+    return scores[0] < scores[1]
+
+
+def get_score_row(file_basename, scores):
+    return [
+        file_basename,
+        "{:.6f}".format(scores[0]),
+        "{:.6f}".format(scores[1]),
+        "good" if is_meteor(scores) else "removed",
+    ]
+
+
+# Add the scores to the report, so that the threshold can be tuned later
+# without running the model again. The rows of the same file names (from
+# the previous runs) are replaced.
+def update_score_report(report_file, score_list):
+    if len(score_list) == 0:
+        return
+
+    score_dict = {}
+    if os.path.exists(report_file):
+        with open(report_file, "r", newline="", encoding="utf-8") as f:
+            for row in list(csv.reader(f))[1:]:
+                score_dict[row[0]] = row
+
+    for row in score_list:
+        score_dict[row[0]] = row
+
+    with open(report_file, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["file", "others", "star", "result"])
+        for filename in sorted(score_dict):
+            writer.writerow(score_dict[filename])
+
+
+_crop_classifier = None
+
+
+# Start streaming the crops of the detection to the classifier.
+# Only works for the detection threads in this process.
+def start_crop_classifier(keep_folder, removed_folder, unclassified_folder):
+    global _crop_classifier
+
+    _crop_classifier = CropClassifier(
+        keep_folder,
+        removed_folder,
+        unclassified_folder,
+        batch_size=settings.CNN_BATCH_SIZE,
+        max_queue_size=settings.CNN_STREAM_QUEUE_SIZE,
+    )
+    return _crop_classifier
+
+
+# None if the crops are not streamed, to be written to '02_cropped'
+def get_crop_classifier():
+    return _crop_classifier
+
+
+# Wait until all the crops are classified. The files may still be being
+# written by the output writer after this.
+def stop_crop_classifier():
+    global _crop_classifier
+
+    crop_classifier = _crop_classifier
+    _crop_classifier = None
+    if crop_classifier is not None:
+        crop_classifier.close()
+        print(crop_classifier.get_stats_string())
@@ -1,18 +1,36 @@
 # -*- coding: utf-8 -*-
-import copy
 import math
 import multiprocessing
 import os
 import shutil
 import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import cv2
 import numpy as np
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
 
-import model
 import settings
-from utils import filter_images, load_image, SUPPORTED_RAW
+from frame_store import load_frame
+from frame_prefetcher import FramePrefetcher
+from frame_ring import FrameRing, get_frame_load_order
+from detection_cache import DetectionCache, DETECTION_CACHE_DIR_NAME
+from crop_classifier import (
+    SCORE_REPORT_NAME,
+    get_crop_classifier,
+    get_crop_dataset,
+    get_crop_file_list,
+    get_score_row,
+    is_meteor,
+    start_crop_classifier,
+    stop_crop_classifier,
+    update_score_report,
+)
+import memory_budget
+import model_host
+import output_writer
+from line_index import LineIndex
+from utils import filter_images, SUPPORTED_RAW
 
 
 class HoughBundler:
@@ -139,6 +157,147 @@ class HoughBundler:
         # [[x,y],[x,y]]
         return [points[0], points[-1]]
 
+    def get_orientations(self, lines):
+        """Same as get_orientation(), for an (N, 4) array of lines"""
+        # Keep using math.atan2() to have exactly the same values.
+        # This is only O(N)
+        return np.array([self.get_orientation(line) for line in lines.tolist()])
+
+    def get_distance_matrix(self, points_x, points_y, lines):
+        """Same as DistancePointLine(), for each point to each line
+        points_x, points_y -- (M, 1) arrays
+        lines -- (N, 4) float array
+        return (M, N) array
+        """
+        x1 = lines[:, 0]
+        y1 = lines[:, 1]
+        x2 = lines[:, 2]
+        y2 = lines[:, 3]
+
+        line_mag = np.sqrt((x2 - x1) * (x2 - x1) + (y2 - y1) * (y2 - y1))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            u1 = ((points_x - x1) * (x2 - x1)) + ((points_y - y1) * (y2 - y1))
+            u = u1 / (line_mag * line_mag)
+
+            # Closest point does not fall within the line segment, take the
+            # shorter distance to an endpoint
+            dist_1 = np.sqrt(
+                (points_x - x1) * (points_x - x1) + (points_y - y1) * (points_y - y1)
+            )
+            dist_2 = np.sqrt(
+                (points_x - x2) * (points_x - x2) + (points_y - y2) * (points_y - y2)
+            )
+            dist_end = np.minimum(dist_1, dist_2)
+
+            # Intersecting point is on the line
+            ix = x1 + u * (x2 - x1)
+            iy = y1 + u * (y2 - y1)
+            dist_on_line = np.sqrt(
+                (ix - points_x) * (ix - points_x) + (iy - points_y) * (iy - points_y)
+            )
+
+        dist = np.where((u < 0.00001) | (u > 1), dist_end, dist_on_line)
+        dist[:, line_mag < 0.00000001] = 9999
+        return dist
+
+    def merge_lines_pipeline_2_vectorized(self, lines):
+        """Same grouping as merge_lines_pipeline_2(), with the distances and
+        orientations calculated for all the lines at once
+        lines -- (N, 4) array, sorted
+        return groups of the line indexes
+        """
+        min_distance_to_merge = 30
+        min_angle_to_merge = 30
+
+        num_of_lines = len(lines)
+        lines_float = lines.astype(np.float64)
+        orientations = self.get_orientations(lines)
+
+        # In merge_lines_pipeline_2() a new line joins the first group that
+        # has any line close to it. Since every previous line is in one
+        # group, it is the smallest group id of all the close previous lines
+        group_ids = np.zeros(num_of_lines, dtype=np.int64)
+        groups = []
+
+        # Calculate the matrix by blocks, to limit the memory usage
+        block_size = max(1, 2000000 // num_of_lines)
+        for block_start in range(0, num_of_lines, block_size):
+            block_end = min(block_start + block_size, num_of_lines)
+            block = lines_float[block_start:block_end]
+
+            # Distance between a new line (rows) and each old line (columns),
+            # same as get_distance()
+            distance = np.minimum.reduce([
+                self.get_distance_matrix(
+                    block[:, 0:1], block[:, 1:2], lines_float[:block_end]
+                ),
+                self.get_distance_matrix(
+                    block[:, 2:3], block[:, 3:4], lines_float[:block_end]
+                ),
+                self.get_distance_matrix(
+                    lines_float[:block_end, 0:1],
+                    lines_float[:block_end, 1:2],
+                    block,
+                ).T,
+                self.get_distance_matrix(
+                    lines_float[:block_end, 2:3],
+                    lines_float[:block_end, 3:4],
+                    block,
+                ).T,
+            ])
+            similar = (distance < min_distance_to_merge) & (
+                np.abs(
+                    orientations[block_start:block_end, np.newaxis]
+                    - orientations[np.newaxis, :block_end]
+                )
+                < min_angle_to_merge
+            )
+
+            for k in range(block_start, block_end):
+                similar_lines = np.flatnonzero(similar[k - block_start, :k])
+
+                if len(similar_lines) > 0:
+                    group_id = group_ids[similar_lines].min()
+                    groups[group_id].append(k)
+                else:
+                    group_id = len(groups)
+                    groups.append([k])
+
+                group_ids[k] = group_id
+
+        return groups
+
+    def process_lines_vectorized(self, lines):
+        """Same as process_lines(), with merge_lines_pipeline_2_vectorized()"""
+        lines = np.asarray(lines).reshape(-1, 4)
+        if len(lines) == 0:
+            return []
+
+        orientations = self.get_orientations(lines)
+        is_vertical = (orientations > 45) & (orientations < 135)
+
+        merged_lines_all = []
+
+        # Same as sorted() in process_lines(). The sorting needs to be stable
+        for line_indexes, sort_by in [
+            (np.flatnonzero(~is_vertical), 0),
+            (np.flatnonzero(is_vertical), 1),
+        ]:
+            if len(line_indexes) > 0:
+                line_indexes = line_indexes[
+                    np.argsort(lines[line_indexes, sort_by], kind="stable")
+                ]
+                sorted_lines = lines[line_indexes]
+
+                groups = self.merge_lines_pipeline_2_vectorized(sorted_lines)
+                for group in groups:
+                    merged_lines_all.append(
+                        self.merge_lines_segments1([sorted_lines[k] for k in group])
+                    )
+
+        return merged_lines_all
+
     # def process_lines(self, lines, img):
     def process_lines(self, lines):
         """Main function for lines from cv.HoughLinesP() output merging
@@ -146,6 +305,9 @@ class HoughBundler:
         lines -- cv.HoughLinesP() output
         img -- binary image
         """
+        if settings.DETECTION_HOUGH_BUNDLER_VECTORIZED:
+            return self.process_lines_vectorized(lines)
+
         lines_x = []
         lines_y = []
         # for every line of cv2.HoughLinesP()
@@ -174,6 +336,71 @@ class HoughBundler:
         return merged_lines_all
 
 
+# The # of decoded frames kept by one detection worker: previous, current
+# and next. They are shared by reference (see FrameRing)
+DETECTION_FRAME_RING_SIZE = 3
+
+# The # of full size frames held by one detection worker at the same time:
+# the frames in the ring, plus the difference, blurred and edges images.
+# Used to size the workers by the memory.
+DETECTION_FRAMES_PER_WORKER = DETECTION_FRAME_RING_SIZE + 3
+
+# The memory used by a new process itself (Python, OpenCV, TensorFlow ...)
+PROCESS_MEMORY_OVERHEAD = 512 * 1024 * 1024
+
+_tile_executor = None
+_tile_executor_size = 0
+_tile_executor_lock = threading.Lock()
+
+# The # of frames detected at the same time (by the detection threads or
+# processes). The tile workers only use the cores left by them.
+_num_of_detection_workers = 1
+
+
+# The worker threads are not copied to a forked process (the process
+# detection backend), so a new pool is created there when needed.
+def _reset_tile_executor_after_fork():
+    global _tile_executor, _tile_executor_lock
+
+    _tile_executor = None
+    _tile_executor_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_tile_executor_after_fork)
+
+
+def set_num_of_detection_workers(num_of_workers):
+    global _num_of_detection_workers
+
+    _num_of_detection_workers = max(num_of_workers, 1)
+
+
+# The # of threads for the tiles of one frame: up to DETECTION_TILE_WORKERS,
+# with the cores not used by the other detection workers. 1 means there is
+# no free core, and the frame is better detected as a whole.
+def get_num_of_tile_workers():
+    free_cores = multiprocessing.cpu_count() // _num_of_detection_workers
+    return max(min(settings.DETECTION_TILE_WORKERS, free_cores), 1)
+
+
+# The worker pool for the tile detection. Shared by all the detection
+# threads, and created again if the # of workers needed is changed
+def get_tile_executor(num_of_workers):
+    global _tile_executor, _tile_executor_size
+
+    with _tile_executor_lock:
+        if _tile_executor is None or _tile_executor_size != num_of_workers:
+            if _tile_executor is not None:
+                # The tiles already submitted are still done
+                _tile_executor.shutdown(wait=False)
+            _tile_executor = ThreadPoolExecutor(
+                max_workers=num_of_workers, thread_name_prefix="Tile"
+            )
+            _tile_executor_size = num_of_workers
+        return _tile_executor
+
+
 class MeteorDetector:
     def __init__(self, thread_name="Single thread"):
         # In order to detect satellites (or planes), we need to compare
@@ -217,11 +444,66 @@ class MeteorDetector:
         # - The opened Next_img can be stored, then when processing the next image,
         #   the Next_img can become the Current_img
         # - This can reduce the disk I/O
-        self.Next_Image_Filename = ""
-        self.Next_Image_to_be_Current_Image = []
+        #
+        # The opened frames are kept in a small ring (previous, current and
+        # next), and handed over by reference instead of being copied
+        self.Frame_Ring = FrameRing(DETECTION_FRAME_RING_SIZE)
 
         self.Thread_Name = thread_name
 
+        # Decodes the frames in background when processing a folder.
+        # None means the frames are loaded synchronously
+        self.Frame_Prefetcher = None
+
+        # The detection results saved from the previous runs.
+        # None means no cache is used
+        self.Detection_Cache = None
+
+        # The lines detected by all the runs of the dynamic scheduling,
+        # keyed by "image|image for subtraction". None if not used
+        self.Shared_Detection_Lines = None
+
+        # Pre-screen statistics, reported at the end of the detection
+        # Each item of the lists is (filename, score)
+        self.Prescreen_Num_Of_Frames = 0
+        self.Prescreen_Skipped_Frames = []
+        self.Prescreen_Borderline_Frames = []
+        self.Prescreen_Missed_Frames = []
+
+    # The memory needed to process the frame, for the admission control.
+    # None means the same as the first frame of the folder
+    def __get_frame_memory_bytes(self, file_dir, image_file):
+        if memory_budget.get_memory_budget() is None:
+            return None
+
+        frame_bytes = memory_budget.get_frame_bytes(
+            os.path.join(file_dir, image_file), decode_if_needed=False
+        )
+        if frame_bytes is None:
+            return None
+        return frame_bytes * (
+            DETECTION_FRAMES_PER_WORKER + settings.DETECTION_PREFETCH_DEPTH
+        )
+
+    # Returns the frame from the ring if it was opened already.
+    # Otherwise the frame is loaded and put to the ring.
+    def __get_frame_from_ring(self, file_dir, filename):
+        frame = self.Frame_Ring.get(filename)
+        if frame is None:
+            # orig_img = cv2.imread(filename_w_path)
+
+            # Change to this method as a work-around for the issue
+            # in OpenCV PY supporting Chinese path/file name
+            # cv2.IMREAD_UNCHANGED == -1
+            frame = self.__load_frame(os.path.join(file_dir, filename))
+            self.Frame_Ring.put(filename, frame)
+        return frame
+
+    def __load_frame(self, filename_w_path):
+        if self.Frame_Prefetcher is not None:
+            return self.Frame_Prefetcher.get(filename_w_path)
+        return load_frame(filename_w_path)
+
     # When two lines have the similar angel, get the two closest points
     # This is for next step to determine if these two lines are in the
     # same line
@@ -584,6 +866,15 @@ class MeteorDetector:
 
         merged_detection = []
 
+        line_index = None
+        if settings.DETECTION_USE_LINE_SPATIAL_INDEX:
+            line_index = LineIndex(
+                filtered_false_detection,
+                settings.LINE_DISTANCE_FOR_MERGE_THRESHOLD,
+                settings.LINE_ANGEL_DELTA_THRESHOLD,
+                include_overlap=True,
+            )
+
         # for i in range(len(filtered_false_detection)-1):
         for i in range(len(filtered_false_detection)):
             angle_1 = filtered_false_detection[i][6]
@@ -593,7 +884,10 @@ class MeteorDetector:
                 # Skip this line
                 continue
 
-            for j in range(i + 1, len(filtered_false_detection)):
+            # for j in range(i + 1, len(filtered_false_detection)):
+            for j in self.__get_lines_to_compare_for_merge(
+                filtered_false_detection, i, line_index
+            ):
                 angle_2 = filtered_false_detection[j][6]
 
                 if angle_2 == -3.14:
@@ -668,6 +962,32 @@ class MeteorDetector:
             ])
         return merged_detection
 
+    # The lines after line i to be compared with line i, in the order of
+    # the index.
+    #
+    # Without the line index, it is simply all the lines after line i.
+    # With the index, only those close enough (and with similar angle) are
+    # returned. Line i could be changed (merged with another line) during
+    # the loop. In this case the candidates are searched again with the
+    # updated line i.
+    def __get_lines_to_compare_for_merge(self, lines, i, line_index):
+        if line_index is None:
+            yield from range(i + 1, len(lines))
+            return
+
+        last_j = i
+        while True:
+            line_i = list(lines[i][0:4])
+            for j in line_index.get_candidates(*line_i, min_index=last_j + 1):
+                yield j
+                last_j = j
+
+                if list(lines[i][0:4]) != line_i:
+                    # Line i was merged with line j
+                    break
+            else:
+                return
+
     # Get the two points coordinators for a square that can hold
     # the detected meteor image
     def get_box_coordinate_from_detected_line(
@@ -770,6 +1090,9 @@ class MeteorDetector:
             # it is to be removed
             box_list.append([box_x1, box_y1, box_x2, box_y2, x_c, y_c, True])
 
+        if settings.DETECTION_BOX_MERGE_METHOD == "union_find":
+            return self.__merge_boxes_by_union_find(box_list, img_width, img_height)
+
         combined_box_list = []
 
         for i in range(len(box_list)):
@@ -875,27 +1198,164 @@ class MeteorDetector:
 
         return combined_box_list
 
-    def detect_meteor_from_image(
-        self, detection_img, original_img, equatorial_mount=False
-    ):
-        # To ensure we have an odd value for he kernel size
-        if equatorial_mount:
-            blur_kernel_size = (
-                settings.DETECTION_BLUR_KERNEL_SIZE_FOR_EQUATORIAL_MOUNTED_IMAGES
-            )
-        else:
-            # Images taken on fixed tripod. Even if star-align performed,
-            # stars at the edges are still distorted, and can cause many
-            # false detection.
-            # So in this case he BLUR kernel size needs to be larger
-            blur_kernel_size = (
-                settings.DETECTION_BLUR_KERNEL_SIZE_FOR_FIXED_TRIPOD_IMAGES
-            )
+    # Merge the overlapped boxes, until no more boxes can be merged.
+    #
+    # The forward pass in get_combined_box_list_from_detected_lines() only
+    # compares box i with the boxes after it. Boxes that become overlapped
+    # after being enlarged by merging are never compared again. So one long
+    # meteor could become several overlapped crops.
+    #
+    # Here in each round, the overlapped boxes (same checking as before)
+    # are found with a grid of the box centers, and merged with union-find.
+    # Then the merged boxes are compared again in the next round.
+    #
+    # To avoid the landscape and meteor objects being merged to a huge
+    # image, two boxes are not merged if the merged box would be bigger
+    # than BOX_MERGE_MAX_SIZE_RATIO of the image (shorter side).
+    def __merge_boxes_by_union_find(self, box_list, img_width, img_height):
+        max_merged_size = settings.BOX_MERGE_MAX_SIZE_RATIO * min(
+            img_width, img_height
+        )
+        threshold = settings.BOX_OVERLAP_THRESHOLD
 
-        count = blur_kernel_size % 2
-        if count == 0:
-            blur_kernel_size += 1
+        # Each box: [x1, y1, x2, y2, x_c, y_c]
+        # The line center is taken from the first box of the merged ones
+        boxes = [box[0:6] for box in box_list]
+
+        while len(boxes) > 1:
+            num_of_boxes = len(boxes)
+            parents = list(range(num_of_boxes))
+
+            # The bounding area of all the boxes in the group, kept in the root
+            group_areas = [box[0:4] for box in boxes]
+
+            def find(i):
+                while parents[i] != i:
+                    parents[i] = parents[parents[i]]
+                    i = parents[i]
+                return i
 
+            widths = [abs(box[2] - box[0]) for box in boxes]
+            centers = [
+                (int((box[0] + box[2]) / 2), int((box[1] + box[3]) / 2))
+                for box in boxes
+            ]
+            max_width = max(widths)
+
+            cell_size = max(1, int(settings.DETECTION_CROP_IMAGE_BOX_SIZE * threshold))
+            grid = {}
+            for i, (x_mid, y_mid) in enumerate(centers):
+                grid.setdefault((x_mid // cell_size, y_mid // cell_size), []).append(i)
+
+            merged_in_this_round = False
+            for i in range(num_of_boxes):
+                i_x_mid, i_y_mid = centers[i]
+
+                # The centers of the boxes that could be overlapped with box i
+                # are within this distance
+                search_dist = (widths[i] + max_width) / 2 * threshold
+                candidates = []
+                for cx in range(
+                    int((i_x_mid - search_dist) // cell_size),
+                    int((i_x_mid + search_dist) // cell_size) + 1,
+                ):
+                    for cy in range(
+                        int((i_y_mid - search_dist) // cell_size),
+                        int((i_y_mid + search_dist) // cell_size) + 1,
+                    ):
+                        candidates.extend(grid.get((cx, cy), []))
+
+                for j in sorted(candidates):
+                    if j <= i:
+                        continue
+
+                    # Same checking as get_combined_box_list_from_detected_lines()
+                    center_dist_x = abs(centers[j][0] - i_x_mid)
+                    center_dist_y = abs(centers[j][1] - i_y_mid)
+                    overlap_dist = (widths[i] + widths[j]) / 2 * threshold
+                    if center_dist_x >= overlap_dist or center_dist_y >= overlap_dist:
+                        continue
+
+                    root_i = find(i)
+                    root_j = find(j)
+                    if root_i == root_j:
+                        continue
+
+                    area_i = group_areas[root_i]
+                    area_j = group_areas[root_j]
+                    merged_area = [
+                        min(area_i[0], area_j[0]),
+                        min(area_i[1], area_j[1]),
+                        max(area_i[2], area_j[2]),
+                        max(area_i[3], area_j[3]),
+                    ]
+                    # A box could be already bigger than the limit (from a
+                    # long line). It can still take the boxes inside it.
+                    size_limit = max(
+                        max_merged_size,
+                        area_i[2] - area_i[0],
+                        area_i[3] - area_i[1],
+                        area_j[2] - area_j[0],
+                        area_j[3] - area_j[1],
+                    )
+                    if (
+                        max(
+                            merged_area[2] - merged_area[0],
+                            merged_area[3] - merged_area[1],
+                        )
+                        > size_limit
+                    ):
+                        # Too big, don't merge
+                        continue
+
+                    # Keep the smaller index as the root, so that the merged
+                    # box takes the line center of the first box
+                    root_i, root_j = min(root_i, root_j), max(root_i, root_j)
+                    parents[root_j] = root_i
+                    group_areas[root_i] = merged_area
+                    merged_in_this_round = True
+
+            if not merged_in_this_round:
+                break
+
+            merged_boxes = []
+            for i in range(num_of_boxes):
+                if find(i) != i:
+                    continue
+
+                if group_areas[i] == boxes[i][0:4]:
+                    # Not merged with others
+                    merged_boxes.append(boxes[i])
+                    continue
+
+                # Make it as a square, not a rectangle
+                # Parameter (factor = 1) means no extra extension
+                merged_x1, merged_y1, merged_x2, merged_y2 = (
+                    self.get_box_coordinate_from_detected_line(
+                        group_areas[i][0],
+                        group_areas[i][1],
+                        group_areas[i][2],
+                        group_areas[i][3],
+                        img_width,
+                        img_height,
+                        factor=1,
+                    )
+                )
+                merged_boxes.append([
+                    merged_x1,
+                    merged_y1,
+                    merged_x2,
+                    merged_y2,
+                    boxes[i][4],
+                    boxes[i][5],
+                ])
+
+            boxes = merged_boxes
+
+        return boxes
+
+    # Blur -> Canny
+    def __detect_edges(self, detection_img, blur_kernel_size):
         blur_img = cv2.GaussianBlur(
             detection_img, (blur_kernel_size, blur_kernel_size), 0
         )
@@ -934,18 +1394,285 @@ class MeteorDetector:
             apertureSize=canny_kernel_size,
         )
 
-        line_threshold = settings.DETECTION_LINE_THRESHOLD
-        minLineLength = settings.DETECTION_LINE_MIN_LINE_LENGTH
-        maxLineGap = settings.DETECTION_LINE_MAX_LINE_GAP
+        return detected_edges
 
+    # Returns the HoughLinesP() output, or None if no line detected
+    def __get_lines_from_edges(
+        self, detected_edges, line_threshold, min_line_length, max_line_gap
+    ):
         lines = cv2.HoughLinesP(
             image=detected_edges,
             rho=1,
             theta=np.pi / 180,
             threshold=line_threshold,
-            minLineLength=minLineLength,
-            maxLineGap=maxLineGap,
+            minLineLength=min_line_length,
+            maxLineGap=max_line_gap,
+        )
+
+        return lines
+
+    # Blur -> Canny -> HoughLinesP
+    # Returns the HoughLinesP() output, or None if no line detected
+    def __detect_raw_lines(
+        self,
+        detection_img,
+        blur_kernel_size,
+        line_threshold,
+        min_line_length,
+        max_line_gap,
+    ):
+        detected_edges = self.__detect_edges(detection_img, blur_kernel_size)
+        return self.__get_lines_from_edges(
+            detected_edges, line_threshold, min_line_length, max_line_gap
+        )
+
+    # Split a big image to overlapped tiles, and do the blur and the Sobel
+    # gradients (the first part of Canny) of the tiles in parallel (OpenCV
+    # releases the GIL). These take most of the edge detection time.
+    #
+    # Each tile is extended with DETECTION_TILE_OVERLAP pixels on each side,
+    # and only the center part is put back to the full gradient images, so
+    # the gradients are the same as from the whole image. The hysteresis of
+    # Canny (a weak edge is kept if it connects to a strong one, which can
+    # be anywhere in the image) is then done once with the full gradients.
+    # So the edges are the same as detected from the whole image.
+    def __detect_edges_by_tiles(
+        self, detection_img, blur_kernel_size, num_of_workers
+    ):
+        height, width = detection_img.shape[0:2]
+        tile_size = settings.DETECTION_TILE_SIZE
+        canny_kernel_size = settings.DETECTION_CANNY_KERNEL_SIZE
+
+        # Enough for the blur and the Sobel kernels
+        overlap = max(
+            settings.DETECTION_TILE_OVERLAP,
+            blur_kernel_size // 2 + canny_kernel_size // 2,
+        )
+
+        # The same # of channels as the image (normally BGR)
+        dx = np.empty(detection_img.shape, dtype=np.int16)
+        dy = np.empty(detection_img.shape, dtype=np.int16)
+
+        tile_list = []
+        for y in range(0, height, tile_size):
+            for x in range(0, width, tile_size):
+                tile_list.append(
+                    [x, y, min(x + tile_size, width), min(y + tile_size, height)]
+                )
+
+        def detect_tile(tile):
+            x1, y1, x2, y2 = tile
+            ext_x1 = max(x1 - overlap, 0)
+            ext_y1 = max(y1 - overlap, 0)
+            ext_x2 = min(x2 + overlap, width)
+            ext_y2 = min(y2 + overlap, height)
+
+            blur_img = cv2.GaussianBlur(
+                detection_img[ext_y1:ext_y2, ext_x1:ext_x2],
+                (blur_kernel_size, blur_kernel_size),
+                0,
+            ).astype(np.uint8)
+
+            # The same as Canny() does with the image
+            center = (
+                slice(y1 - ext_y1, y2 - ext_y1),
+                slice(x1 - ext_x1, x2 - ext_x1),
+            )
+            dx[y1:y2, x1:x2] = cv2.Sobel(
+                blur_img,
+                cv2.CV_16S,
+                1,
+                0,
+                ksize=canny_kernel_size,
+                borderType=cv2.BORDER_REPLICATE,
+            )[center]
+            dy[y1:y2, x1:x2] = cv2.Sobel(
+                blur_img,
+                cv2.CV_16S,
+                0,
+                1,
+                ksize=canny_kernel_size,
+                borderType=cv2.BORDER_REPLICATE,
+            )[center]
+
+        # Go through the results, to get the exceptions raised (if any)
+        for _ in get_tile_executor(num_of_workers).map(detect_tile, tile_list):
+            pass
+
+        canny_lowThreshold = settings.DETECTION_CANNY_LOW_THRESHOLD
+        canny_ratio = settings.DETECTION_CANNY_RATIO
+        return cv2.Canny(dx, dy, canny_lowThreshold, canny_lowThreshold * canny_ratio)
+
+    # Coarse-to-fine detection:
+    # 1) Downsample the difference image (by 2^pyramid_level) and detect the
+    #    lines on it, with the line parameters scaled accordingly
+    # 2) Take the areas around the lines found as the candidate regions
+    # 3) Detect the lines again only in these regions, with the full
+    #    resolution image, and map the lines back to the full image position
+    #
+    # Much faster for big images, since most of the image doesn't have any
+    # line. But some faint meteors could be missed in the downsampled image.
+    # Use compare_coarse_to_fine.py to check the recall.
+    def __detect_raw_lines_coarse_to_fine(
+        self, detection_img, blur_kernel_size, pyramid_level
+    ):
+        scale = 2**pyramid_level
+
+        coarse_img = detection_img
+        for _ in range(pyramid_level):
+            coarse_img = cv2.pyrDown(coarse_img)
+
+        # The downsampling has already blurred the image
+        coarse_blur_kernel_size = max(1, blur_kernel_size // scale)
+        if coarse_blur_kernel_size % 2 == 0:
+            coarse_blur_kernel_size += 1
+
+        coarse_lines = self.__detect_raw_lines(
+            coarse_img,
+            coarse_blur_kernel_size,
+            max(1, int(settings.DETECTION_LINE_THRESHOLD / scale)),
+            max(1, int(settings.DETECTION_LINE_MIN_LINE_LENGTH / scale)),
+            max(1, int(settings.DETECTION_LINE_MAX_LINE_GAP / scale)),
         )
+        if coarse_lines is None:
+            return None
+
+        height, width = detection_img.shape[0:2]
+        margin = settings.DETECTION_PYRAMID_ROI_MARGIN + scale
+
+        roi_list = []
+        for line in coarse_lines:
+            x1, y1, x2, y2 = [int(v) * scale for v in line[0]]
+            roi_list.append([
+                max(min(x1, x2) - margin, 0),
+                max(min(y1, y2) - margin, 0),
+                min(max(x1, x2) + margin, width),
+                min(max(y1, y2) + margin, height),
+            ])
+
+        # Combine the overlapped regions, so that the same line would not
+        # be detected twice
+        roi_list = self.__merge_overlapped_regions(roi_list)
+
+        lines_list = []
+        for roi_x1, roi_y1, roi_x2, roi_y2 in roi_list:
+            roi_lines = self.__detect_raw_lines(
+                detection_img[roi_y1:roi_y2, roi_x1:roi_x2],
+                blur_kernel_size,
+                settings.DETECTION_LINE_THRESHOLD,
+                settings.DETECTION_LINE_MIN_LINE_LENGTH,
+                settings.DETECTION_LINE_MAX_LINE_GAP,
+            )
+            if roi_lines is not None:
+                roi_offset = np.array([roi_x1, roi_y1, roi_x1, roi_y1], dtype=np.int32)
+                lines_list.append(roi_lines + roi_offset)
+
+        if len(lines_list) == 0:
+            return None
+
+        return np.concatenate(lines_list)
+
+    # Merge the overlapped regions ([x1, y1, x2, y2]), until no more regions
+    # can be merged (a merged region could overlap another one).
+    #
+    # In each round, the overlapped regions are found by a sweep of the
+    # regions sorted by x1: only the regions not ended (x2) before the start
+    # (x1) of a region can overlap it. They are merged with union-find. The
+    # merged regions are in the order of their first region.
+    def __merge_overlapped_regions(self, roi_list):
+        while len(roi_list) > 1:
+            num_of_regions = len(roi_list)
+            parents = list(range(num_of_regions))
+
+            def find(i):
+                while parents[i] != i:
+                    parents[i] = parents[parents[i]]
+                    i = parents[i]
+                return i
+
+            merged_in_this_round = False
+            active_list = []
+            for i in sorted(range(num_of_regions), key=lambda i: roi_list[i][0]):
+                roi_i = roi_list[i]
+                active_list = [j for j in active_list if roi_list[j][2] > roi_i[0]]
+                for j in active_list:
+                    roi_j = roi_list[j]
+                    if (
+                        roi_j[0] < roi_i[2]
+                        and roi_i[1] < roi_j[3]
+                        and roi_j[1] < roi_i[3]
+                    ):
+                        root_i = find(i)
+                        root_j = find(j)
+                        if root_i != root_j:
+                            parents[max(root_i, root_j)] = min(root_i, root_j)
+                            merged_in_this_round = True
+                active_list.append(i)
+
+            if not merged_in_this_round:
+                break
+
+            merged_regions = {}
+            for i, roi in enumerate(roi_list):
+                root = find(i)
+                if root not in merged_regions:
+                    merged_regions[root] = list(roi)
+                else:
+                    merged_roi = merged_regions[root]
+                    merged_roi[0] = min(merged_roi[0], roi[0])
+                    merged_roi[1] = min(merged_roi[1], roi[1])
+                    merged_roi[2] = max(merged_roi[2], roi[2])
+                    merged_roi[3] = max(merged_roi[3], roi[3])
+            roi_list = [merged_regions[root] for root in sorted(merged_regions)]
+
+        return roi_list
+
+    def detect_meteor_from_image(
+        self, detection_img, original_img, equatorial_mount=False
+    ):
+        # To ensure we have an odd value for he kernel size
+        if equatorial_mount:
+            blur_kernel_size = (
+                settings.DETECTION_BLUR_KERNEL_SIZE_FOR_EQUATORIAL_MOUNTED_IMAGES
+            )
+        else:
+            # Images taken on fixed tripod. Even if star-align performed,
+            # stars at the edges are still distorted, and can cause many
+            # false detection.
+            # So in this case he BLUR kernel size needs to be larger
+            blur_kernel_size = (
+                settings.DETECTION_BLUR_KERNEL_SIZE_FOR_FIXED_TRIPOD_IMAGES
+            )
+
+        count = blur_kernel_size % 2
+        if count == 0:
+            blur_kernel_size += 1
+
+        if settings.DETECTION_PYRAMID_LEVEL > 0:
+            lines = self.__detect_raw_lines_coarse_to_fine(
+                detection_img, blur_kernel_size, settings.DETECTION_PYRAMID_LEVEL
+            )
+        elif (
+            0 < settings.DETECTION_TILE_SIZE < max(detection_img.shape[0:2])
+            and get_num_of_tile_workers() > 1
+        ):
+            detected_edges = self.__detect_edges_by_tiles(
+                detection_img, blur_kernel_size, get_num_of_tile_workers()
+            )
+            lines = self.__get_lines_from_edges(
+                detected_edges,
+                settings.DETECTION_LINE_THRESHOLD,
+                settings.DETECTION_LINE_MIN_LINE_LENGTH,
+                settings.DETECTION_LINE_MAX_LINE_GAP,
+            )
+        else:
+            lines = self.__detect_raw_lines(
+                detection_img,
+                blur_kernel_size,
+                settings.DETECTION_LINE_THRESHOLD,
+                settings.DETECTION_LINE_MIN_LINE_LENGTH,
+                settings.DETECTION_LINE_MAX_LINE_GAP,
+            )
 
         if lines is not None:
             my_HoughBundler = HoughBundler()
@@ -976,12 +1703,144 @@ class MeteorDetector:
         else:
             return None
 
-    def draw_detection_boxes_on_image(self, original_img, detection_lines, color):
+    # A cheap check of the difference image, to know if there could be any
+    # meteor in it, before running the whole detection.
+    #
+    # The difference image is heavily downsampled. The pixels brighter than
+    # the noise level are grouped to connected components, and the "energy"
+    # (sum of the brightness above the noise level) of each component is
+    # calculated. The score is the biggest energy of all the components.
+    # A frame with nothing new would only have some noise and star residuals,
+    # which give a low score.
+    def get_prescreen_score(self, detection_img):
+        height, width = detection_img.shape[0:2]
+        scale = settings.DETECTION_PRESCREEN_SCALE
+
+        small_img = cv2.resize(
+            detection_img,
+            (max(width // scale, 1), max(height // scale, 1)),
+            interpolation=cv2.INTER_AREA,
+        )
+        if small_img.ndim == 3:
+            small_img = small_img.max(axis=2)
+        small_img = small_img.astype(np.float32)
+
+        # Noise level estimated by the median and the median absolute
+        # deviation, so that it is not affected by the bright objects
+        median = np.median(small_img)
+        mad = np.median(np.abs(small_img - median)) * 1.4826
+        noise_level = median + settings.DETECTION_PRESCREEN_NOISE_SIGMA * max(mad, 1)
+
+        above_noise = small_img > noise_level
+        num_of_labels, labels, stats, _ = cv2.connectedComponentsWithStats(
+            above_noise.astype(np.uint8), connectivity=8
+        )
+        if num_of_labels <= 1:
+            return 0
+
+        energy = np.bincount(
+            labels.ravel(),
+            weights=np.where(above_noise, small_img - noise_level, 0).ravel(),
+            minlength=num_of_labels,
+        )
+
+        # Label 0 is the background
+        energy = energy[1:]
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        energy = energy[areas >= settings.DETECTION_PRESCREEN_MIN_AREA]
+        if len(energy) == 0:
+            return 0
+
+        return float(energy.max())
+
+    # Same as detect_meteor_from_image(), but with the pre-screen checking
+    # first. Returns (lines, pre-screen result):
+    # - lines: None if the frame is skipped
+    # - pre-screen result: {"score", "skipped", "missed"}, None if the
+    #   pre-screen is not enabled. "missed" is only known with the audit.
+    def __detect_meteor_from_image_with_prescreen(
+        self, detection_img, original_img, equatorial_mount=False
+    ):
+        if not settings.DETECTION_PRESCREEN_ENABLED:
+            detection_lines = self.detect_meteor_from_image(
+                detection_img, original_img, equatorial_mount=equatorial_mount
+            )
+            return detection_lines, None
+
+        score = self.get_prescreen_score(detection_img)
+        prescreen = {
+            "score": score,
+            "skipped": score < settings.DETECTION_PRESCREEN_MIN_ENERGY,
+            "missed": None,
+        }
+        if not prescreen["skipped"]:
+            detection_lines = self.detect_meteor_from_image(
+                detection_img, original_img, equatorial_mount=equatorial_mount
+            )
+            return detection_lines, prescreen
+
+        if settings.DETECTION_PRESCREEN_AUDIT:
+            # Still run the whole detection, just to know if anything
+            # would be missed. The result is not used.
+            detection_lines = self.detect_meteor_from_image(
+                detection_img, original_img, equatorial_mount=equatorial_mount
+            )
+            prescreen["missed"] = (
+                detection_lines is not None and len(detection_lines) > 0
+            )
+
+        return None, prescreen
+
+    # Add the pre-screen result of a frame (detected, or from the detection
+    # cache) to the statistics
+    def __add_prescreen_stats(self, filename, prescreen):
+        if prescreen is None:
+            return
+
+        self.Prescreen_Num_Of_Frames += 1
+        if not prescreen["skipped"]:
+            return
+
+        score = prescreen["score"]
+        self.Prescreen_Skipped_Frames.append((filename, score))
+        threshold = settings.DETECTION_PRESCREEN_MIN_ENERGY
+        if score >= threshold * settings.DETECTION_PRESCREEN_BORDERLINE_RATIO:
+            self.Prescreen_Borderline_Frames.append((filename, score))
+        if prescreen["missed"]:
+            self.Prescreen_Missed_Frames.append((filename, score))
+
+    # The image for drawing the detection boxes on. The frame itself is
+    # read-only and shared, so the boxes are drawn on a copy, downscaled by
+    # settings.DETECTION_ANNOTATION_SCALE to save the memory and the time.
+    def get_annotation_image(self, original_img):
+        scale = settings.DETECTION_ANNOTATION_SCALE
+        if scale >= 1:
+            return original_img.copy()
+        return cv2.resize(
+            original_img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+        )
+
+    # The image saved for the frame without any detection. Same size as
+    # the annotation images, but the full size frame is not copied.
+    def get_no_detection_image(self, original_img):
+        if settings.DETECTION_ANNOTATION_SCALE >= 1:
+            return original_img
+        return self.get_annotation_image(original_img)
+
+    # If draw_img is given (from get_annotation_image()), the boxes are drawn
+    # on it directly. Otherwise a new annotation image is made.
+    def draw_detection_boxes_on_image(
+        self, original_img, detection_lines, color, draw_img=None
+    ):
         # Get the detected lines coordinates
         # detection_lines = self.detect_meteor_from_image(original_img)
 
-        draw_img = copy.copy(original_img)
-        height, width, channels = draw_img.shape
+        if draw_img is None:
+            draw_img = self.get_annotation_image(original_img)
+
+        # The lines and boxes are in the coordinates of the full size image
+        height, width, channels = original_img.shape
+        scale = draw_img.shape[1] / width
 
         # box_list = self.get_box_list_from_meteor_lines(detection_lines, width, height)
         box_list = self.get_combined_box_list_from_detected_lines(
@@ -1007,14 +1866,16 @@ class MeteorDetector:
 
             angle = line[6]
 
+            x1, y1, x2, y2 = [int(round(v * scale)) for v in [x1, y1, x2, y2]]
+
             cv2.line(draw_img, (x1, y1), (x2, y2), (0, 0, 255), 2)
 
             cv2.putText(
                 draw_img,
                 "{0:.3f}".format(angle * 180 / np.pi),
-                (x2 + 10, y2 + 10),
+                (x2 + int(10 * scale), y2 + int(10 * scale)),
                 cv2.FONT_HERSHEY_SIMPLEX,
-                fontScale=3,
+                fontScale=3 * scale,
                 color=(255, 255, 255),
                 lineType=2,
             )
@@ -1029,6 +1890,9 @@ class MeteorDetector:
             box_y1 = box[1]
             box_x2 = box[2]
             box_y2 = box[3]
+            box_x1, box_y1, box_x2, box_y2 = [
+                int(round(v * scale)) for v in [box_x1, box_y1, box_x2, box_y2]
+            ]
             # cv2.rectangle(draw_img, (box_x1, box_y1), (box_x2, box_y2), (255, 255, 0), 1)
             cv2.rectangle(draw_img, (box_x1, box_y1), (box_x2, box_y2), color, 1)
 
@@ -1061,6 +1925,8 @@ class MeteorDetector:
         # filename_no_ext = os.path.splitext(orig_filename)[0]
         filename_no_ext, file_ext = os.path.splitext(orig_filename)
 
+        crop_classifier = get_crop_classifier()
+
         for box in box_list:
             # for draw_x1, draw_y1, draw_x2, draw_y2 in box:
             box_x1 = box[0]
@@ -1101,8 +1967,14 @@ class MeteorDetector:
 
             # cv2.imwrite(file_to_save, crop_img)
 
+            # Streaming to the CNN filter. The crop is written by the
+            # classifier, to the 'good' or 'removed' folder
+            if crop_classifier is not None:
+                crop_classifier.put(file_ext, crop_img, os.path.basename(file_to_save))
+                continue
+
             # To solve the Chinese character support issue in OpenCV PY
-            cv2.imencode(file_ext, crop_img)[1].tofile(file_to_save)
+            output_writer.write_image(file_ext, crop_img, file_to_save)
         # End of function
 
     # Logic:
@@ -1113,6 +1985,15 @@ class MeteorDetector:
     #    have the similar angle, then consider these two are from the
     #    same satellite object
     def check_satellite_with_previous_detection_list(self, verbose):
+        line_index = None
+        if settings.DETECTION_USE_LINE_SPATIAL_INDEX:
+            line_index = LineIndex(
+                self.Current_Image_Detection_Lines,
+                settings.LINE_DISTANCE_FOR_SATELLITE_THRESHOLD,
+                settings.LINE_ANGEL_DELTA_THRESHOLD,
+                include_overlap=False,
+            )
+
         for previous_line in self.Previous_Image_Detection_Lines:
             p_x1 = previous_line[0]
             p_y1 = previous_line[1]
@@ -1122,7 +2003,16 @@ class MeteorDetector:
             p_y_mid = previous_line[5]
             p_angle = previous_line[6]
 
-            for current_line in self.Current_Image_Detection_Lines:
+            if line_index is None:
+                current_lines = self.Current_Image_Detection_Lines
+            else:
+                # Only those close enough (and with similar angle)
+                current_lines = [
+                    self.Current_Image_Detection_Lines[j]
+                    for j in line_index.get_candidates(p_x1, p_y1, p_x2, p_y2)
+                ]
+
+            for current_line in current_lines:
                 c_x1 = current_line[0]
                 c_y1 = current_line[1]
                 c_x2 = current_line[2]
@@ -1185,6 +2075,7 @@ class MeteorDetector:
         file_for_subtraction,
         equatorial_mount=False,
         verbose=1,
+        extract_previous_image=True,
     ):
         """
         # Directory to save the image drawn with detection boxes
@@ -1203,54 +2094,82 @@ class MeteorDetector:
         # - The opened Next_img can be stored, then when processing the next image,
         #   the Next_img can become the Current_img
         # - This can reduce the disk I/O
-        if self.Next_Image_Filename != orig_filename:
-            # This image was not opened yet
-
-            filename_w_path = os.path.join(file_dir, orig_filename)
-            # orig_img = cv2.imread(filename_w_path)
-
-            # Change to this method as a work-around for the issue
-            # in OpenCV PY supporting Chinese path/file name
-            # cv2.IMREAD_UNCHANGED == -1
-            orig_img = load_image(filename_w_path)
-        else:
-            # We had opened this image when processing the previous image
-            # Just reuse it
-            orig_img = copy.copy(self.Next_Image_to_be_Current_Image)
+        # - The frames in the ring are read-only and shared by reference.
+        #   The "next image" of this step is the "current image" of the next
+        #   step, and then the "previous image" to be extracted
+        filename_w_path = os.path.join(file_dir, orig_filename)
+        orig_img = self.__get_frame_from_ring(file_dir, orig_filename)
 
         # Do a subtraction with another image, which has been star-aligned
         file_for_subtraction_w_path = os.path.join(file_dir, file_for_subtraction)
-        # img_for_subtraction = cv2.imread(file_for_subtraction_w_path)
-        img_for_subtraction = load_image(file_for_subtraction_w_path)
+        img_for_subtraction = self.__get_frame_from_ring(
+            file_dir, file_for_subtraction
+        )
 
-        # Store the "next image"
-        # It will be used as the "current image" when we process
-        # the next one
-        self.Next_Image_Filename = file_for_subtraction
-        self.Next_Image_to_be_Current_Image = copy.copy(img_for_subtraction)
+        # Use the lines detected in the previous run if the two images
+        # and the settings are not changed
+        detection_lines = None
+
+        # The lines could have been detected by another run already
+        # (the dynamic scheduling)
+        shared_key = None
+        if self.Shared_Detection_Lines is not None:
+            shared_key = orig_filename + "|" + file_for_subtraction
+            detection_lines = self.Shared_Detection_Lines.get(shared_key)
+
+        cache_key = None
+        if detection_lines is None and self.Detection_Cache is not None:
+            cache_key = self.Detection_Cache.get_key(
+                filename_w_path, file_for_subtraction_w_path, equatorial_mount
+            )
+            cached = self.Detection_Cache.load(cache_key)
+            if cached is not None:
+                detection_lines, prescreen = cached
+                self.__add_prescreen_stats(orig_filename, prescreen)
+
+        if detection_lines is None:
+            img = cv2.subtract(orig_img, img_for_subtraction)
+
+            # If the frame is skipped by the pre-screen, it is taken as no line
+            # detected. Still go through the steps below, so that the previous
+            # image is processed, and this image is kept for the next one.
+            detection_lines, prescreen = self.__detect_meteor_from_image_with_prescreen(
+                img, orig_img, equatorial_mount=equatorial_mount
+            )
+            self.__add_prescreen_stats(orig_filename, prescreen)
+            if detection_lines is None:
+                detection_lines = []
+
+            if cache_key is not None:
+                self.Detection_Cache.save(
+                    cache_key,
+                    filename_w_path,
+                    file_for_subtraction_w_path,
+                    equatorial_mount,
+                    detection_lines,
+                    prescreen,
+                )
 
-        img = cv2.subtract(orig_img, img_for_subtraction)
+        if shared_key is not None:
+            self.Shared_Detection_Lines[shared_key] = detection_lines
 
-        detection_lines = self.detect_meteor_from_image(
-            img, orig_img, equatorial_mount=equatorial_mount
-        )
-        if detection_lines is not None:
-            self.Current_Image_Detection_Lines = detection_lines
-        else:
-            self.Current_Image_Detection_Lines = []
+        self.Current_Image_Detection_Lines = detection_lines
 
         # Check if we are the first image.
         # Only when we are not the first image we'll do the extraction
         if len(self.Previous_Image_Filename) > 0:
-            # We can now extract the detection objects from the
-            # previous image, with excluding the possible satellites
-
             # The self.Previous_Image_Detection_Lines,
             #     self.Previous_Image_Satellites,
             #     self.Current_Image_Satellites
             # will be updated
             self.check_satellite_with_previous_detection_list(verbose)
 
+        # The previous image could be the lead-in image of a run (see
+        # get_detection_runs()). It was only detected for the satellite
+        # checking of this image. Another run extracts it.
+        if len(self.Previous_Image_Filename) > 0 and extract_previous_image:
+            # We can now extract the detection objects from the
+            # previous image, with excluding the possible satellites
             filename_no_ext, file_ext = os.path.splitext(self.Previous_Image_Filename)
             if file_ext.lower().replace(".", "") in SUPPORTED_RAW:
                 file_ext = ".jpg" if file_ext[0] == "." else "jpg"
@@ -1281,9 +2200,13 @@ class MeteorDetector:
                     color=(255, 255, 0),
                 )
 
-                # Also highlight the possible satellites as well
+                # Also highlight the possible satellites as well, on the
+                # same annotation image
                 draw_img = self.draw_detection_boxes_on_image(
-                    draw_img, self.Previous_Image_Satellites, color=(0, 255, 255)
+                    self.Previous_Image,
+                    self.Previous_Image_Satellites,
+                    color=(0, 255, 255),
+                    draw_img=draw_img,
                 )
 
                 draw_filename = filename_no_ext + "_detection_{}".format(
@@ -1296,7 +2219,7 @@ class MeteorDetector:
                 draw_filename = os.path.join(draw_box_file_dir, draw_filename)
 
                 # cv2.imwrite(draw_filename, draw_img)
-                cv2.imencode(file_ext, draw_img)[1].tofile(draw_filename)
+                output_writer.write_image(file_ext, draw_img, draw_filename)
 
                 # Extract the detected portions to small image files
                 # Normally they would be 640x640 size, but can be bigger
@@ -1318,7 +2241,7 @@ class MeteorDetector:
                     self.Previous_Image_Filename,
                     verbose=0,
                 )
-            else:
+            elif settings.DETECTION_SAVE_NO_DETECTION_IMAGES:
                 # No any line detected
                 # Save an image with updated file name to indicate
                 # detection is 0
@@ -1328,13 +2251,18 @@ class MeteorDetector:
                 draw_filename = os.path.join(draw_box_file_dir, draw_filename)
 
                 # cv2.imwrite(draw_filename, self.Previous_Image)
-                cv2.imencode(file_ext, self.Previous_Image)[1].tofile(draw_filename)
+                output_writer.write_image(
+                    file_ext,
+                    self.get_no_detection_image(self.Previous_Image),
+                    draw_filename,
+                )
 
         # The previous file was handled and done
         # Update the previous data to the current
         self.Previous_Image_Detection_Lines = self.Current_Image_Detection_Lines
         self.Previous_Image_Satellites = self.Current_Image_Satellites
-        self.Previous_Image = copy.copy(orig_img)
+        # No copy needed: the frame is read-only
+        self.Previous_Image = orig_img
         self.Previous_Image_Filename = orig_filename
 
         self.Current_Image_Detection_Lines = []
@@ -1380,12 +2308,14 @@ class MeteorDetector:
 
         filename_w_path = os.path.join(file_dir, orig_filename)
         # orig_img = cv2.imread(filename_w_path)
-        orig_img = load_image(filename_w_path)
+        orig_img = self.__load_frame(filename_w_path)
+        orig_img.flags.writeable = False
 
         filename_no_ext, file_ext = os.path.splitext(orig_filename)
 
         # img = cv2.subtract(orig_img, img_for_subtraction)
-        img_for_detection = copy.copy(orig_img)
+        # The detection doesn't change the image, no copy needed
+        img_for_detection = orig_img
 
         detection_lines = self.detect_meteor_from_image(
             img_for_detection, orig_img, equatorial_mount=False
@@ -1403,7 +2333,7 @@ class MeteorDetector:
 
             draw_filename = os.path.join(draw_box_file_dir, draw_filename)
             # cv2.imwrite(draw_filename, draw_img)
-            cv2.imencode(file_ext, draw_img)[1].tofile(draw_filename)
+            output_writer.write_image(file_ext, draw_img, draw_filename)
 
             # Extract the detected portions to small image files
             # Normally they would be 640x640 size, but can be bigger
@@ -1413,7 +2343,7 @@ class MeteorDetector:
             self.extract_meteor_images_to_file(
                 orig_img, detection_lines, extracted_file_dir, orig_filename, verbose=0
             )
-        else:
+        elif settings.DETECTION_SAVE_NO_DETECTION_IMAGES:
             # No line detected
             # Save an image with updated file name to indicate
             # detection is 0
@@ -1422,7 +2352,9 @@ class MeteorDetector:
             # draw_filename = os.path.join(save_dir, draw_filename)
             draw_filename = os.path.join(draw_box_file_dir, draw_filename)
             # cv2.imwrite(draw_filename, orig_img)
-            cv2.imencode(file_ext, orig_img)[1].tofile(draw_filename)
+            output_writer.write_image(
+                file_ext, self.get_no_detection_image(orig_img), draw_filename
+            )
 
     # end of function
 
@@ -1484,6 +2416,136 @@ class MeteorDetector:
         # if not os.path.exists(extracted_file_dir):
         #     os.mkdir(extracted_file_dir)
 
+        self.__open_frame_sources(
+            save_dir, self.__get_frame_access_order(file_dir, image_list, subtraction)
+        )
+
+        try:
+            self.__detect_n_extract_meteor_from_image_list(
+                file_dir,
+                image_list,
+                draw_box_file_dir,
+                extracted_file_dir,
+                subtraction,
+                equatorial_mount,
+                verbose,
+            )
+        finally:
+            self.__close_frame_sources(verbose)
+
+    # end of function
+
+    # Process one run made by get_detection_runs(): a few adjacent images,
+    # plus the lead-in / lead-out images for the satellite checking.
+    # Used by the dynamic scheduling of the detection.
+    def detect_n_extract_meteor_from_run(
+        self, file_dir, save_dir, run, equatorial_mount=False, verbose=1
+    ):
+        draw_box_file_dir = os.path.join(save_dir, "01_detection")
+        extracted_file_dir = os.path.join(save_dir, "02_cropped", "un-classified")
+
+        # Same as __get_frame_access_order(), the frames still in the frame
+        # ring are not loaded again
+        access_list = get_frame_load_order(
+            [(step[0], step[1]) for step in run], DETECTION_FRAME_RING_SIZE
+        )
+
+        self.__open_frame_sources(
+            save_dir,
+            [os.path.join(file_dir, image_file) for image_file in access_list],
+        )
+
+        try:
+            for image_file, file_for_subtraction, extract_previous_image in run:
+                if verbose:
+                    print(
+                        "\n{} is processing image {} ...".format(
+                            self.Thread_Name, image_file
+                        )
+                    )
+
+                # Wait if the other threads are using up the memory budget
+                with memory_budget.admit(
+                    self.__get_frame_memory_bytes(file_dir, image_file)
+                ):
+                    self.detect_n_process_the_previous_image(
+                        file_dir,
+                        image_file,
+                        draw_box_file_dir,
+                        extracted_file_dir,
+                        file_for_subtraction=file_for_subtraction,
+                        equatorial_mount=equatorial_mount,
+                        verbose=verbose,
+                        extract_previous_image=extract_previous_image,
+                    )
+        finally:
+            # Printing the statistics for every run would be too much
+            self.__close_frame_sources(verbose=0)
+
+    def __open_frame_sources(self, save_dir, frame_access_list):
+        if settings.DETECTION_PREFETCH_DEPTH > 0:
+            self.Frame_Prefetcher = FramePrefetcher(
+                frame_access_list,
+                depth=settings.DETECTION_PREFETCH_DEPTH,
+                readers=settings.DETECTION_PREFETCH_READERS,
+                name=self.Thread_Name,
+            )
+
+        if settings.DETECTION_CACHE_ENABLED:
+            self.Detection_Cache = DetectionCache(
+                os.path.join(save_dir, DETECTION_CACHE_DIR_NAME)
+            )
+
+    def __close_frame_sources(self, verbose):
+        if self.Frame_Prefetcher is not None:
+            self.Frame_Prefetcher.close()
+            if verbose:
+                print(self.Frame_Prefetcher.get_stats_string())
+            self.Frame_Prefetcher = None
+
+        if self.Detection_Cache is not None:
+            if verbose:
+                print(
+                    "{}: detection cache {} hit(s), {} miss(es)".format(
+                        self.Thread_Name,
+                        self.Detection_Cache.Num_Of_Hits,
+                        self.Detection_Cache.Num_Of_Misses,
+                    )
+                )
+            self.Detection_Cache = None
+
+    # The order of the frames to be loaded by
+    # __detect_n_extract_meteor_from_image_list(). Used for the prefetching.
+    #
+    # With subtraction, the first image and its next image are loaded for
+    # the first step. After that only the next image is loaded in each step
+    # (the current image is still in the frame ring). The previous image
+    # used by the last step is also in the ring.
+    def __get_frame_access_order(self, file_dir, image_list, subtraction):
+        num_of_images = len(image_list)
+        if not subtraction or num_of_images <= 1:
+            access_list = list(image_list)
+        else:
+            step_list = []
+            for index in range(num_of_images):
+                if index <= num_of_images - 2:
+                    step_list.append((image_list[index], image_list[index + 1]))
+                else:
+                    step_list.append((image_list[index], image_list[index - 1]))
+            access_list = get_frame_load_order(step_list, DETECTION_FRAME_RING_SIZE)
+
+        return [os.path.join(file_dir, image_file) for image_file in access_list]
+
+    def __detect_n_extract_meteor_from_image_list(
+        self,
+        file_dir,
+        image_list,
+        draw_box_file_dir,
+        extracted_file_dir,
+        subtraction,
+        equatorial_mount,
+        verbose,
+    ):
         num_of_images = len(image_list)
         for index, image_file in enumerate(image_list):
             # The last one in the sub-set
@@ -1524,15 +2586,19 @@ class MeteorDetector:
                 else:
                     next_image_file = image_list[index - 1]
 
-                self.detect_n_process_the_previous_image(
-                    file_dir,
-                    image_file,
-                    draw_box_file_dir,
-                    extracted_file_dir,
-                    file_for_subtraction=next_image_file,
-                    equatorial_mount=equatorial_mount,
-                    verbose=verbose,
-                )
+                # Wait if the other threads are using up the memory budget
+                with memory_budget.admit(
+                    self.__get_frame_memory_bytes(file_dir, image_file)
+                ):
+                    self.detect_n_process_the_previous_image(
+                        file_dir,
+                        image_file,
+                        draw_box_file_dir,
+                        extracted_file_dir,
+                        file_for_subtraction=next_image_file,
+                        equatorial_mount=equatorial_mount,
+                        verbose=verbose,
+                    )
             else:
                 # Detection without image subtraction
                 # This would be rarely used now...
@@ -1573,10 +2639,15 @@ class Detection_Thread(threading.Thread):
         self.image_list = selected_image_list
         # self.last_image_needs_detection = last_image_needs_detection
         self.verbose = verbose
+        self.meteor_detector = None
 
     def run(self):
         print("\nStart thread: {}... ".format(self.name))
         meteor_detector = MeteorDetector(self.name)
+
+        # Kept for the report after all threads are done
+        self.meteor_detector = meteor_detector
+
         meteor_detector.detect_n_extract_meteor_from_folder(
             self.file_dir,
             self.save_dir,
@@ -1590,9 +2661,18 @@ class Detection_Thread(threading.Thread):
 
 
 # This is the main interface to be called by external program
+# backend: "thread" or "process". None means settings.DETECTION_BACKEND
 def multi_thread_process_detect_n_extract_meteor_from_folder(
-    file_dir, save_dir, subtraction=True, equatorial_mount=False, verbose=1
+    file_dir,
+    save_dir,
+    subtraction=True,
+    equatorial_mount=False,
+    verbose=1,
+    backend=None,
 ):
+    if backend is None:
+        backend = settings.DETECTION_BACKEND
+
     image_list = filter_images(os.listdir(file_dir))
 
     if not os.path.exists(save_dir):
@@ -1612,17 +2692,112 @@ def multi_thread_process_detect_n_extract_meteor_from_folder(
     if not os.path.exists(extracted_file_dir):
         os.mkdir(extracted_file_dir)
 
-    CPU_count = multiprocessing.cpu_count()
-    print("Total CPU core # = {}".format(CPU_count))
+    print("Total CPU core # = {}".format(multiprocessing.cpu_count()))
 
     # To avoid resource outage
     # 24 cores would consume about 12G memory on 5D Make III images
     # 12 cores would consume about 8G memory on 5D Make III images
-    if CPU_count > settings.MAX_CPU_FOR_DETECTION:
-        CPU_count = settings.MAX_CPU_FOR_DETECTION
+    #
+    # So the # of threads/processes is decided by the memory each of them
+    # needs (from the photo size), and the memory available.
+    frame_bytes = 0
+    if len(image_list) > 0:
+        frame_bytes = memory_budget.get_frame_bytes(
+            os.path.join(file_dir, image_list[0])
+        )
+
+    worker_bytes = frame_bytes * (
+        DETECTION_FRAMES_PER_WORKER + settings.DETECTION_PREFETCH_DEPTH
+    )
+    if backend == "process":
+        worker_bytes += PROCESS_MEMORY_OVERHEAD
+
+    # The images waiting in the output writer queue
+    shared_bytes = frame_bytes * (
+        settings.OUTPUT_WRITER_QUEUE_SIZE + settings.OUTPUT_WRITER_WORKERS
+    )
+
+    CPU_count, admission_budget_bytes = memory_budget.get_worker_count(
+        settings.MAX_CPU_FOR_DETECTION, worker_bytes, shared_bytes, name="Detection"
+    )
+
+    # The admission control only works for the threads in this process.
+    # The processes have their own memory, sized by the worker count above
+    if backend == "process":
+        memory_budget.set_memory_budget(None)
+    else:
+        memory_budget.set_memory_budget(admission_budget_bytes, worker_bytes)
 
     print("Will limit the # of CPU core(s) for processing to {}.".format(CPU_count))
 
+    # The tile detection of a frame only uses the cores left by the workers
+    set_num_of_detection_workers(CPU_count)
+
+    # The crops can only be streamed from the threads of this process
+    if settings.DETECTION_STREAM_TO_CLASSIFIER:
+        if backend == "process":
+            print(
+                "Streaming to the classifier is not supported by the process backend."
+            )
+            print("The objects will be classified after the detection.")
+        else:
+            filtered_dir = os.path.join(save_dir, "03_filtered")
+            start_crop_classifier(
+                os.path.join(filtered_dir, "good"),
+                os.path.join(filtered_dir, "removed"),
+                extracted_file_dir,
+            )
+
+    try:
+        if subtraction and settings.DETECTION_RUN_SIZE > 0:
+            prescreen_stats_list = dynamic_detect_n_extract_meteor_from_image_list(
+                file_dir,
+                save_dir,
+                equatorial_mount,
+                image_list,
+                CPU_count,
+                backend,
+                verbose,
+            )
+        else:
+            prescreen_stats_list = static_detect_n_extract_meteor_from_image_list(
+                file_dir,
+                save_dir,
+                subtraction,
+                equatorial_mount,
+                image_list,
+                CPU_count,
+                backend,
+                verbose,
+            )
+    finally:
+        set_num_of_detection_workers(1)
+        if get_crop_classifier() is not None:
+            stop_crop_classifier()
+            output_writer.flush()
+
+    if settings.DETECTION_PRESCREEN_ENABLED:
+        print_prescreen_report(prescreen_stats_list)
+
+    if memory_budget.get_memory_budget() is not None:
+        print(memory_budget.get_memory_budget().get_stats_string())
+        memory_budget.set_memory_budget(None)
+
+    print("\nMulti-thread process for image detection done !")
+
+
+# The image list is cut into fixed contiguous sub-lists, one for each
+# thread/process (settings.DETECTION_RUN_SIZE = 0)
+def static_detect_n_extract_meteor_from_image_list(
+    file_dir,
+    save_dir,
+    subtraction,
+    equatorial_mount,
+    image_list,
+    CPU_count,
+    backend,
+    verbose,
+):
     num_image_list = len(image_list)
 
     size_per_sublist = math.ceil(num_image_list / CPU_count)
@@ -1648,7 +2823,7 @@ def multi_thread_process_detect_n_extract_meteor_from_folder(
     )
     print("Each core to handle {} images".format(min(size_per_sublist, num_image_list)))
 
-    thread_set = []
+    subset_image_list_set = []
 
     start_from = 0
     num = 0
@@ -1722,6 +2897,224 @@ def multi_thread_process_detect_n_extract_meteor_from_folder(
         # print(num)
         # print(subset_image_list)
 
+        subset_image_list_set.append(subset_image_list)
+
+    if backend == "process":
+        prescreen_stats_list = process_pool_detect_n_extract_meteor_from_image_lists(
+            file_dir,
+            save_dir,
+            subtraction,
+            equatorial_mount,
+            subset_image_list_set,
+            verbose,
+        )
+    else:
+        prescreen_stats_list = thread_detect_n_extract_meteor_from_image_lists(
+            file_dir,
+            save_dir,
+            subtraction,
+            equatorial_mount,
+            subset_image_list_set,
+            verbose,
+        )
+
+    return prescreen_stats_list
+
+
+# Dynamic scheduling (settings.DETECTION_RUN_SIZE > 0):
+#
+# The image list is cut into small runs of adjacent images. The runs are
+# put to the queue of a thread/process pool, and each worker takes the
+# next run when it is free. So the workers getting the slow images
+# (clouds, landscape lights, planes ...) don't hold up the others.
+#
+# Each image is detected with its next image for the subtraction (the
+# last image with the previous one), the same as processing the whole
+# list in one thread. To extract image i, the lines of image i-1 and i+1
+# are needed for the satellite checking. So each run has:
+# - a lead-in step: the image before the run, only for the satellite
+#   checking, not extracted
+# - a lead-out step: the image after the run, not extracted
+# The lines detected are shared by all the runs, so these images are
+# normally not detected again.
+#
+# Each run is a list of steps: (image, image for subtraction,
+#                               extract the image of the previous step)
+def get_detection_runs(image_list, run_size):
+    num_of_images = len(image_list)
+
+    run_list = []
+    for start in range(0, num_of_images, run_size):
+        end = min(start + run_size, num_of_images)
+
+        run = []
+        for index in range(max(start - 1, 0), min(end + 1, num_of_images)):
+            if index <= num_of_images - 2:
+                file_for_subtraction = image_list[index + 1]
+            else:
+                file_for_subtraction = image_list[index - 1]
+            run.append((image_list[index], file_for_subtraction, index - 1 >= start))
+
+        if end == num_of_images:
+            # One more step to extract the last image, the same as the
+            # extra image added to the last sub-list of the static way
+            run.append((image_list[max(num_of_images - 2, 0)], image_list[-1], True))
+
+        run_list.append(run)
+
+    return run_list
+
+
+def dynamic_detect_n_extract_meteor_from_image_list(
+    file_dir, save_dir, equatorial_mount, image_list, CPU_count, backend, verbose
+):
+    run_list = get_detection_runs(image_list, settings.DETECTION_RUN_SIZE)
+    num_of_workers = max(min(CPU_count, len(run_list)), 1)
+
+    print(
+        "\nTotally {} images to be processed by {} {}s, in {} runs of {} images".format(
+            len(image_list),
+            num_of_workers,
+            backend,
+            len(run_list),
+            settings.DETECTION_RUN_SIZE,
+        )
+    )
+
+    start_time = time.perf_counter()
+    if backend == "process":
+        with multiprocessing.Manager() as manager:
+            with ProcessPoolExecutor(
+                max_workers=num_of_workers,
+                initializer=init_detection_process,
+                initargs=(settings.DETECTION_PROCESS_CV2_THREADS, num_of_workers),
+            ) as executor:
+                run_result_list = run_detection_runs(
+                    executor,
+                    file_dir,
+                    save_dir,
+                    equatorial_mount,
+                    run_list,
+                    manager.dict(),
+                    True,
+                    verbose,
+                )
+    else:
+        with ThreadPoolExecutor(
+            max_workers=num_of_workers, thread_name_prefix="Thread"
+        ) as executor:
+            run_result_list = run_detection_runs(
+                executor,
+                file_dir,
+                save_dir,
+                equatorial_mount,
+                run_list,
+                {},
+                False,
+                verbose,
+            )
+
+        # The detection threads may finish before all the files are written
+        output_writer.flush()
+
+    print_worker_utilization(run_result_list, time.perf_counter() - start_time)
+
+    return [run_result["prescreen_stats"] for run_result in run_result_list]
+
+
+def run_detection_runs(
+    executor,
+    file_dir,
+    save_dir,
+    equatorial_mount,
+    run_list,
+    shared_detection_lines,
+    flush_output,
+    verbose,
+):
+    future_list = [
+        executor.submit(
+            detect_n_extract_meteor_from_run,
+            file_dir,
+            save_dir,
+            equatorial_mount,
+            run,
+            shared_detection_lines,
+            flush_output,
+            verbose,
+        )
+        for run in run_list
+    ]
+
+    # Any exception raised in the workers is raised again here
+    return [future.result() for future in future_list]
+
+
+def detect_n_extract_meteor_from_run(
+    file_dir,
+    save_dir,
+    equatorial_mount,
+    run,
+    shared_detection_lines,
+    flush_output,
+    verbose,
+):
+    start_time = time.perf_counter()
+
+    if multiprocessing.current_process().name != "MainProcess":
+        worker_name = "Process-{}".format(os.getpid())
+    else:
+        worker_name = threading.current_thread().name
+
+    # A new detector for each run, as the runs are not adjacent
+    meteor_detector = MeteorDetector(worker_name)
+    meteor_detector.Shared_Detection_Lines = shared_detection_lines
+    meteor_detector.detect_n_extract_meteor_from_run(
+        file_dir, save_dir, run, equatorial_mount, verbose
+    )
+
+    # The output writer of a process is not flushed by the main process
+    if flush_output:
+        output_writer.flush()
+
+    return {
+        "worker_name": worker_name,
+        "num_of_images": sum(1 for step in run if step[2]),
+        "busy_time": time.perf_counter() - start_time,
+        "prescreen_stats": get_prescreen_stats(meteor_detector),
+    }
+
+
+# The utilization is the time a worker was processing runs, against the
+# total time of the detection. Low values mean the workers were idle
+# waiting for the others (the runs could be made smaller).
+def print_worker_utilization(run_result_list, total_time):
+    worker_stats = {}
+    for run_result in run_result_list:
+        stats = worker_stats.setdefault(run_result["worker_name"], [0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += run_result["num_of_images"]
+        stats[2] += run_result["busy_time"]
+
+    print("\nWorker utilization (total {:.2f}s):".format(total_time))
+    for worker_name in sorted(worker_stats):
+        num_of_runs, num_of_images, busy_time = worker_stats[worker_name]
+        print(
+            "    {}: {} runs, {} images, busy {:.2f}s ({:.1f}%)".format(
+                worker_name,
+                num_of_runs,
+                num_of_images,
+                busy_time,
+                busy_time / max(total_time, 1e-6) * 100,
+            )
+        )
+
+
+def thread_detect_n_extract_meteor_from_image_lists(
+    file_dir, save_dir, subtraction, equatorial_mount, subset_image_list_set, verbose
+):
+    thread_set = []
+    for i, subset_image_list in enumerate(subset_image_list_set):
         thread_set.append(
             Detection_Thread(
                 i + 1,
@@ -1741,7 +3134,147 @@ def multi_thread_process_detect_n_extract_meteor_from_folder(
     for thread_process in thread_set:
         thread_process.join()
 
-    print("\nMulti-thread process for image detection done !")
+    # The detection threads may finish before all the files are written
+    output_writer.flush()
+
+    return [
+        get_prescreen_stats(thread_process.meteor_detector)
+        for thread_process in thread_set
+        if thread_process.meteor_detector is not None
+    ]
+
+
+# Most of the per-frame work after the edge detection (line merging, box
+# merging, satellite checking) is pure Python, so the threads share one
+# core most of the time due to the GIL. With the process backend, each
+# image sub-list is processed in its own process instead.
+#
+# Notes:
+# - Each process loads its frames and writes its files by itself. Only the
+#   pre-screen statistics are sent back.
+# - The settings are read by each process when it starts. The changes
+#   made at run time (not in settings.py) are not seen by the processes
+#   on Windows / macOS.
+# - The output printed by the processes is not shown in the GUI log (it
+#   only captures the main process). A line is printed here when each
+#   process is done.
+def process_pool_detect_n_extract_meteor_from_image_lists(
+    file_dir, save_dir, subtraction, equatorial_mount, subset_image_list_set, verbose
+):
+    prescreen_stats_list = []
+    with ProcessPoolExecutor(
+        max_workers=len(subset_image_list_set),
+        initializer=init_detection_process,
+        initargs=(
+            settings.DETECTION_PROCESS_CV2_THREADS,
+            len(subset_image_list_set),
+        ),
+    ) as executor:
+        future_set = []
+        for i, subset_image_list in enumerate(subset_image_list_set):
+            name = "Process-{0:03d}".format(i + 1)
+            print("\nStart process: {}... ".format(name))
+            future_set.append(
+                (
+                    name,
+                    executor.submit(
+                        process_detect_n_extract_meteor_from_image_list,
+                        name,
+                        file_dir,
+                        save_dir,
+                        subtraction,
+                        equatorial_mount,
+                        subset_image_list,
+                        verbose,
+                    ),
+                )
+            )
+
+        # Any exception raised in the processes is raised again here
+        for (name, future), subset_image_list in zip(
+            future_set, subset_image_list_set
+        ):
+            prescreen_stats_list.append(future.result())
+            print("{} done: {} images".format(name, len(subset_image_list)))
+
+    return prescreen_stats_list
+
+
+def init_detection_process(cv2_num_of_threads, num_of_processes):
+    # Every process running OpenCV with all the cores would over-subscribe
+    # the CPU. 0 keeps the OpenCV default.
+    if cv2_num_of_threads > 0:
+        cv2.setNumThreads(cv2_num_of_threads)
+
+    # Same for the tile detection (not seen from the main process on
+    # Windows / macOS, where the processes are not forked)
+    set_num_of_detection_workers(num_of_processes)
+
+
+def process_detect_n_extract_meteor_from_image_list(
+    name, file_dir, save_dir, subtraction, equatorial_mount, image_list, verbose
+):
+    meteor_detector = MeteorDetector(name)
+    meteor_detector.detect_n_extract_meteor_from_folder(
+        file_dir,
+        save_dir,
+        subtraction,
+        equatorial_mount,
+        image_list,
+        verbose=verbose,
+    )
+
+    # The output writer is per process. All the files need to be written
+    # before the process is taken as done
+    output_writer.flush()
+
+    return get_prescreen_stats(meteor_detector)
+
+
+def get_prescreen_stats(meteor_detector):
+    return {
+        "num_of_frames": meteor_detector.Prescreen_Num_Of_Frames,
+        "skipped_frames": meteor_detector.Prescreen_Skipped_Frames,
+        "borderline_frames": meteor_detector.Prescreen_Borderline_Frames,
+        "missed_frames": meteor_detector.Prescreen_Missed_Frames,
+    }
+
+
+# prescreen_stats_list: from get_prescreen_stats() of each thread/process
+def print_prescreen_report(prescreen_stats_list):
+    num_of_frames = 0
+    skipped_frames = []
+    borderline_frames = []
+    missed_frames = []
+    for prescreen_stats in prescreen_stats_list:
+        num_of_frames += prescreen_stats["num_of_frames"]
+        skipped_frames.extend(prescreen_stats["skipped_frames"])
+        borderline_frames.extend(prescreen_stats["borderline_frames"])
+        missed_frames.extend(prescreen_stats["missed_frames"])
+
+    print(
+        "\nPre-screen: {} of {} frames skipped (threshold {})".format(
+            len(skipped_frames), num_of_frames, settings.DETECTION_PRESCREEN_MIN_ENERGY
+        )
+    )
+
+    if len(borderline_frames) > 0:
+        print(
+            "    {} skipped frames were close to the threshold:".format(
+                len(borderline_frames)
+            )
+        )
+        for filename, score in sorted(borderline_frames):
+            print("        {} (score {:.1f})".format(filename, score))
+
+    if settings.DETECTION_PRESCREEN_AUDIT:
+        print(
+            "    Audit: {} skipped frames had lines found by the detection:".format(
+                len(missed_frames)
+            )
+        )
+        for filename, score in sorted(missed_frames):
+            print("        {} (score {:.1f})".format(filename, score))
 
 
 # Use a simple CNN classification model to filter out
@@ -1774,78 +3307,63 @@ def filter_possible_not_meteor_objects(detection_folder, keep_folder, removed_fo
     if not os.path.exists(removed_folder):
         os.mkdir(removed_folder)
 
-    test_datagen = ImageDataGenerator(rescale=1.0 / 255)
-
-    batch_size = 1
-
-    # test_folder = os.path.join(training_data_folder, 'test')
-
     # Normally this would be '02_cropped'
-    test_folder = detection_folder
-    test_generator = test_datagen.flow_from_directory(
-        test_folder,
-        target_size=(256, 256),
-        batch_size=batch_size,
-        shuffle=False,
-        class_mode=None,
-    )
+    file_list = get_crop_file_list(detection_folder)
 
-    # label_map = test_generator.class_indices
-    # print(label_map)
+    # The objects could have been classified during the detection already
+    # (settings.DETECTION_STREAM_TO_CLASSIFIER)
+    if len(file_list) == 0:
+        print("No objects left to be classified in {}".format(detection_folder))
+        return
 
-    # cnn_model = model.cnn()
-    # cnn_model = model.cnn_2()
-    # cnn_model = model.cnn_3()
-    # cnn_model = model.cnn_4()
-    # cnn_model = model.cnn_7()
-    cnn_model = model.cnn_11()
-    cnn_model.load_weights(settings.CNN_SAVED_MODEL)
-
-    filenames = test_generator.filenames
-    nb_samples = len(filenames)
-
-    # scores_predict = cnn_model.predict_generator(test_generator, nb_samples, verbose=1)
+    print("Found {} images to be classified.".format(len(file_list)))
 
     # 2021-7-22:
     # To align with TF2 API
-    scores_predict = cnn_model.predict(test_generator, nb_samples, verbose=1)
-
-    # There will be three values in each score:
-    #   [0]: 'meteor'   : 0.xxxxx
-    #   [1]: 'others'   : 0.yyyyy
-    #   [2]: 'satellite': 0.zzzzz
     #
-    #  2020-5-13: Changed to this
-    #   [0]: 'others'   : 0.xxxxx
-    #   [1]: 'star'     : 0.yyyyy
-    #
-    # If the maximum value is scores_predict[i][1], take it as a meteor
-    # Otherwise, consider it as not a meteor
-    for i, test_file in enumerate(test_generator.filenames):
-        # The test_file would be 'un-classified/IMG_xxxxxxx.jpg
-        source_file_w_path = os.path.join(detection_folder, test_file)
-        file_basename = os.path.basename(test_file)
+    # The crops are decoded and resized in parallel by a tf.data pipeline,
+    # and predicted in batches (instead of ImageDataGenerator with
+    # batch_size = 1)
+
+    test_dataset = get_crop_dataset(
+        file_list,
+        batch_size=settings.CNN_BATCH_SIZE,
+        decode_threads=settings.CNN_DECODE_THREADS,
+        prefetch_batches=settings.CNN_PREFETCH_BATCHES,
+    )
 
-        """
-        if (scores_predict[i][0] >= scores_predict[i][1]) and (scores_predict[i][0] >= scores_predict[i][2]):
-            # Highly possible meteors
-            dest_file_w_path = os.path.join(keep_folder, file_basename)
-        else:
-            # Possible satellites. Put to 'not_sure' folder
-            if (scores_predict[i][2] >= scores_predict[i][1]) and (scores_predict[i][2] >= scores_predict[i][2]):
-                dest_file_w_path = os.path.join(not_sure_folder, file_basename)
-            else:
-                dest_file_w_path = os.path.join(removed_folder, file_basename)
+    # The model is loaded only once in a session
+    cnn_model = model_host.get_model(model_host.CNN_MODEL)
 
-        """
+    start_time = time.perf_counter()
+    scores_predict = cnn_model.predict(test_dataset, verbose=1)
+    used_time = time.perf_counter() - start_time
+    print(
+        "{} images classified in {:.2f}s, {:.1f} images/s".format(
+            len(file_list), used_time, len(file_list) / max(used_time, 1e-6)
+        )
+    )
+
+    # If the maximum value is scores_predict[i][1], take it as a meteor
+    # Otherwise, consider it as not a meteor (see is_meteor())
+    score_list = []
+    for source_file_w_path, scores in zip(file_list, scores_predict):
+        file_basename = os.path.basename(source_file_w_path)
 
-        if scores_predict[i][0] < scores_predict[i][1]:
+        if is_meteor(scores):
             # Star image, keep
             dest_file_w_path = os.path.join(keep_folder, file_basename)
         else:
             dest_file_w_path = os.path.join(removed_folder, file_basename)
 
         shutil.copyfile(source_file_w_path, dest_file_w_path)
+        score_list.append(get_score_row(file_basename, scores))
+
+    # The scores can be used to tune the threshold, without running the
+    # model again
+    update_score_report(
+        os.path.join(os.path.dirname(keep_folder), SCORE_REPORT_NAME), score_list
+    )
 
 
 # end of function
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+import settings
+
+# The cache folder, under the "process" folder
+DETECTION_CACHE_DIR_NAME = "00_detection_cache"
+
+# The settings that could change the detection lines of one frame: all the
+# DETECTION_* / LINE_* settings, so that a new setting is never missed.
+# If any of these is changed, the cached results are not used.
+DETECTION_SETTINGS_PREFIXES = ("DETECTION_", "LINE_")
+
+# Except these, which only change how the detection is run, or what is done
+# after the lines are detected
+NON_DETECTION_SETTINGS_NAMES = [
+    "DETECTION_TILE_WORKERS",
+    "DETECTION_PRESCREEN_BORDERLINE_RATIO",
+    "DETECTION_SAVE_NO_DETECTION_IMAGES",
+    "DETECTION_ANNOTATION_SCALE",
+    "DETECTION_CROP_IMAGE_BOX_SIZE",
+    "DETECTION_CROP_IMAGE_BOX_FACTOR",
+    "DETECTION_BOX_MERGE_METHOD",
+    "DETECTION_BACKEND",
+    "DETECTION_PROCESS_CV2_THREADS",
+    "DETECTION_RUN_SIZE",
+    "DETECTION_PREFETCH_DEPTH",
+    "DETECTION_PREFETCH_READERS",
+    "DETECTION_CACHE_ENABLED",
+    "DETECTION_STREAM_TO_CLASSIFIER",
+]
+
+
+def get_detection_settings():
+    return {
+        name: value
+        for name, value in vars(settings).items()
+        if name.startswith(DETECTION_SETTINGS_PREFIXES)
+        and name not in NON_DETECTION_SETTINGS_NAMES
+    }
+
+
+def get_detection_settings_hash():
+    settings_str = json.dumps(get_detection_settings(), sort_keys=True)
+    return hashlib.sha1(settings_str.encode("utf-8")).hexdigest()
+
+
+# The file is identified by the full path, size and modified time
+def get_file_identity(filename_w_path):
+    file_stat = os.stat(filename_w_path)
+    return [os.path.abspath(filename_w_path), file_stat.st_size, file_stat.st_mtime_ns]
+
+
+# Caches the detection lines of each frame to a JSON file, so that the
+# detection doesn't need to be done again when re-running the step 1,
+# for the frames not changed.
+#
+# The cache key is made from:
+# - The frame file (path, size and modified time)
+# - The frame used for subtraction (the same)
+# - The equatorial mount option
+# - The detection related settings (get_detection_settings())
+#
+# The pre-screen result of the frame is cached with the lines, so that the
+# pre-screen report is the same when the lines are from the cache.
+class DetectionCache:
+    def __init__(self, cache_dir):
+        self.Cache_Dir = cache_dir
+        os.makedirs(self.Cache_Dir, exist_ok=True)
+
+        self.Num_Of_Hits = 0
+        self.Num_Of_Misses = 0
+        self.Lock = threading.Lock()
+
+    def get_key(self, frame_file, partner_file, equatorial_mount):
+        key_str = json.dumps([
+            get_file_identity(frame_file),
+            get_file_identity(partner_file),
+            bool(equatorial_mount),
+            get_detection_settings_hash(),
+        ])
+        return hashlib.sha1(key_str.encode("utf-8")).hexdigest()
+
+    def __get_cache_file(self, key):
+        return os.path.join(self.Cache_Dir, key + ".json")
+
+    # Returns the cached (detection lines, pre-screen result), or None if
+    # not cached
+    def load(self, key):
+        cache_file = self.__get_cache_file(key)
+        try:
+            with open(cache_file, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            lines = entry["lines"]
+            prescreen = entry["prescreen"]
+        except (OSError, ValueError, KeyError):
+            with self.Lock:
+                self.Num_Of_Misses += 1
+            return None
+
+        with self.Lock:
+            self.Num_Of_Hits += 1
+        return lines, prescreen
+
+    # prescreen: the pre-screen result of the frame, None if not checked
+    def save(
+        self, key, frame_file, partner_file, equatorial_mount, lines, prescreen=None
+    ):
+        entry = {
+            "frame": get_file_identity(frame_file),
+            "partner": get_file_identity(partner_file),
+            "equatorial_mount": bool(equatorial_mount),
+            "settings_hash": get_detection_settings_hash(),
+            "settings": get_detection_settings(),
+            "created": time.time(),
+            # Each line: [x1, y1, x2, y2, x_mid, y_mid, angle]
+            "lines": [
+                [int(v) for v in line[0:6]] + [float(line[6])] for line in lines
+            ],
+            # {"score", "skipped", "missed"}, see MeteorDetector
+            "prescreen": prescreen,
+        }
+
+        # Write to a temp file first, so that a half-written file would
+        # never be read
+        cache_file = self.__get_cache_file(key)
+        temp_file = cache_file + ".{}.tmp".format(threading.get_ident())
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(temp_file, cache_file)
+
+    def get_entry_list(self):
+        entry_list = []
+        for cache_file in sorted(os.listdir(self.Cache_Dir)):
+            if not cache_file.endswith(".json"):
+                continue
+
+            try:
+                cache_file_w_path = os.path.join(self.Cache_Dir, cache_file)
+                with open(cache_file_w_path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                entry = None
+            entry_list.append((cache_file, entry))
+        return entry_list
+
+    # An entry is stale if the frame files are changed or removed, or the
+    # settings are changed. It would never be used again.
+    def is_entry_stale(self, entry):
+        if entry is None:
+            return True
+
+        if entry.get("settings_hash") != get_detection_settings_hash():
+            return True
+
+        for file_identity in [entry["frame"], entry["partner"]]:
+            try:
+                if get_file_identity(file_identity[0]) != file_identity:
+                    return True
+            except OSError:
+                return True
+
+        return False
+
+    # Remove the stale entries, and the entries older than max_age_days
+    # (if specified). Returns the number of entries removed.
+    def prune(self, max_age_days=None):
+        num_of_removed = 0
+        for cache_file, entry in self.get_entry_list():
+            remove = self.is_entry_stale(entry)
+            if not remove and max_age_days is not None:
+                remove = time.time() - entry["created"] > max_age_days * 24 * 3600
+
+            if remove:
+                try:
+                    os.remove(os.path.join(self.Cache_Dir, cache_file))
+                    num_of_removed += 1
+                except OSError:
+                    pass
+        return num_of_removed
+
+    def clear(self):
+        for cache_file, _ in self.get_entry_list():
+            try:
+                os.remove(os.path.join(self.Cache_Dir, cache_file))
+            except OSError:
+                pass
+
+
+def print_entry_list(detection_cache):
+    entry_list = detection_cache.get_entry_list()
+    num_of_stale = 0
+    for cache_file, entry in entry_list:
+        if entry is None:
+            print("{}: unreadable".format(cache_file))
+            num_of_stale += 1
+            continue
+
+        stale = detection_cache.is_entry_stale(entry)
+        if stale:
+            num_of_stale += 1
+
+        print(
+            "{}: {} - {}, {} lines, {}{}".format(
+                cache_file,
+                os.path.basename(entry["frame"][0]),
+                os.path.basename(entry["partner"][0]),
+                len(entry["lines"]),
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["created"])),
+                " (stale)" if stale else "",
+            )
+        )
+
+    print(
+        "\n{} entries, {} stale, in {}".format(
+            len(entry_list), num_of_stale, detection_cache.Cache_Dir
+        )
+    )
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if len(argv) < 2 or argv[1] not in ["list", "prune", "clear"]:
+        print(
+            "\nUsage: detection_cache <folder name> list|prune|clear [max age in days]"
+        )
+        print("    list : show the cached detection results")
+        print("    prune: remove the results which would never be used again")
+        print("           (frames or settings changed), or older than the max age")
+        print("    clear: remove all the cached results")
+        sys.exit(1)
+
+    cache_dir = os.path.join(argv[0], "process", DETECTION_CACHE_DIR_NAME)
+    if not os.path.exists(cache_dir):
+        print("No detection cache in: {}".format(argv[0]))
+        sys.exit(1)
+
+    detection_cache = DetectionCache(cache_dir)
+    if argv[1] == "list":
+        print_entry_list(detection_cache)
+    elif argv[1] == "prune":
+        max_age_days = None
+        if len(argv) > 2:
+            max_age_days = float(argv[2])
+        print("{} entries removed".format(detection_cache.prune(max_age_days)))
+    else:
+        detection_cache.clear()
+        print("Detection cache cleared")
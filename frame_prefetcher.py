@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from frame_store import load_frame
+
+
+# Decode the frames in the background, in the same order as they will be
+# used by the detection. So that frame N+1 (N+2 ...) is being read/decoded
+# while frame N is being analysed.
+#
+# file_list is the full list of files (with path) in the access order.
+# At most "depth" frames are decoded ahead, to limit the memory usage
+# (each frame of a 45M pixels photo is ~130MB).
+#
+# The statistics about how long the detection had to wait for the frames
+# (queue starvation) can be used to tune the depth and readers number.
+class FramePrefetcher:
+    def __init__(self, file_list, depth=2, readers=1, name="Prefetcher"):
+        self.File_List = list(file_list)
+        self.Depth = max(depth, 1)
+        self.Readers = max(readers, 1)
+        self.Name = name
+
+        self.Executor = ThreadPoolExecutor(
+            max_workers=self.Readers, thread_name_prefix=name
+        )
+        self.Pending = collections.deque()
+        self.Next_Index = 0
+
+        # Statistics
+        self.Num_Of_Gets = 0
+        self.Num_Of_Starved = 0
+        self.Num_Of_Misses = 0
+        self.Starved_Time = 0.0
+        self.Max_Starved_Time = 0.0
+
+        self.__fill_queue()
+
+    def __fill_queue(self):
+        while len(self.Pending) < self.Depth and self.Next_Index < len(
+            self.File_List
+        ):
+            filename_w_path = self.File_List[self.Next_Index]
+            future = self.Executor.submit(load_frame, filename_w_path)
+            self.Pending.append((filename_w_path, future))
+            self.Next_Index += 1
+
+    def get(self, filename_w_path):
+        self.Num_Of_Gets += 1
+
+        if len(self.Pending) == 0 or self.Pending[0][0] != filename_w_path:
+            # Not in the expected order. Just load it directly
+            self.Num_Of_Misses += 1
+            return load_frame(filename_w_path)
+
+        _, future = self.Pending.popleft()
+
+        # Start decoding the next one before waiting for this one
+        self.__fill_queue()
+
+        if not future.done():
+            self.Num_Of_Starved += 1
+            start_time = time.perf_counter()
+            img = future.result()
+            wait_time = time.perf_counter() - start_time
+            self.Starved_Time += wait_time
+            self.Max_Starved_Time = max(self.Max_Starved_Time, wait_time)
+            return img
+
+        return future.result()
+
+    def close(self):
+        for _, future in self.Pending:
+            future.cancel()
+        self.Pending.clear()
+        self.Executor.shutdown(wait=True)
+
+    def get_stats_string(self):
+        if self.Num_Of_Gets > 0:
+            starved_ratio = self.Num_Of_Starved / self.Num_Of_Gets * 100
+        else:
+            starved_ratio = 0
+
+        return (
+            "{}: prefetch depth {}, {} reader(s): {} frames, starved {} times "
+            "({:.1f}%), waited {:.2f}s in total (max {:.2f}s), {} out-of-order "
+            "loads".format(
+                self.Name,
+                self.Depth,
+                self.Readers,
+                self.Num_Of_Gets,
+                self.Num_Of_Starved,
+                starved_ratio,
+                self.Starved_Time,
+                self.Max_Starved_Time,
+                self.Num_Of_Misses,
+            )
+        )
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import collections
+
+
+# A small ring of the decoded frames used by one detection thread.
+#
+# The detection of each image needs the image itself and the image for
+# subtraction (the next one). The image is extracted in the next step,
+# after the satellite checking with the next image. So at most 3 frames
+# are in use at the same time: previous, current and next.
+#
+# The frames are handed over by reference, never copied. A frame put into
+# the ring is made read-only, so that no one can change it while it is
+# still used as another step's current / previous image. Whoever needs
+# to draw on it has to make its own copy.
+#
+# When the ring is full, the least recently used frame is dropped.
+class FrameRing:
+    def __init__(self, size=3):
+        self.Size = max(size, 1)
+        self.Frames = collections.OrderedDict()
+
+    def get(self, filename):
+        frame = self.Frames.get(filename)
+        if frame is not None:
+            self.Frames.move_to_end(filename)
+        return frame
+
+    def put(self, filename, frame):
+        if hasattr(frame, "flags"):
+            frame.flags.writeable = False
+
+        self.Frames[filename] = frame
+        self.Frames.move_to_end(filename)
+        while len(self.Frames) > self.Size:
+            self.Frames.popitem(last=False)
+
+    def clear(self):
+        self.Frames.clear()
+
+
+# The order the frames will be loaded in, for the given steps of
+# (image, image for subtraction), with a FrameRing of ring_size.
+# Used for the prefetching, so that the frames already in the ring are
+# not loaded again.
+def get_frame_load_order(step_list, ring_size=3):
+    frame_ring = FrameRing(ring_size)
+
+    load_order = []
+    for step in step_list:
+        for filename in step:
+            if frame_ring.get(filename) is None:
+                load_order.append(filename)
+                frame_ring.put(filename, filename)
+    return load_order
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+import settings
+from utils import load_image
+
+# The # of locks shared by the frames (see FrameStore.Key_Locks)
+NUM_OF_KEY_LOCKS = 64
+
+
+# The same original photo would be decoded many times during the whole
+# process (detection, extraction ...). For RAW files each decoding could
+# take seconds.
+#
+# The frame store decodes each photo only once, and saves the decoded
+# pixels to an on-disk .npy cache file. Later the pixels are read with
+# memory mapping, no need to decode or copy the whole image again.
+#
+# The cache file is keyed by the file path + size + modified time. So if
+# the photo is changed (like re-exported), it will be decoded again.
+class FrameStore:
+    def __init__(self, cache_dir, max_size_in_bytes):
+        self.Cache_Dir = cache_dir
+        self.Max_Size_In_Bytes = max_size_in_bytes
+
+        if not os.path.exists(self.Cache_Dir):
+            os.makedirs(self.Cache_Dir)
+
+        # To ensure the same frame is not decoded by two threads at the same
+        # time (the adjacent detection threads share one image), and the
+        # cache file is not removed while being loaded.
+        # A fixed set of locks, each frame uses one by its key. So the locks
+        # don't grow with the # of frames.
+        self.Key_Locks = [threading.Lock() for _ in range(NUM_OF_KEY_LOCKS)]
+
+    def get_cache_key(self, filename_w_path):
+        file_stat = os.stat(filename_w_path)
+        key_str = "{}|{}|{}".format(
+            os.path.abspath(filename_w_path), file_stat.st_size, file_stat.st_mtime_ns
+        )
+        return hashlib.sha1(key_str.encode("utf-8")).hexdigest()
+
+    def __get_key_lock(self, key):
+        return self.Key_Locks[hash(key) % len(self.Key_Locks)]
+
+    # Returns the decoded image (in the same format as utils.load_image()),
+    # as a read-only memory-mapped array
+    def load(self, filename_w_path):
+        key = self.get_cache_key(filename_w_path)
+        cache_file = os.path.join(self.Cache_Dir, key + ".npy")
+
+        with self.__get_key_lock(key):
+            try:
+                # Refresh the modified time. It is used for the eviction
+                os.utime(cache_file, None)
+                return np.load(cache_file, mmap_mode="r")
+            except OSError:
+                # Not cached yet, or just removed by another process
+                pass
+
+            img = load_image(filename_w_path)
+            if img is None:
+                return None
+
+            # Write to a temp file first, so that another process would
+            # never read a half-written cache file
+            temp_file = cache_file + ".{}.tmp".format(threading.get_ident())
+            with open(temp_file, "wb") as f:
+                np.save(f, img)
+            os.replace(temp_file, cache_file)
+
+            self.evict(keep_file=cache_file)
+
+            return np.load(cache_file, mmap_mode="r")
+
+    def get_size_in_bytes(self):
+        total = 0
+        for cache_file in os.listdir(self.Cache_Dir):
+            if cache_file.endswith(".npy"):
+                total += os.path.getsize(os.path.join(self.Cache_Dir, cache_file))
+        return total
+
+    # Remove the least recently used cache files until the total size is
+    # within the limit
+    def evict(self, keep_file=None):
+        cache_list = []
+        total = 0
+        for cache_file in os.listdir(self.Cache_Dir):
+            if not cache_file.endswith(".npy"):
+                continue
+            cache_file = os.path.join(self.Cache_Dir, cache_file)
+            try:
+                file_stat = os.stat(cache_file)
+            except OSError:
+                continue
+            cache_list.append((file_stat.st_mtime, file_stat.st_size, cache_file))
+            total += file_stat.st_size
+
+        cache_list.sort()
+
+        for mtime, size, cache_file in cache_list:
+            if total <= self.Max_Size_In_Bytes:
+                break
+            if cache_file == keep_file:
+                continue
+            if self.__remove_cache_file(cache_file):
+                total -= size
+
+    def clear(self):
+        for cache_file in os.listdir(self.Cache_Dir):
+            if cache_file.endswith(".npy"):
+                self.__remove_cache_file(os.path.join(self.Cache_Dir, cache_file))
+
+    # Returns False if the file is not removed
+    def __remove_cache_file(self, cache_file):
+        # The file is skipped if it is being loaded by another thread (or
+        # its lock is held by this thread, for another frame)
+        key_lock = self.__get_key_lock(os.path.basename(cache_file)[: -len(".npy")])
+        if not key_lock.acquire(blocking=False):
+            return False
+
+        try:
+            os.remove(cache_file)
+            return True
+        except OSError:
+            # The file could be still mapped by others (on Windows).
+            # Just leave it this time
+            return False
+        finally:
+            key_lock.release()
+
+
+_frame_store = None
+_frame_store_lock = threading.Lock()
+
+
+# The locks could be held by other threads when the process is forked
+# (the process detection backend). Start with a new frame store there.
+def _reset_frame_store_after_fork():
+    global _frame_store, _frame_store_lock
+
+    _frame_store = None
+    _frame_store_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_frame_store_after_fork)
+
+
+# The frame store for the whole session. None if it is not enabled
+# in the settings.
+def get_frame_store():
+    global _frame_store
+
+    if not settings.FRAME_STORE_ENABLED:
+        return None
+
+    with _frame_store_lock:
+        if _frame_store is None:
+            cache_dir = settings.FRAME_STORE_DIR
+            if cache_dir == "":
+                cache_dir = os.path.join(tempfile.gettempdir(), "meteor_frame_store")
+
+            _frame_store = FrameStore(
+                cache_dir, int(settings.FRAME_STORE_MAX_SIZE_GB * 1024 * 1024 * 1024)
+            )
+        return _frame_store
+
+
+# Drop-in replacement of utils.load_image(). Goes through the frame store
+# when it is enabled.
+def load_frame(filename_w_path):
+    frame_store = get_frame_store()
+    if frame_store is None:
+        return load_image(filename_w_path)
+    return frame_store.load(filename_w_path)
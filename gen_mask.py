@@ -5,17 +5,231 @@ import numpy as np
 import math
 import shutil
 import threading
-import multiprocessing
+import time
 from time import sleep
 from PIL import Image, ImageOps, ImageChops, ImageDraw, ImageFont
 
-import model
+import model_host
 import unet_proc
 
+import compositor
+import frame_store
+import memory_budget
+import output_writer
 import settings
 from utils import filter_images
 
 
+# The shared extraction engine for all the "extract_meteor_from_xxx_with_mask"
+# functions. Works on whole arrays instead of looping the pixels in Python.
+#
+# photo_rgb and mask_rgb are uint8 (H, W, 3) arrays in RGB order.
+# Returns a uint8 (H, W, 4) RGBA array.
+#
+# With the default (soft_alpha=False) the output is exactly the same as the
+# previous PIL implementation:
+#     ImageChops.multiply() -> convert("RGBA") -> pixels with all R/G/B below
+#     the threshold are replaced with (255, 255, 255, 0)
+#
+# With soft_alpha=True, the alpha channel is taken from the mask brightness
+# and the RGB values are the original photo colors (not multiplied), so that
+# the soft edge of the mask gives a smooth transition when being combined.
+# The threshold checking is still done on the multiplied values.
+def extract_meteor_rgba_with_mask(
+    photo_rgb, mask_rgb, rgb_threshold=None, soft_alpha=False
+):
+    if rgb_threshold is None:
+        rgb_threshold = settings.EXTRACT_RGB_VALUE_THRESHOLD
+
+    # Same as ImageChops.multiply(), only the common part of the two images
+    # is handled if the sizes are different
+    height = min(photo_rgb.shape[0], mask_rgb.shape[0])
+    width = min(photo_rgb.shape[1], mask_rgb.shape[1])
+    photo_rgb = photo_rgb[:height, :width, :3]
+    mask_rgb = mask_rgb[:height, :width, :3]
+
+    # ImageChops.multiply() does (image1 * image2) / 255, with the result
+    # truncated to integer. 255 * 255 can still fit in uint16
+    multiplied = photo_rgb.astype(np.uint16)
+    multiplied *= mask_rgb
+    multiplied //= 255
+
+    rgba = np.empty((height, width, 4), dtype=np.uint8)
+    if soft_alpha:
+        rgba[:, :, :3] = photo_rgb
+        rgba[:, :, 3] = np.max(mask_rgb, axis=2)
+    else:
+        rgba[:, :, :3] = multiplied
+        rgba[:, :, 3] = 255
+
+    # To remove some quite dark edge around the meteor
+    transparent = np.all(multiplied < rgb_threshold, axis=2)
+    rgba[transparent] = (255, 255, 255, 0)
+
+    return rgba
+
+
+# The # of full size RGBA images held by one thread when extending the
+# objects to the full photo size: the extended image, the PIL image and
+# the labelled copy, plus one more for the conversions
+EXTENSION_IMAGES_PER_THREAD = 4
+
+
+# Not all cropped images will be divided to mosaic
+# Only when images which width >= 640 * 1.5
+#     settings.DETECTION_CROP_IMAGE_BOX_SIZE (640)
+#     settings.RATIO_FOR_MOSAIC (1.5)
+def is_mosaic_needed(orig_width):
+    target_width = settings.DETECTION_CROP_IMAGE_BOX_SIZE
+    return orig_width >= target_width * settings.RATIO_FOR_MOSAIC
+
+
+# The mosaic tiles of a big cropped image. Each tile is
+# settings.DETECTION_CROP_IMAGE_BOX_SIZE wide, overlapped by
+# settings.MOSAIC_OVERLAP_RATIO:
+#
+#    num_X ->
+#   -------------------
+#   |   |   |   |   | |
+#   |   |   |   |   | | num_Y |
+#   -------------------       V
+#   |   |   |   |   | |
+#   |   |   |   |   | |
+#   -------------------
+#   |   |   |   |   | |
+#   -------------------
+#
+# Returns (num_Y, num_X, tile list). Each tile is (i, j, x1, y1, x2, y2),
+# i and j are the row and the column
+def get_mosaic_tile_list(orig_width, orig_height):
+    target_width = settings.DETECTION_CROP_IMAGE_BOX_SIZE
+
+    # round up, like 3.2 => 4
+
+    # num_X = math.ceil(orig_width / target_width)
+    # num_Y = math.ceil(orig_height / target_width)
+
+    num_X_no_overlap = orig_width / target_width
+    num_Y_no_overlap = orig_height / target_width
+
+    overlap_ratio = settings.MOSAIC_OVERLAP_RATIO
+
+    num_X_w_overlap = math.ceil(
+        (num_X_no_overlap - overlap_ratio) / (1 - overlap_ratio)
+    )
+    num_Y_w_overlap = math.ceil(
+        (num_Y_no_overlap - overlap_ratio) / (1 - overlap_ratio)
+    )
+
+    tile_list = []
+
+    # for i in range(num_Y):
+    for i in range(num_Y_w_overlap):
+        y1 = int(target_width * (i - overlap_ratio * i))
+        y2 = y1 + target_width
+
+        if y2 >= orig_height:
+            # y2 = orig_height - 1
+            y2 = orig_height - 1
+            y1 = orig_height - target_width
+
+        for j in range(num_X_w_overlap):
+            x1 = int(target_width * (j - overlap_ratio * j))
+            x2 = x1 + target_width
+
+            if x2 >= orig_width:
+                # x2 = orig_width - 1
+                x2 = orig_width
+                x1 = orig_width - target_width
+
+            tile_list.append((i, j, x1, y1, x2, y2))
+
+    return num_Y_w_overlap, num_X_w_overlap, tile_list
+
+
+# The part added to the file name of a mosaic tile, like:
+#     IMG_3119_size_(05472,03648)_0001_pos_(02650,01938)_(03700,02988)_mosaic_(002,002)_(001,001).png
+def get_mosaic_name(num_Y, num_X, i, j):
+    return "_mosaic_({:03d},{:03d})_({:03d},{:03d})".format(num_Y, num_X, i + 1, j + 1)
+
+
+# The gray 256x256 image given to the UNET++, from a cropped image or a
+# mosaic tile (same as convert_image_folder_to_gray_256() does)
+def convert_image_to_gray_256(img):
+    if img.ndim == 2:
+        gray = img
+    elif img.shape[2] == 4:
+        gray = cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY)
+    else:
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    return cv2.resize(gray, (settings.UNET_IMAGE_SIZE, settings.UNET_IMAGE_SIZE))
+
+
+# The gray 256x256 image to the UNET++ input, (256, 256, 1) in float32
+# 0~1. Same as what unet_proc.testGenerator() gives from the image file
+def get_unet_input(gray_256):
+    max_value = 255.0
+    if gray_256.dtype == np.uint16:
+        max_value = 65535.0
+    return (gray_256.astype(np.float32) / max_value)[:, :, np.newaxis]
+
+
+# The UNET++ output (256, 256, 1) to an 8-bit mask, rounded the same way
+# as skimage's img_as_ubyte() used by unet_proc.saveResult_V2()
+def get_mask_from_unet_output(unet_output):
+    mask = np.rint(np.clip(unet_output[:, :, 0], 0, 1) * 255)
+    return mask.astype(np.uint8)
+
+
+# Puts the masks of the mosaic tiles back to one mask, in the size of the
+# cropped image. Each mask is resized back to the tile size first. Where the
+# tiles overlap, the brighter pixel is taken. This is the logical OR done by
+# mosaic_mask_files_merge_back(), without turning the mask to black / white
+def merge_mosaic_masks(mask_list, tile_list, orig_width, orig_height):
+    target_width = settings.DETECTION_CROP_IMAGE_BOX_SIZE
+
+    merged_mask = np.zeros((orig_height, orig_width), dtype=np.uint8)
+    for mask, (i, j, x1, y1, x2, y2) in zip(mask_list, tile_list):
+        mask = cv2.resize(mask, (target_width, target_width))
+
+        # Same position as the tile, except the last row: the tile is one
+        # pixel shorter there, but the mask is put back in the full size
+        area = merged_mask[y1 : y1 + target_width, x1 : x1 + target_width]
+        np.maximum(area, mask[: area.shape[0], : area.shape[1]], out=area)
+
+    return merged_mask
+
+
+# Prints the progress of the mask generation, as the masks are written batch
+# by batch. A line about every 10% (the GUI log can't overwrite a line)
+class MaskProgress:
+    def __init__(self, num_of_total, name="masks"):
+        self.Num_Of_Total = num_of_total
+        self.Name = name
+        self.Num_Of_Done = 0
+        self.Next_Report = 1
+        self.Start_Time = time.perf_counter()
+
+    def update(self, num_of_new):
+        self.Num_Of_Done += num_of_new
+        if self.Num_Of_Done < self.Next_Report and self.Num_Of_Done < self.Num_Of_Total:
+            return
+
+        used_time = time.perf_counter() - self.Start_Time
+        print(
+            "    {}/{} {} done ({:.0%}), {:.1f}s, {:.2f}/s".format(
+                self.Num_Of_Done,
+                self.Num_Of_Total,
+                self.Name,
+                self.Num_Of_Done / max(self.Num_Of_Total, 1),
+                used_time,
+                self.Num_Of_Done / max(used_time, 1e-6),
+            )
+        )
+        self.Next_Report = self.Num_Of_Done + max(self.Num_Of_Total // 10, 1)
+
+
 class Gen_mask:
     # Not all cropped images will be divided to mosaic
     # Only when images which width > 640 * 1.5
@@ -29,8 +243,6 @@ class Gen_mask:
         if not os.path.exists(save_dir):
             os.mkdir(save_dir)
 
-        target_width = settings.DETECTION_CROP_IMAGE_BOX_SIZE
-
         for image_file in image_list:
             filename_w_path = os.path.join(file_dir, image_file)
             filename_no_ext, file_ext = os.path.splitext(image_file)
@@ -44,79 +256,33 @@ class Gen_mask:
             orig_width = original_img.shape[1]
 
             # Normally this is >= 640 * 1.5
-            if orig_width >= target_width * settings.RATIO_FOR_MOSAIC:
+            if is_mosaic_needed(orig_width):
                 # Big image, let's do mosaic
-                #
-                #    num_X ->
-                #   -------------------
-                #   |   |   |   |   | |
-                #   |   |   |   |   | | num_Y |
-                #   -------------------       V
-                #   |   |   |   |   | |
-                #   |   |   |   |   | |
-                #   -------------------
-                #   |   |   |   |   | |
-                #   -------------------
-
-                # round up, like 3.2 => 4
-
-                # num_X = math.ceil(orig_width / target_width)
-                # num_Y = math.ceil(orig_height / target_width)
-
-                num_X_no_overlap = orig_width / target_width
-                num_Y_no_overlap = orig_height / target_width
-
-                overlap_ratio = settings.MOSAIC_OVERLAP_RATIO
-
-                num_X_w_overlap = math.ceil(
-                    (num_X_no_overlap - overlap_ratio) / (1 - overlap_ratio)
-                )
-                num_Y_w_overlap = math.ceil(
-                    (num_Y_no_overlap - overlap_ratio) / (1 - overlap_ratio)
-                )
+                num_Y, num_X, tile_list = get_mosaic_tile_list(orig_width, orig_height)
 
-                # for i in range(num_Y):
-                for i in range(num_Y_w_overlap):
-                    y1 = int(target_width * (i - overlap_ratio * i))
-                    y2 = y1 + target_width
-
-                    if y2 >= orig_height:
-                        # y2 = orig_height - 1
-                        y2 = orig_height - 1
-                        y1 = orig_height - target_width
-
-                    for j in range(num_X_w_overlap):
-                        x1 = int(target_width * (j - overlap_ratio * j))
-                        x2 = x1 + target_width
-
-                        if x2 >= orig_width:
-                            # x2 = orig_width - 1
-                            x2 = orig_width
-                            x1 = orig_width - target_width
-
-                        mosaic_img = original_img[y1:y2, x1:x2]
-                        file_to_save = (
-                            filename_no_ext
-                            + "_mosaic_({:03d},{:03d})_({:03d},{:03d})".format(
-                                num_Y_w_overlap, num_X_w_overlap, i + 1, j + 1
-                            )
-                            + file_ext
-                        )
+                for i, j, x1, y1, x2, y2 in tile_list:
+                    mosaic_img = original_img[y1:y2, x1:x2]
+                    file_to_save = (
+                        filename_no_ext + get_mosaic_name(num_Y, num_X, i, j) + file_ext
+                    )
 
-                        file_to_save = os.path.join(save_dir, file_to_save)
-                        # cv2.imwrite(file_to_save, mosaic_img)
-                        cv2.imencode(file_ext, mosaic_img)[1].tofile(file_to_save)
+                    file_to_save = os.path.join(save_dir, file_to_save)
+                    # cv2.imwrite(file_to_save, mosaic_img)
+                    output_writer.write_image(file_ext, mosaic_img, file_to_save)
 
             else:
                 # No need to do mosaic
                 # Just save the original image to the mosaic folder
                 file_to_save = os.path.join(save_dir, image_file)
                 # cv2.imwrite(file_to_save, original_img)
-                cv2.imencode(file_ext, original_img)[1].tofile(file_to_save)
+                output_writer.write_image(file_ext, original_img, file_to_save)
 
             # sleep(0.02)
         # End for-loop
 
+        # All the files need to be written before going to the next step
+        output_writer.flush()
+
     def __convert_image_to_gray_256(self, original_img):
         # img = Image.open(file_to_open).convert('L')
 
@@ -151,7 +317,7 @@ class Gen_mask:
         file_gray_256 = os.path.join(save_dir, file_gray_256)
 
         # cv2.imwrite(file_gray_256, gray_256)
-        cv2.imencode(file_ext, gray_256)[1].tofile(file_gray_256)
+        output_writer.write_image(file_ext, gray_256, file_gray_256)
 
     def convert_image_folder_to_gray_256(self, file_dir, save_dir):
         print("\nConverting the detected meteor images to gray 256x256 size ...")
@@ -165,6 +331,9 @@ class Gen_mask:
             self.__convert_image_file_to_gray_256(file_dir, image_file, save_dir)
             # sleep(0.2)
 
+        # All the files need to be written before going to the next step
+        output_writer.flush()
+
     # image_folder is the folder contains processed image, 256x256, gray
     def gen_meteor_mask_from_folder(self, image_folder, output_folder):
         print("\nGenerating mask from Unet ...")
@@ -172,17 +341,21 @@ class Gen_mask:
         if not os.path.exists(output_folder):
             os.mkdir(output_folder)
 
-        # The image size supported is (256, 256)
-        # unet_model = model.unet(input_size=(settings.UNET_IMAGE_SIZE, settings.UNET_IMAGE_SIZE, 1))
-        unet_model = model.unet_plus_plus(
-            input_size=(settings.UNET_IMAGE_SIZE, settings.UNET_IMAGE_SIZE, 1)
-        )
-        unet_model.load_weights(settings.UNET_SAVED_MODEL)
+        # The model is loaded only once in a session
+        unet_model = model_host.get_model(model_host.UNET_MODEL)
 
-        test_image_list = os.listdir(image_folder)
-        num_image = len(test_image_list)
+        test_file_list = unet_proc.get_test_file_list(image_folder)
+        if len(test_file_list) == 0:
+            return
 
-        testGene = unet_proc.testGenerator(image_folder, as_gray=True)
+        # The images are decoded in parallel, and predicted in batches
+        # (instead of testGenerator() giving one image at a time)
+        test_dataset = unet_proc.testDataset(
+            test_file_list,
+            batch_size=settings.UNET_BATCH_SIZE,
+            decode_threads=settings.UNET_DECODE_THREADS,
+            prefetch_batches=settings.UNET_PREFETCH_BATCHES,
+        )
 
         """
         test_datagen = ImageDataGenerator(rescale=1. / 255)
@@ -203,10 +376,34 @@ class Gen_mask:
 
         # 2021-7-22:
         # To align with TF2 API
-        results = unet_model.predict(testGene, num_image, verbose=1)
+        # results = unet_model.predict(testGene, num_image, verbose=1)
         # results = unet_model.predict_generator(test_generator, num_image, verbose=1)
 
-        unet_proc.saveResult_V2(output_folder, results, test_image_list)
+        # The batches are predicted one by one, and the masks of a batch are
+        # written as soon as it is done. Not to keep the results of all the
+        # images in memory (256x256 float32 each) until the end.
+        progress = MaskProgress(len(test_file_list))
+        num_of_done = 0
+        for batch in test_dataset:
+            results = np.asarray(unet_model.predict_on_batch(batch))
+
+            for filename_w_path, result in zip(
+                test_file_list[num_of_done : num_of_done + len(results)], results
+            ):
+                filename_no_ext = os.path.splitext(os.path.basename(filename_w_path))[0]
+
+                # Same file name and content as unet_proc.saveResult_V2()
+                file_to_save = filename_no_ext + "_mask.png"
+                file_to_save = os.path.join(output_folder, file_to_save)
+                output_writer.write_image(
+                    ".png", get_mask_from_unet_output(result), file_to_save
+                )
+
+            num_of_done += len(results)
+            progress.update(len(results))
+
+        # All the files need to be written before going to the next step
+        output_writer.flush()
 
     # The filename parm doesn't have path info, just pure file name
     # The file name would be like this:
@@ -257,6 +454,37 @@ class Gen_mask:
 
         return x, y
 
+    # The label printed near to the meteor object in the final image
+    #
+    # The file name would be like this:
+    #     ER4A3109_r_size_(05760,03840)_0001_pos_(02301,02327)_(02941,02967)_center_(02621,02647).png
+    #
+    # The label would be the short file name:
+    #     ER4A3109_r_0001
+    # And it is printed a little bit above the line center position
+    def get_label_info_from_file_name(self, filename):
+        string_to_match = "_center_("
+        str_pos = filename.find(string_to_match)
+
+        if str_pos > -1:
+            str_x_c = filename[str_pos + 9 : str_pos + 14]
+            str_y_c = filename[str_pos + 15 : str_pos + 20]
+
+            x_c = int(str_x_c)
+            y_c = int(str_y_c) - 16
+        else:
+            x_c = 0
+            y_c = 0
+
+        label_name = filename
+        string_to_match = "_pos_("
+        str_pos = filename.find(string_to_match)
+
+        if str_pos > -1:
+            label_name = filename[0 : str_pos - 24] + filename[str_pos - 5 : str_pos]
+
+        return label_name, x_c, y_c
+
     # This is to resize the 256x256 mask file back to its
     # original cropped XXX x XXX size. Still a small image
     # Not the original photo file size
@@ -326,9 +554,12 @@ class Gen_mask:
             file_to_save = os.path.join(save_dir, file_to_save)
 
             # cv2.imwrite(file_to_save, resized_img)
-            cv2.imencode(file_ext, resized_img)[1].tofile(file_to_save)
+            output_writer.write_image(file_ext, resized_img, file_to_save)
             # sleep(0.02)
 
+        # All the files need to be written before going to the next step
+        output_writer.flush()
+
     # After the masks are generated, and re-sized back (normally 640x640),
     # scan the ones from mosaic, and merge them back to one file
     # For images don't belong to mosaic, just save them to the new folder
@@ -449,7 +680,7 @@ class Gen_mask:
                 )
                 # file_to_save = image_file[0: str_pos_mosaic] + "_gray_mask"
                 file_to_save = os.path.join(save_dir, file_to_save)
-                img_mosaic.save(file_to_save, "PNG")
+                output_writer.save_pil_image(img_mosaic, file_to_save, "PNG")
 
                 # Done for this mosaic
                 # Need to skip (x*y-1) items
@@ -467,10 +698,228 @@ class Gen_mask:
             # sleep(0.02)
         # end of for-loop
 
+        # All the files need to be written before going to the next step
+        output_writer.flush()
+
+    # The mask generation in one go, in place of the 5 steps writing the
+    # images to the folders in between:
+    #     convert_cropped_image_folder_to_mosaic_for_big_files() -> 04_mosaic
+    #     convert_image_folder_to_gray_256()     -> 05_gray_256
+    #     gen_meteor_mask_from_folder()          -> 06_mask_256
+    #     resize_mask_to_original_cropped_size() -> 07_mask_resize_back
+    #     mosaic_mask_files_merge_back()         -> 08_mosaic_merged_back
+    #
+    # The cropped images are divided to mosaic tiles in memory. The tiles
+    # are predicted by the UNET++ in batches (settings.UNET_BATCH_SIZE), and
+    # the masks are put back with array operations. The positions are kept
+    # with the tiles, instead of being read back from the file names.
+    #
+    # Only the final masks are written to save_dir (08_mosaic_merged_back),
+    # with the same file names as before. With settings.MASK_DEBUG_DUMP, the
+    # images in between are also written, to the debug_dirs:
+    #     (04_mosaic, 05_gray_256, 06_mask_256, 07_mask_resize_back)
+    def gen_meteor_mask_from_cropped_folder(self, file_dir, save_dir, debug_dirs=None):
+        print("\nGenerating the masks from Unet ...")
+
+        image_list = filter_images(file_dir)
+
+        if not os.path.exists(save_dir):
+            os.mkdir(save_dir)
+
+        if not settings.MASK_DEBUG_DUMP:
+            debug_dirs = None
+        if debug_dirs is not None:
+            for debug_dir in debug_dirs:
+                if not os.path.exists(debug_dir):
+                    os.mkdir(debug_dir)
+
+        if len(image_list) == 0:
+            return
+
+        start_time = time.perf_counter()
+
+        # The model is loaded only once in a session
+        unet_model = model_host.get_model(model_host.UNET_MODEL)
+        batch_size = max(settings.UNET_BATCH_SIZE, 1)
+
+        # The tiles to be predicted: (cropped image mask, tile index, input)
+        pending_tiles = []
+        num_of_tiles = 0
+
+        # The masks are written as soon as all the tiles of a cropped image
+        # are predicted, so the progress is by the cropped images
+        progress = MaskProgress(len(image_list))
+
+        for image_file in image_list:
+            cropped_mask = self.__get_cropped_image_mask(
+                file_dir, image_file, debug_dirs
+            )
+
+            for index, unet_input in enumerate(cropped_mask["Inputs"]):
+                pending_tiles.append((cropped_mask, index, unet_input))
+                num_of_tiles += 1
+
+                if len(pending_tiles) >= batch_size:
+                    progress.update(
+                        self.__predict_mask_tiles(
+                            unet_model, pending_tiles, save_dir, debug_dirs
+                        )
+                    )
+                    pending_tiles = []
+
+            # Only the tiles are needed from now on
+            cropped_mask["Inputs"] = None
+
+        if len(pending_tiles) > 0:
+            progress.update(
+                self.__predict_mask_tiles(
+                    unet_model, pending_tiles, save_dir, debug_dirs
+                )
+            )
+
+        # All the files need to be written before going to the next step
+        output_writer.flush()
+
+        print(
+            "{} masks generated from {} tiles in {:.2f}s".format(
+                len(image_list), num_of_tiles, time.perf_counter() - start_time
+            )
+        )
+
+    # Reads a cropped image, and divides it to the mosaic tiles if it is big.
+    # Returns the info to generate its mask, with the UNET++ inputs of the
+    # tiles.
+    def __get_cropped_image_mask(self, file_dir, image_file, debug_dirs):
+        filename_w_path = os.path.join(file_dir, image_file)
+        filename_no_ext, file_ext = os.path.splitext(image_file)
+
+        original_img = cv2.imdecode(np.fromfile(filename_w_path, dtype=np.uint8), -1)
+        orig_height = original_img.shape[0]
+        orig_width = original_img.shape[1]
+
+        is_mosaic = is_mosaic_needed(orig_width)
+        if is_mosaic:
+            num_Y, num_X, tile_list = get_mosaic_tile_list(orig_width, orig_height)
+            tile_name_list = [
+                filename_no_ext + get_mosaic_name(num_Y, num_X, i, j)
+                for i, j, x1, y1, x2, y2 in tile_list
+            ]
+
+            # Normally it is settings.DETECTION_CROP_IMAGE_BOX_SIZE (640)
+            mask_width = settings.DETECTION_CROP_IMAGE_BOX_SIZE
+        else:
+            # The whole image as one tile
+            tile_list = [(0, 0, 0, 0, orig_width, orig_height)]
+            tile_name_list = [filename_no_ext]
+
+            # The mask is resized back to the cropped size. Same as
+            # resize_mask_to_original_cropped_size(), it is from the
+            # position info in the file name
+            x1, y1, x2, y2 = self.get_image_pos_from_file_name(image_file)
+            mask_width = abs(x2 - x1)
+            if mask_width == 0:
+                mask_width = orig_width
+
+        input_list = []
+        for tile_name, (i, j, x1, y1, x2, y2) in zip(tile_name_list, tile_list):
+            tile_img = original_img[y1:y2, x1:x2]
+            gray_256 = convert_image_to_gray_256(tile_img)
+            input_list.append(get_unet_input(gray_256))
+
+            if debug_dirs is not None:
+                output_writer.write_image(
+                    file_ext,
+                    tile_img,
+                    os.path.join(debug_dirs[0], tile_name + file_ext),
+                )
+                output_writer.write_image(
+                    file_ext,
+                    gray_256,
+                    os.path.join(debug_dirs[1], tile_name + "_gray_256" + file_ext),
+                )
+
+        return {
+            "Filename_No_Ext": filename_no_ext,
+            "Width": orig_width,
+            "Height": orig_height,
+            "Is_Mosaic": is_mosaic,
+            "Tiles": tile_list,
+            "Tile_Names": tile_name_list,
+            "Mask_Width": mask_width,
+            "Inputs": input_list,
+            "Masks": [None] * len(tile_list),
+            "Num_Of_Masks": 0,
+        }
+
+    # Returns the # of the cropped images whose masks are done
+    def __predict_mask_tiles(self, unet_model, pending_tiles, save_dir, debug_dirs):
+        batch = np.stack([unet_input for _, _, unet_input in pending_tiles])
+        unet_outputs = np.asarray(unet_model.predict_on_batch(batch))
+
+        num_of_saved = 0
+        for (cropped_mask, index, _), unet_output in zip(pending_tiles, unet_outputs):
+            cropped_mask["Masks"][index] = get_mask_from_unet_output(unet_output)
+            cropped_mask["Num_Of_Masks"] += 1
+
+            # All the tiles of the cropped image are done
+            if cropped_mask["Num_Of_Masks"] == len(cropped_mask["Tiles"]):
+                self.__save_cropped_image_mask(cropped_mask, save_dir, debug_dirs)
+                num_of_saved += 1
+
+        return num_of_saved
+
+    def __save_cropped_image_mask(self, cropped_mask, save_dir, debug_dirs):
+        mask_width = cropped_mask["Mask_Width"]
+
+        if debug_dirs is not None:
+            for tile_name, mask in zip(
+                cropped_mask["Tile_Names"], cropped_mask["Masks"]
+            ):
+                output_writer.write_image(
+                    ".png",
+                    mask,
+                    os.path.join(debug_dirs[2], tile_name + "_gray_256_mask.png"),
+                )
+                output_writer.write_image(
+                    ".png",
+                    cv2.cvtColor(
+                        cv2.resize(mask, (mask_width, mask_width)), cv2.COLOR_GRAY2BGR
+                    ),
+                    os.path.join(
+                        debug_dirs[3],
+                        tile_name + "_gray_256_mask_{}.png".format(mask_width),
+                    ),
+                )
+
+        if cropped_mask["Is_Mosaic"]:
+            final_mask = merge_mosaic_masks(
+                cropped_mask["Masks"],
+                cropped_mask["Tiles"],
+                cropped_mask["Width"],
+                cropped_mask["Height"],
+            )
+        else:
+            final_mask = cv2.resize(cropped_mask["Masks"][0], (mask_width, mask_width))
+
+        # Like:
+        #     IMG_3119_size_(05472,03648)_0001_pos_(02650,01938)_(03700,02988)_gray_256_mask_1050.png
+        # The mask is in 24-bit, to be used for extracting the meteor object
+        file_to_save = cropped_mask["Filename_No_Ext"] + "_gray_256_mask_{}.png".format(
+            mask_width
+        )
+        output_writer.write_image(
+            ".png",
+            cv2.cvtColor(final_mask, cv2.COLOR_GRAY2BGR),
+            os.path.join(save_dir, file_to_save),
+        )
+
+        # Release the masks of the tiles
+        cropped_mask["Masks"] = None
+
     def extract_meteor_from_cropped_file_with_mask(
         self, cropped_photo_file, mask_file, save_file
     ):
-        cropped_img = Image.open(cropped_photo_file)
+        cropped_img = np.asarray(Image.open(cropped_photo_file).convert("RGB"))
 
         # Need to be processed in color
         # The mask image has been changed to 24-bit
@@ -479,44 +928,17 @@ class Gen_mask:
         # 2021-7-9: Need to ensure the mask img format is in RGB
         # As we allow people to edit the mask file manually, sometimes
         # the edit s/w could save the file to RGBA format
-        mask_img = Image.open(mask_file).convert("RGB")
+        mask_img = np.asarray(Image.open(mask_file).convert("RGB"))
 
-        img_extract = ImageChops.multiply(cropped_img, mask_img)
-        img_extract = img_extract.convert("RGBA")
-        datas = img_extract.getdata()
-
-        newData = []
-        rgb_threshold = settings.EXTRACT_RGB_VALUE_THRESHOLD
-        for item in datas:
-            # if item[0] == 0 and item[1] == 0 and item[2] == 0:
-
-            # This still needs adjustment
-            # To remove some quite dark edge around the meteor
-            #
-            # Looks like currently 72 could be a reasonable
-            # threshold
-            #
-            # if item[0] < 8 and item[1] < 8 and item[2] < 8:
-            # if item[0] < 30 and item[1] < 30 and item[2] < 30:
-            # if item[0] < 80 and item[1] < 80 and item[2] < 80:
-            #
-            # if item[0] < 72 and item[1] < 72 and item[2] < 72:
-            # if item[0] < 30 and item[1] < 30 and item[2] < 30:
-            if (
-                item[0] < rgb_threshold
-                and item[1] < rgb_threshold
-                and item[2] < rgb_threshold
-            ):
-                newData.append((255, 255, 255, 0))
-            else:
-                newData.append(item)
-
-        img_extract.putdata(newData)
+        img_extract = extract_meteor_rgba_with_mask(
+            cropped_img, mask_img, soft_alpha=settings.EXTRACT_SOFT_ALPHA
+        )
+        img_extract = Image.fromarray(img_extract, "RGBA")
 
         # To be in PNG format
         # file_to_save = mask_filename_no_ext + '_transparent.png'
         # file_to_save = os.path.join(save_dir, file_to_save)
-        img_extract.save(save_file, "PNG")
+        output_writer.save_pil_image(img_extract, save_file, "PNG")
 
     # def extract_meteor_from_cropped_folder_with_mask(self, photo_dir, mask_dir, save_dir):
     # crop_dir: The cropped meteor objects photo folder. Normally it is the "2_extraction"
@@ -604,44 +1026,44 @@ class Gen_mask:
                     )
         # end for loop of the mask_list
 
+        # All the files need to be written before going to the next step
+        output_writer.flush()
+
     def extract_meteor_from_original_file_with_mask(
         self, original_photo_file, mask_file, save_file
     ):
-        original_img = Image.open(original_photo_file)
-
         # Need to get the position info from the mask file name
         x1, y1, x2, y2 = self.get_image_pos_from_file_name(mask_file)
-        # cropped_img = original_img[y1:y2, x1:x2]
-        cropped_img = original_img.crop((x1, y1, x2, y2))
+
+        my_frame_store = frame_store.get_frame_store()
+        if my_frame_store is not None:
+            # The decoded photo is already in the frame store (normally done
+            # in the detection step). Just take the area needed from the
+            # memory-mapped array, in RGB order.
+            original_img = my_frame_store.load(original_photo_file)
+            cropped_img = original_img[y1:y2, x1:x2, 2::-1]
+        else:
+            original_img = Image.open(original_photo_file)
+            # cropped_img = original_img[y1:y2, x1:x2]
+            cropped_img = np.asarray(
+                original_img.crop((x1, y1, x2, y2)).convert("RGB")
+            )
 
         # Need to be processed in color
         # The mask image has been changed to 24-bit
         # photo_img = ImageOps.grayscale(photo_img)
 
-        mask_img = Image.open(mask_file)
-
-        img_extract = ImageChops.multiply(cropped_img, mask_img)
-        img_extract = img_extract.convert("RGBA")
-        datas = img_extract.getdata()
-
-        newData = []
-        rgb_threshold = settings.EXTRACT_RGB_VALUE_THRESHOLD
-        for item in datas:
-            if (
-                item[0] < rgb_threshold
-                and item[1] < rgb_threshold
-                and item[2] < rgb_threshold
-            ):
-                newData.append((255, 255, 255, 0))
-            else:
-                newData.append(item)
+        mask_img = np.asarray(Image.open(mask_file).convert("RGB"))
 
-        img_extract.putdata(newData)
+        img_extract = extract_meteor_rgba_with_mask(
+            cropped_img, mask_img, soft_alpha=settings.EXTRACT_SOFT_ALPHA
+        )
+        img_extract = Image.fromarray(img_extract, "RGBA")
 
         # To be in PNG format
         # file_to_save = mask_filename_no_ext + '_transparent.png'
         # file_to_save = os.path.join(save_dir, file_to_save)
-        img_extract.save(save_file, "PNG")
+        output_writer.save_pil_image(img_extract, save_file, "PNG")
 
     # We may allow some process on the cropped image, like improving the contrast to make it better
     # to be process by the UNET network.
@@ -732,6 +1154,9 @@ class Gen_mask:
             # sleep(0.02)
         # end for loop of the mask_list
 
+        # All the files need to be written before going to the next step
+        output_writer.flush()
+
     # This extends the XXX x XXX extracted meteor objects png file to the original big
     # photo file size. Still in png format
     #
@@ -843,39 +1268,13 @@ class Gen_mask:
             file_to_save = os.path.join(save_dir, filename_to_save)
 
             # cv2.imwrite(file_to_save, extend_img, [cv2.IMWRITE_PNG_COMPRESSION, 3])
-            cv2.imencode(file_ext, extend_img, [cv2.IMWRITE_PNG_COMPRESSION, 3])[
-                1
-            ].tofile(file_to_save)
+            output_writer.write_image(
+                file_ext, extend_img, file_to_save, [cv2.IMWRITE_PNG_COMPRESSION, 3]
+            )
 
             # 2020-7-4:
             # Add the file name as the label to the image, and save to another location
-            string_to_match = "_center_("
-            str_pos = image_file.find(string_to_match)
-
-            if str_pos > -1:
-                str_x_c = image_file[str_pos + 9 : str_pos + 14]
-                str_y_c = image_file[str_pos + 15 : str_pos + 20]
-
-                x_c = int(str_x_c)
-                y_c = int(str_y_c) - 16
-            else:
-                x_c = 0
-                y_c = 0
-
-            # Get the short file name.
-            # The file name would be:
-            #     ER4A3109_r_size_(05760,03840)_0001_pos_(02301,02327)_(02941,02967).png
-            #
-            # The short file name would be:
-            #     ER4A3109_r_0001
-            label_name = image_file
-            string_to_match = "_pos_("
-            str_pos = image_file.find(string_to_match)
-
-            if str_pos > -1:
-                label_name = (
-                    image_file[0 : str_pos - 24] + image_file[str_pos - 5 : str_pos]
-                )
+            label_name, x_c, y_c = self.get_label_info_from_file_name(image_file)
 
             im_rgb = cv2.cvtColor(extend_img, cv2.COLOR_BGRA2RGBA)
             pil_im = Image.fromarray(im_rgb)
@@ -896,7 +1295,7 @@ class Gen_mask:
             """
             file_to_save = os.path.join(label_save_dir, filename_to_save)
 
-            pil_im.save(file_to_save, "PNG")
+            output_writer.save_pil_image(pil_im, file_to_save, "PNG")
             # cv2_im_processed = cv2.cvtColor(np.array(pil_im), cv2.COLOR_RGB2BGR)
             # cv2.imwrite(file_to_save, cv2_im_processed, [cv2.IMWRITE_PNG_COMPRESSION, 3])
 
@@ -934,13 +1333,31 @@ class Gen_mask:
             if any(fn.endswith(ext) for ext in included_extensions)
         ]
 
-        CPU_count = multiprocessing.cpu_count()
-
         # Add some restriction to avoid out of memory
         # if CPU_count > 8:
         #     CPU_count = 8
-        if CPU_count > settings.MAX_CPU_FOR_MASK_EXTRACTION:
-            CPU_count = settings.MAX_CPU_FOR_MASK_EXTRACTION
+        #
+        # The # of threads is decided by the memory needed for the full size
+        # images (from the photo size in the file name), and the memory
+        # available
+        image_bytes = 0
+        if len(image_list) > 0:
+            image_bytes = self.__get_extension_memory_bytes(image_list[0]) or 0
+
+        # The images waiting in the output writer queue
+        shared_bytes = (
+            image_bytes
+            // EXTENSION_IMAGES_PER_THREAD
+            * (settings.OUTPUT_WRITER_QUEUE_SIZE + settings.OUTPUT_WRITER_WORKERS)
+        )
+
+        CPU_count, admission_budget_bytes = memory_budget.get_worker_count(
+            settings.MAX_CPU_FOR_MASK_EXTRACTION,
+            image_bytes,
+            shared_bytes,
+            name="Extraction",
+        )
+        memory_budget.set_memory_budget(admission_budget_bytes, image_bytes)
 
         num_image_list = len(image_list)
 
@@ -986,7 +1403,7 @@ class Gen_mask:
 
             thread_set.append(
                 threading.Thread(
-                    target=self.extend_extracted_objects_to_original_photo_size,
+                    target=self.__extend_extracted_objects_with_memory_budget,
                     args=(
                         file_dir,
                         save_dir,
@@ -1006,8 +1423,34 @@ class Gen_mask:
         for thread_process in thread_set:
             thread_process.join()
 
+        # All the files need to be written before going to the next step
+        output_writer.flush()
+
+        if memory_budget.get_memory_budget() is not None:
+            print(memory_budget.get_memory_budget().get_stats_string())
+            memory_budget.set_memory_budget(None)
+
         print("\nMulti-thread process done !")
 
+    # Same as extend_extracted_objects_to_original_photo_size(), but waits
+    # before each image if the other threads are using up the memory budget
+    def __extend_extracted_objects_with_memory_budget(
+        self, file_dir, save_dir, label_save_dir, selected_image_list, verbose
+    ):
+        for image_file in selected_image_list:
+            with memory_budget.admit(self.__get_extension_memory_bytes(image_file)):
+                self.extend_extracted_objects_to_original_photo_size(
+                    file_dir, save_dir, label_save_dir, [image_file], verbose
+                )
+
+    # The memory needed to extend one object image to the full photo size.
+    # None means the same as the first image (if the size is not known)
+    def __get_extension_memory_bytes(self, image_file):
+        target_width, target_height = self.get_image_size_from_file_name(image_file)
+        if target_width == 0 or target_height == 0:
+            return None
+        return target_width * target_height * 4 * EXTENSION_IMAGES_PER_THREAD
+
     # Sometimes the final combined image would still contain some objects we don't want.
     # Like satellites (escaped from recognition), or a few meteors we don't want.
     #
@@ -1095,9 +1538,12 @@ class Gen_mask:
             draw.text((x_c, y_c), label_name, fill=(0, 255, 255), font=ttFont)
 
             file_to_save = os.path.join(save_dir, image_file)
-            im.save(file_to_save, "PNG")
+            output_writer.save_pil_image(im, file_to_save, "PNG")
         # end for loop
 
+        # All the files need to be written before going to the next step
+        output_writer.flush()
+
     def combine_meteor_images_to_one(
         self, meteor_dir, save_dir, specified_filename="final.png", verbose=1
     ):
@@ -1155,3 +1601,102 @@ class Gen_mask:
         file_to_save = os.path.join(save_dir, file_to_save)
 
         combined_img.save(file_to_save, "PNG")
+
+    # Combine the extracted meteor objects (normally in the '09_object_extracted'
+    # folder) to one final image directly.
+    #
+    # Each extracted object is kept as a small layer with its position in the
+    # original photo (from the file name), and blended to one canvas. So there's
+    # no need to extend every object to the full photo size first.
+    #
+    # The full size file for each object (the '10_FINAL' and '10_FINAL_w_label'
+    # folders) is only generated when "save_full_size_files" is True. This can
+    # be useful if you want to check which object to be excluded.
+    #
+    # blend_mode: "alpha" (same as before), "lighten" or "max"
+    def combine_extracted_objects_to_one(
+        self,
+        file_dir,
+        save_dir,
+        full_size_dir=None,
+        full_size_w_label_dir=None,
+        blend_mode=None,
+        save_full_size_files=None,
+        verbose=1,
+    ):
+        print("\nCombining the extracted meteor objects to one ...")
+        included_extensions = [
+            "jpg",
+            "JPG",
+            "jpeg",
+            "JPEG",
+            "bmp",
+            "BMP",
+            "png",
+            "PNG",
+            "tif",
+            "TIF",
+            "tiff",
+            "TIFF",
+        ]
+
+        if blend_mode is None:
+            blend_mode = settings.FINAL_COMBINE_BLEND_MODE
+
+        if save_full_size_files is None:
+            save_full_size_files = settings.FINAL_SAVE_FULL_SIZE_OBJECT_FILES
+
+        if not os.path.exists(save_dir):
+            os.mkdir(save_dir)
+
+        image_list = [
+            fn
+            for fn in os.listdir(file_dir)
+            if any(fn.endswith(ext) for ext in included_extensions)
+        ]
+        image_list.sort()
+
+        if len(image_list) == 0:
+            print("No image file in folder {}".format(file_dir))
+            return
+
+        # All the objects should come from photos with the same size
+        target_width, target_height = self.get_image_size_from_file_name(
+            image_list[0]
+        )
+        my_compositor = compositor.MeteorCompositor(
+            target_width, target_height, blend_mode=blend_mode
+        )
+
+        label_list = []
+
+        for image_file in image_list:
+            if verbose:
+                print("... Merging {} ...".format(image_file))
+            filename_w_path = os.path.join(file_dir, image_file)
+
+            x1, y1, x2, y2 = self.get_image_pos_from_file_name(image_file)
+            layer = np.asarray(Image.open(filename_w_path).convert("RGBA"))
+            my_compositor.add_layer(layer, x1, y1)
+
+            label_list.append(self.get_label_info_from_file_name(image_file))
+
+        combined_img = Image.fromarray(my_compositor.get_canvas(), "RGBA")
+        combined_img.save(os.path.join(save_dir, "final.png"), "PNG")
+
+        # The labels are printed to a copy of the combined image directly
+        try:
+            ttFont = ImageFont.truetype("arial.ttf", 16)
+        except Exception:
+            ttFont = ImageFont.load_default()
+
+        draw = ImageDraw.Draw(combined_img)
+        for label_name, x_c, y_c in label_list:
+            draw.text((x_c, y_c), label_name, fill=(0, 255, 255), font=ttFont)
+
+        combined_img.save(os.path.join(save_dir, "final_w_label.png"), "PNG")
+
+        if save_full_size_files and full_size_dir and full_size_w_label_dir:
+            self.extend_extracted_objects_to_original_photo_size_by_multi_threading(
+                file_dir, full_size_dir, full_size_w_label_dir, verbose=verbose
+            )
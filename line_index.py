@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import math
+
+
+def get_line_angle(x1, y1, x2, y2):
+    angle = math.atan2((y2 - y1), (x2 - x1))
+
+    # To ensure the angle range is (-pi/2, pi/2)
+    if angle > math.pi / 2:
+        angle = angle - math.pi
+    if angle < -math.pi / 2:
+        angle = math.pi + angle
+
+    return angle
+
+
+# A grid index of the detected lines, to find out the lines that could
+# belong to the same object as a given line, without comparing it with
+# every other line.
+#
+# The lines are put into grid cells keyed by (x cell, y cell, angle bucket):
+# - The cell size is the distance threshold. A line is put to all the cells
+#   covered by its bounding box. The distance used for the merging is
+#   between two corners of the lines' bounding boxes, so a line too far
+#   away would never be in the cells around the bounding box of the given
+#   line. (The mid point cannot be used for this, a long line could have
+#   its mid point far away from the other line)
+# - The angle buckets are at least as wide as the angle threshold, so the
+#   lines with similar angles are in the same or the adjacent buckets.
+#   The angle is circular: -pi/2 and pi/2 are the same direction.
+#
+# When include_overlap is True, the lines which have the x or y range
+# overlapped with the given line are returned as well, no matter how far
+# away they are. The overlapped lines can be merged without checking the
+# distance (see __decide_if_two_lines_should_belong_to_the_same_object())
+#
+# The index only gives the candidates. The final decision still needs to
+# be done by the same checking as before, so the result is identical.
+class LineIndex:
+    def __init__(self, lines, distance_threshold, angle_threshold, include_overlap):
+        self.Cell_Size = max(distance_threshold, 1)
+        self.Distance_Threshold = distance_threshold
+        self.Include_Overlap = include_overlap
+
+        # The buckets are made a little bit wider than the threshold, to
+        # avoid two lines at exactly the threshold to be two buckets away
+        # due to the float rounding
+        self.Num_Of_Angle_Buckets = max(int(math.pi / angle_threshold - 1e-6), 1)
+        self.Angle_Bucket_Size = math.pi / self.Num_Of_Angle_Buckets
+
+        self.Grid = {}
+        self.X_Strips = {}
+        self.Y_Strips = {}
+
+        # Each line is in the format of [x1, y1, x2, y2, ...]
+        for index, line in enumerate(lines):
+            x1, y1, x2, y2 = [int(v) for v in line[0:4]]
+            bucket = self.__get_angle_bucket(get_line_angle(x1, y1, x2, y2))
+
+            cx1, cx2 = self.__get_cell(min(x1, x2)), self.__get_cell(max(x1, x2))
+            cy1, cy2 = self.__get_cell(min(y1, y2)), self.__get_cell(max(y1, y2))
+
+            for cx in range(cx1, cx2 + 1):
+                for cy in range(cy1, cy2 + 1):
+                    self.Grid.setdefault((cx, cy, bucket), []).append(index)
+
+            if self.Include_Overlap:
+                for cx in range(cx1, cx2 + 1):
+                    self.X_Strips.setdefault((cx, bucket), []).append(index)
+                for cy in range(cy1, cy2 + 1):
+                    self.Y_Strips.setdefault((cy, bucket), []).append(index)
+
+    def __get_cell(self, value):
+        return int(math.floor(value / self.Cell_Size))
+
+    def __get_angle_bucket(self, angle):
+        bucket = int((angle + math.pi / 2) / self.Angle_Bucket_Size)
+        return min(max(bucket, 0), self.Num_Of_Angle_Buckets - 1)
+
+    def __get_nearby_angle_buckets(self, angle):
+        if self.Num_Of_Angle_Buckets <= 3:
+            return range(self.Num_Of_Angle_Buckets)
+
+        bucket = self.__get_angle_bucket(angle)
+        return [
+            (bucket - 1) % self.Num_Of_Angle_Buckets,
+            bucket,
+            (bucket + 1) % self.Num_Of_Angle_Buckets,
+        ]
+
+    # Returns the indexes (sorted, >= min_index) of the lines that need to
+    # be compared with the given line
+    def get_candidates(self, x1, y1, x2, y2, min_index=0):
+        x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+        buckets = self.__get_nearby_angle_buckets(get_line_angle(x1, y1, x2, y2))
+
+        cx1 = self.__get_cell(min(x1, x2) - self.Distance_Threshold)
+        cx2 = self.__get_cell(max(x1, x2) + self.Distance_Threshold)
+        cy1 = self.__get_cell(min(y1, y2) - self.Distance_Threshold)
+        cy2 = self.__get_cell(max(y1, y2) + self.Distance_Threshold)
+
+        candidates = set()
+        for bucket in buckets:
+            for cx in range(cx1, cx2 + 1):
+                for cy in range(cy1, cy2 + 1):
+                    candidates.update(self.Grid.get((cx, cy, bucket), []))
+
+            if self.Include_Overlap:
+                for cx in range(
+                    self.__get_cell(min(x1, x2)), self.__get_cell(max(x1, x2)) + 1
+                ):
+                    candidates.update(self.X_Strips.get((cx, bucket), []))
+                for cy in range(
+                    self.__get_cell(min(y1, y2)), self.__get_cell(max(y1, y2)) + 1
+                ):
+                    candidates.update(self.Y_Strips.get((cy, bucket), []))
+
+        return sorted(index for index in candidates if index >= min_index)
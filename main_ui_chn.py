@@ -126,6 +126,14 @@ class Ui_MainWindow(object):
         self.isEQmountCheckBox.setStyleSheet("color: rgb(255, 108, 0);")
         self.isEQmountCheckBox.setObjectName("isEQmountCheckBox")
         self.verticalLayout.addWidget(self.isEQmountCheckBox)
+        self.useProcessCheckBox = QtWidgets.QCheckBox(self.groupBox)
+        font = QtGui.QFont()
+        font.setFamily("微软雅黑")
+        font.setPointSize(10)
+        self.useProcessCheckBox.setFont(font)
+        self.useProcessCheckBox.setStyleSheet("color: rgb(255, 108, 0);")
+        self.useProcessCheckBox.setObjectName("useProcessCheckBox")
+        self.verticalLayout.addWidget(self.useProcessCheckBox)
         self.label_15 = QtWidgets.QLabel(self.groupBox)
         font = QtGui.QFont()
         font.setFamily("微软雅黑")
@@ -423,6 +431,9 @@ class Ui_MainWindow(object):
         self.isEQmountCheckBox.setText(
             _translate("MainWindow", " 使用了赤道仪跟踪拍摄")
         )
+        self.useProcessCheckBox.setText(
+            _translate("MainWindow", " 使用多进程检测（多核CPU更快）")
+        )
         self.label_15.setText(_translate("MainWindow", "解释："))
         self.label_16.setText(
             _translate(
@@ -104,6 +104,13 @@ class Ui_MainWindow(object):
         self.isEQmountCheckBox.setStyleSheet("color: rgb(255, 108, 0);")
         self.isEQmountCheckBox.setObjectName("isEQmountCheckBox")
         self.verticalLayout.addWidget(self.isEQmountCheckBox)
+        self.useProcessCheckBox = QtWidgets.QCheckBox(self.groupBox)
+        font = QtGui.QFont()
+        font.setFamily("Arial")
+        self.useProcessCheckBox.setFont(font)
+        self.useProcessCheckBox.setStyleSheet("color: rgb(255, 108, 0);")
+        self.useProcessCheckBox.setObjectName("useProcessCheckBox")
+        self.verticalLayout.addWidget(self.useProcessCheckBox)
         self.label_15 = QtWidgets.QLabel(self.groupBox)
         font = QtGui.QFont()
         font.setFamily("Arial")
@@ -380,6 +387,11 @@ class Ui_MainWindow(object):
         self.isEQmountCheckBox.setText(
             _translate("MainWindow", " Taken on equatorial mount")
         )
+        self.useProcessCheckBox.setText(
+            _translate(
+                "MainWindow", " Use multiple processes (faster on many-core CPUs)"
+            )
+        )
         self.label_15.setText(_translate("MainWindow", "Note:"))
         self.label_16.setText(
             _translate(
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import ctypes
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from PIL import Image
+
+import settings
+from frame_store import load_frame
+
+# psutil is optional. Without it the available memory is read from the
+# system in other ways (see get_available_memory()).
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+GB = 1024 * 1024 * 1024
+MB = 1024 * 1024
+
+
+def _get_available_memory_from_proc():
+    with open("/proc/meminfo", "r") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def _get_available_memory_on_windows():
+    class MEMORYSTATUSEX(ctypes.Structure):
+        _fields_ = [
+            ("dwLength", ctypes.c_ulong),
+            ("dwMemoryLoad", ctypes.c_ulong),
+            ("ullTotalPhys", ctypes.c_ulonglong),
+            ("ullAvailPhys", ctypes.c_ulonglong),
+            ("ullTotalPageFile", ctypes.c_ulonglong),
+            ("ullAvailPageFile", ctypes.c_ulonglong),
+            ("ullTotalVirtual", ctypes.c_ulonglong),
+            ("ullAvailVirtual", ctypes.c_ulonglong),
+            ("ullAvailExtendedVirtual", ctypes.c_ulonglong),
+        ]
+
+    status = MEMORYSTATUSEX()
+    status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+    if not ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+        return None
+    return status.ullAvailPhys
+
+
+# Returns the available physical memory in bytes, or None if it cannot
+# be found out
+def get_available_memory():
+    if psutil is not None:
+        return psutil.virtual_memory().available
+
+    try:
+        if sys.platform == "win32":
+            return _get_available_memory_on_windows()
+        if os.path.exists("/proc/meminfo"):
+            return _get_available_memory_from_proc()
+
+        # Other Unix systems (macOS ...). Free pages only, so a bit less
+        # than what is really available
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# The memory that can be used by the processing, in bytes.
+# None if the available memory is unknown and no budget is set.
+def get_memory_budget_bytes():
+    if settings.MEMORY_BUDGET_GB > 0:
+        return int(settings.MEMORY_BUDGET_GB * GB)
+
+    available_memory = get_available_memory()
+    if available_memory is None:
+        return None
+    return int(available_memory * settings.MEMORY_BUDGET_RATIO)
+
+
+# Returns the size in bytes of one frame loaded for the detection.
+# Only the file header is read if possible. The frames are loaded as
+# 3 channels (BGR).
+#
+# For the files not supported by PIL (RAW files ...), the file needs to be
+# decoded. If decode_if_needed is False, None is returned instead.
+def get_frame_bytes(filename_w_path, decode_if_needed=True):
+    try:
+        with Image.open(filename_w_path) as img:
+            width, height = img.size
+            bytes_per_channel = 2 if img.mode in ["I;16", "I;16B", "I", "F"] else 1
+        return width * height * 3 * bytes_per_channel
+    except Exception:
+        if not decode_if_needed:
+            return None
+        return load_frame(filename_w_path).nbytes
+
+
+# The # of workers (threads or processes) to run at the same time:
+# - At most the # of CPU cores, and max_workers if it is > 0
+# - Each worker needs worker_bytes of memory. Plus the shared_bytes used
+#   no matter how many workers there are (like the output queue)
+#
+# The memory left after the workers are counted is used for the admission
+# control. Returns (# of workers, admission budget in bytes or None)
+def get_worker_count(max_workers, worker_bytes, shared_bytes=0, name=""):
+    num_of_workers = multiprocessing.cpu_count()
+    if max_workers > 0:
+        num_of_workers = min(num_of_workers, max_workers)
+
+    budget_bytes = get_memory_budget_bytes()
+    if budget_bytes is None:
+        print("{}: available memory unknown, {} workers".format(name, num_of_workers))
+        return num_of_workers, None
+
+    num_of_workers_by_memory = int(
+        (budget_bytes - shared_bytes) // max(worker_bytes, 1)
+    )
+    num_of_workers = max(min(num_of_workers, num_of_workers_by_memory), 1)
+
+    print(
+        "{}: memory budget {:.1f}GB, about {:.0f}MB for each worker, {} workers".format(
+            name, budget_bytes / GB, worker_bytes / MB, num_of_workers
+        )
+    )
+    return num_of_workers, max(budget_bytes - shared_bytes, 0)
+
+
+# Admission control: before a worker starts a frame, the memory it would
+# need is taken from the budget, and given back when the frame is done.
+# If the budget would be exceeded, the worker waits for the others.
+#
+# A frame is always started if no other frame is in progress, so a budget
+# too small (or a frame too big) never blocks the processing.
+#
+# frame_bytes is the memory needed by a frame if not given to admit()
+class MemoryBudget:
+    def __init__(self, budget_bytes, frame_bytes=0):
+        self.Budget_Bytes = budget_bytes
+        self.Frame_Bytes = frame_bytes
+        self.Used_Bytes = 0
+        self.Num_Of_Frames_In_Progress = 0
+        self.Condition = threading.Condition()
+
+        # Statistics
+        self.Num_Of_Waits = 0
+        self.Wait_Time = 0.0
+
+    def acquire(self, num_of_bytes):
+        with self.Condition:
+            if not self.__can_start(num_of_bytes):
+                self.Num_Of_Waits += 1
+                start_time = time.perf_counter()
+                while not self.__can_start(num_of_bytes):
+                    self.Condition.wait()
+                self.Wait_Time += time.perf_counter() - start_time
+
+            self.Used_Bytes += num_of_bytes
+            self.Num_Of_Frames_In_Progress += 1
+
+    def release(self, num_of_bytes):
+        with self.Condition:
+            self.Used_Bytes -= num_of_bytes
+            self.Num_Of_Frames_In_Progress -= 1
+            self.Condition.notify_all()
+
+    def __can_start(self, num_of_bytes):
+        return (
+            self.Num_Of_Frames_In_Progress == 0
+            or self.Used_Bytes + num_of_bytes <= self.Budget_Bytes
+        )
+
+    @contextlib.contextmanager
+    def admit(self, num_of_bytes=None):
+        if num_of_bytes is None:
+            num_of_bytes = self.Frame_Bytes
+
+        self.acquire(num_of_bytes)
+        try:
+            yield
+        finally:
+            self.release(num_of_bytes)
+
+    def get_stats_string(self):
+        return "Memory budget {:.1f}GB: waited {} times, {:.2f}s in total".format(
+            self.Budget_Bytes / GB, self.Num_Of_Waits, self.Wait_Time
+        )
+
+
+_memory_budget = None
+
+
+# Set the budget for the admission control of the coming processing.
+# None means no admission control.
+def set_memory_budget(budget_bytes, frame_bytes=0):
+    global _memory_budget
+
+    if budget_bytes is None:
+        _memory_budget = None
+    else:
+        _memory_budget = MemoryBudget(budget_bytes, frame_bytes)
+    return _memory_budget
+
+
+def get_memory_budget():
+    return _memory_budget
+
+
+# Used as "with memory_budget.admit(num_of_bytes):" around the processing
+# of one frame. Does nothing if no budget is set.
+@contextlib.contextmanager
+def admit(num_of_bytes=None):
+    memory_budget = _memory_budget
+    if memory_budget is None:
+        yield
+        return
+
+    with memory_budget.admit(num_of_bytes):
+        yield
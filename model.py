@@ -550,6 +550,52 @@ def cnn_11(input_size=(256, 256, 3)):
     return model
 
 
+# The same convolution layers as cnn_11, with a light classifier head.
+#
+# cnn_11 flattens the 16x16x512 feature map into Dense(1024), which is
+# about 134M parameters, most of the size of the model. Here the feature
+# map is reduced by a global average pooling instead, so the head is only
+# ~33K parameters.
+#
+# As the convolution layers are the same, they can be initialized from
+# the cnn_11 weights when training (see train_cnn.py).
+def cnn_11_gap(input_size=(256, 256, 3)):
+    model = keras.Sequential()
+
+    model.add(
+        Conv2D(64, (3, 3), activation="relu", padding="same", input_shape=input_size)
+    )
+    model.add(Conv2D(64, (3, 3), activation="relu", padding="same"))
+    model.add(MaxPooling2D(pool_size=(2, 2), strides=(2, 2)))
+
+    model.add(Conv2D(128, (3, 3), activation="relu", padding="same"))
+    model.add(Conv2D(128, (3, 3), activation="relu", padding="same"))
+    model.add(MaxPooling2D(pool_size=(2, 2), strides=(2, 2)))
+
+    model.add(Conv2D(256, (3, 3), activation="relu", padding="same"))
+    model.add(Conv2D(256, (3, 3), activation="relu", padding="same"))
+
+    model.add(Conv2D(256, (3, 3), activation="relu", padding="same"))
+    model.add(Conv2D(256, (3, 3), activation="relu", padding="same"))
+    model.add(MaxPooling2D(pool_size=(2, 2), strides=(2, 2)))
+
+    model.add(Conv2D(512, (3, 3), activation="relu", padding="same"))
+    model.add(Conv2D(512, (3, 3), activation="relu", padding="same"))
+    model.add(Conv2D(512, (3, 3), activation="relu", padding="same"))
+    model.add(Conv2D(512, (3, 3), activation="relu", padding="same"))
+    model.add(MaxPooling2D(pool_size=(2, 2), strides=(2, 2)))
+
+    model.add(GlobalAveragePooling2D())
+    model.add(Dropout(0.25))
+
+    model.add(Dense(64, activation="relu"))
+    model.add(Dropout(0.25))
+
+    model.add(Dense(2, activation="sigmoid"))
+
+    return model
+
+
 # if __name__ == "__main__":
 #    model = unet(input_size=(640, 640, 3))
 #    model.summary()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# Export of the models (the CNN and the UNET++) to TensorFlow Lite, for a
+# faster inference on CPU (settings.INFERENCE_BACKEND = "tflite").
+#
+# The weights can be stored as:
+# - fp32: no quantization
+# - fp16: half precision, half the size of the file
+# - int8: 8-bit weights (dynamic range quantization), a quarter of the
+#         size. The calculation is still done in float, so no calibration
+#         data is needed
+#
+# The exported file is put next to the Keras weights file, like
+# "xxxx.hdf5" -> "xxxx_fp16.tflite"
+#
+# Before switching to TFLite, check the results are still good enough
+# with check_inference_accuracy.py
+#
+# Usage:
+#     python model_export.py <cnn|unet|all> [fp32|fp16|int8]
+import multiprocessing
+import os
+import sys
+import threading
+
+import numpy as np
+
+import settings
+
+QUANTIZATION_TYPES = ["fp32", "fp16", "int8"]
+
+
+# The LiteRT package replaces tf.lite.Interpreter in the newer TensorFlow.
+# It is optional.
+#
+# TensorFlow is imported only when it is needed, as it takes seconds.
+# The model host imports this module to find the model files.
+def get_interpreter_class():
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+
+        Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+def get_tflite_model_file(weights_file, quantization):
+    return "{}_{}.tflite".format(os.path.splitext(weights_file)[0], quantization)
+
+
+def export_tflite_model(keras_model, tflite_model_file, quantization="fp16"):
+    if quantization not in QUANTIZATION_TYPES:
+        raise ValueError("Unknown quantization: {}".format(quantization))
+
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    if quantization == "fp16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    tflite_model = converter.convert()
+
+    # Write to a temp file first, so that a half-written file would
+    # never be loaded
+    temp_file = tflite_model_file + ".tmp"
+    with open(temp_file, "wb") as f:
+        f.write(tflite_model)
+    os.replace(temp_file, tflite_model_file)
+
+
+# A TFLite model which can be used in place of the Keras model for the
+# prediction: predict() and predict_on_batch().
+#
+# The interpreter cannot be used by two threads at the same time, so the
+# calls are serialized.
+class TFLiteModel:
+    def __init__(self, tflite_model_file, num_threads=0):
+        if num_threads <= 0:
+            num_threads = multiprocessing.cpu_count()
+
+        self.Model_File = tflite_model_file
+        self.Interpreter = get_interpreter_class()(
+            model_path=tflite_model_file, num_threads=num_threads
+        )
+        self.Input_Index = self.Interpreter.get_input_details()[0]["index"]
+        self.Output_Index = self.Interpreter.get_output_details()[0]["index"]
+        self.Batch_Size = None
+        self.Lock = threading.Lock()
+
+    def predict_on_batch(self, x):
+        x = np.asarray(x, dtype=np.float32)
+
+        with self.Lock:
+            # The input shape is changed only when the batch size changes
+            if self.Batch_Size != x.shape[0]:
+                self.Interpreter.resize_tensor_input(self.Input_Index, x.shape)
+                self.Interpreter.allocate_tensors()
+                self.Batch_Size = x.shape[0]
+
+            self.Interpreter.set_tensor(self.Input_Index, x)
+            self.Interpreter.invoke()
+            return self.Interpreter.get_tensor(self.Output_Index).copy()
+
+    # Same as the Keras predict(). x can be an array (predicted in batches
+    # of batch_size), a tf.data.Dataset or a generator of batches (like
+    # unet_proc.testGenerator(), which gives (batch,)). At most "steps"
+    # batches are taken from a dataset / generator.
+    def predict(self, x, batch_size=None, verbose=0, steps=None):
+        if isinstance(x, np.ndarray):
+            batch_size = batch_size or 32
+            x = [x[i : i + batch_size] for i in range(0, len(x), batch_size)]
+
+        results = []
+        for batch in x:
+            if steps is not None and len(results) >= steps:
+                break
+            if isinstance(batch, tuple):
+                batch = batch[0]
+
+            results.append(self.predict_on_batch(batch))
+            if verbose:
+                print("\r{} batches predicted".format(len(results)), end="")
+
+        if verbose:
+            print()
+        if len(results) == 0:
+            return np.zeros((0,))
+        return np.concatenate(results)
+
+
+if __name__ == "__main__":
+    # Imported here, so that the model host can import this module
+    import model_host
+
+    argv = sys.argv[1:]
+    if len(argv) < 1 or argv[0] not in ["cnn", "unet", "all"]:
+        print("\nUsage: model_export <cnn|unet|all> [fp32|fp16|int8]")
+        print("    The default quantization is settings.INFERENCE_TFLITE_QUANTIZATION")
+        sys.exit(1)
+
+    quantization = settings.INFERENCE_TFLITE_QUANTIZATION
+    if len(argv) > 1:
+        quantization = argv[1]
+    if quantization not in QUANTIZATION_TYPES:
+        print("Unknown quantization: {}".format(quantization))
+        sys.exit(1)
+
+    model_names = [argv[0]]
+    if argv[0] == "all":
+        model_names = [model_host.CNN_MODEL, model_host.UNET_MODEL]
+
+    for model_name in model_names:
+        keras_model, weights_file = model_host.load_keras_model(model_name)
+        tflite_model_file = get_tflite_model_file(weights_file, quantization)
+
+        print("Exporting {} to {} ...".format(model_name, tflite_model_file))
+        export_tflite_model(keras_model, tflite_model_file, quantization)
+        print(
+            "Done. {:.1f}MB -> {:.1f}MB".format(
+                os.path.getsize(weights_file) / 1024 / 1024,
+                os.path.getsize(tflite_model_file) / 1024 / 1024,
+            )
+        )
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+import collections
+import gc
+import os
+import threading
+import time
+
+import settings
+from model_export import TFLiteModel, get_tflite_model_file
+
+# TensorFlow / Keras (and the model module using them) are imported only
+# when a model is loaded, as it takes seconds. So the steps without the
+# models (like the detection before the filter) and the GUI start faster.
+
+# The models used by the processing
+CNN_MODEL = "cnn"
+UNET_MODEL = "unet"
+
+
+# The CNN models can be selected by settings.CNN_MODEL_TYPE:
+# model type -> (model function in model.py, the setting of its weights file)
+CNN_MODEL_TYPES = {
+    "cnn_11": ("cnn_11", "CNN_SAVED_MODEL"),
+    "cnn_11_gap": ("cnn_11_gap", "CNN_GAP_SAVED_MODEL"),
+}
+
+
+def build_cnn_model(model_type):
+    import model
+
+    return getattr(model, CNN_MODEL_TYPES[model_type][0])()
+
+
+def _build_cnn_model():
+    # cnn_model = model.cnn()
+    # cnn_model = model.cnn_2()
+    # cnn_model = model.cnn_3()
+    # cnn_model = model.cnn_4()
+    # cnn_model = model.cnn_7()
+    return build_cnn_model(settings.CNN_MODEL_TYPE)
+
+
+def _build_unet_model():
+    import model
+
+    # The image size supported is (256, 256)
+    # unet_model = model.unet(input_size=(settings.UNET_IMAGE_SIZE, settings.UNET_IMAGE_SIZE, 1))
+    return model.unet_plus_plus(
+        input_size=(settings.UNET_IMAGE_SIZE, settings.UNET_IMAGE_SIZE, 1)
+    )
+
+
+MODEL_BUILDERS = {
+    CNN_MODEL: _build_cnn_model,
+    UNET_MODEL: _build_unet_model,
+}
+
+
+# The Keras weights file of the model. For the CNN, by its model type
+def get_weights_file(name):
+    if name == CNN_MODEL:
+        return getattr(settings, CNN_MODEL_TYPES[settings.CNN_MODEL_TYPE][1])
+    return settings.UNET_SAVED_MODEL
+
+
+# The Keras model with the weights loaded. Returns (model, weights file)
+def load_keras_model(name):
+    keras_model = MODEL_BUILDERS[name]()
+    weights_file = get_weights_file(name)
+    keras_model.load_weights(weights_file)
+    return keras_model, weights_file
+
+
+# The TFLite model files reported as not exported, to report only once
+_missing_tflite_model_files = set()
+
+
+# The file the model is loaded from, by settings.INFERENCE_BACKEND.
+# The Keras weights file is used if the model was not exported to TFLite.
+def get_model_file(name):
+    weights_file = get_weights_file(name)
+    if settings.INFERENCE_BACKEND == "tflite":
+        tflite_model_file = get_tflite_model_file(
+            weights_file, settings.INFERENCE_TFLITE_QUANTIZATION
+        )
+        if os.path.exists(tflite_model_file):
+            return tflite_model_file
+
+        if tflite_model_file not in _missing_tflite_model_files:
+            _missing_tflite_model_files.add(tflite_model_file)
+            print(
+                "Model host: {} not found, using the Keras model".format(
+                    tflite_model_file
+                )
+            )
+            print("    It can be exported by: python model_export.py {}".format(name))
+    return weights_file
+
+
+def load_model(name, model_file):
+    if model_file.endswith(".tflite"):
+        return TFLiteModel(model_file, settings.INFERENCE_TFLITE_THREADS)
+    return load_keras_model(name)[0]
+
+
+# Keeps the models loaded, so that they are built and the weights are
+# loaded only once in a session (all the GUI steps, or all the folders
+# processed by one command), instead of each time a folder is processed.
+#
+# The memory is released by the policy in the settings:
+# - MODEL_RELEASE_POLICY = "keep": the models stay until the program ends
+#   (or release_models() is called)
+# - MODEL_RELEASE_POLICY = "step": the models are released at the end of
+#   each step (end_of_step()), same as before there was the model host
+# - At most MODEL_HOST_MAX_MODELS models are kept. The least recently
+#   used one is released to load another one (0 means no limit).
+#
+# The models are loaded as Keras models, or TFLite models (see
+# settings.INFERENCE_BACKEND and model_export.py). A model is loaded again
+# if its file was changed, or the backend was changed.
+class ModelHost:
+    def __init__(self, max_models=0):
+        self.Max_Models = max_models
+        self.Models = collections.OrderedDict()
+        self.Lock = threading.Lock()
+
+        # Statistics
+        self.Num_Of_Loads = 0
+        self.Num_Of_Reuses = 0
+        self.Load_Time = 0.0
+
+    def get_model(self, name):
+        with self.Lock:
+            model_file = get_model_file(name)
+
+            entry = self.Models.get(name)
+            if entry is not None and entry[1] == self.__get_file_identity(model_file):
+                self.Models.move_to_end(name)
+                self.Num_Of_Reuses += 1
+                return entry[0]
+
+            # Not loaded, or the model file / backend changed
+            self.Models.pop(name, None)
+            while self.Max_Models > 0 and len(self.Models) >= self.Max_Models:
+                released_name, _ = self.Models.popitem(last=False)
+                print("Model host: {} released".format(released_name))
+            gc.collect()
+
+            start_time = time.perf_counter()
+            loaded_model = load_model(name, model_file)
+            used_time = time.perf_counter() - start_time
+
+            self.Num_Of_Loads += 1
+            self.Load_Time += used_time
+            print(
+                "Model host: {} loaded from {} in {:.2f}s".format(
+                    name, os.path.basename(model_file), used_time
+                )
+            )
+
+            self.Models[name] = (loaded_model, self.__get_file_identity(model_file))
+            return loaded_model
+
+    def __get_file_identity(self, model_file):
+        try:
+            file_stat = os.stat(model_file)
+            return [model_file, file_stat.st_size, file_stat.st_mtime_ns]
+        except OSError:
+            return [model_file]
+
+    def is_loaded(self, name):
+        with self.Lock:
+            return name in self.Models
+
+    # Release all the models, and the memory used by Keras
+    def release_models(self):
+        with self.Lock:
+            if len(self.Models) == 0:
+                return
+
+            print("Model host: {} released".format(", ".join(self.Models)))
+            self.Models.clear()
+
+            # Need to clean up the keras session
+            # to allow it to be run in the 2nd time
+            from tensorflow import keras
+
+            keras.backend.clear_session()
+            gc.collect()
+
+    def get_stats_string(self):
+        return "Model host: {} loads ({:.2f}s), {} reuses".format(
+            self.Num_Of_Loads, self.Load_Time, self.Num_Of_Reuses
+        )
+
+
+_model_host = None
+_model_host_lock = threading.Lock()
+
+
+# The forked processes (the process detection backend) don't use the
+# models, and should not share the loaded ones
+def _reset_model_host_after_fork():
+    global _model_host, _model_host_lock
+
+    _model_host = None
+    _model_host_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_model_host_after_fork)
+
+
+# The shared model host for the whole session
+def get_model_host():
+    global _model_host
+
+    with _model_host_lock:
+        if _model_host is None:
+            _model_host = ModelHost(settings.MODEL_HOST_MAX_MODELS)
+        return _model_host
+
+
+# Returns the loaded model (CNN_MODEL / UNET_MODEL), loading it if needed
+def get_model(name):
+    return get_model_host().get_model(name)
+
+
+def release_models():
+    get_model_host().release_models()
+
+
+# To be called at the end of each processing step (in place of
+# keras.backend.clear_session())
+def end_of_step():
+    if settings.MODEL_RELEASE_POLICY == "step":
+        release_models()
+
+
+# Loads TensorFlow (and the models if load_models) in advance, like when
+# the GUI is waiting for the user. So the first step using the models
+# doesn't need to wait for it.
+def warm_up(load_models=False):
+    start_time = time.perf_counter()
+    import model
+
+    print(
+        "Model host: TensorFlow loaded in {:.2f}s".format(
+            time.perf_counter() - start_time
+        )
+    )
+
+    if load_models:
+        for name in MODEL_BUILDERS:
+            try:
+                get_model(name)
+            except Exception as e:
+                print("Model host: {} not loaded: {}".format(name, e))
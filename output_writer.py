@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import os
+import queue
+import threading
+
+import cv2
+
+import settings
+
+
+# Encoding a big image (like a 45M pixels JPG) takes hundreds of ms. The
+# output writer moves the encoding and writing of the output files to a
+# pool of worker threads, so that the processing threads can go on with
+# the next image.
+#
+# - The queue is bounded. When the workers cannot catch up, submit() will
+#   wait, so that the images waiting to be written would not use up the
+#   memory.
+# - The images submitted must not be modified after submitting.
+# - flush() waits until all the submitted files are written. Any error
+#   happened in the workers is raised there (as OSError).
+class OutputWriter:
+    def __init__(self, num_of_workers=2, max_queue_size=8, name="Writer"):
+        self.Queue = queue.Queue(maxsize=max(max_queue_size, 1))
+        self.Name = name
+
+        self.Errors = []
+        self.Errors_Lock = threading.Lock()
+
+        self.Workers = []
+        for i in range(max(num_of_workers, 1)):
+            worker = threading.Thread(
+                target=self.__worker_loop,
+                name="{}-{:03d}".format(name, i + 1),
+                daemon=True,
+            )
+            worker.start()
+            self.Workers.append(worker)
+
+    def __worker_loop(self):
+        while True:
+            task = self.Queue.get()
+            try:
+                if task is None:
+                    return
+
+                func, args, kwargs = task
+                func(*args, **kwargs)
+            except Exception as e:
+                print("{}: writing failed: {}".format(self.Name, e))
+                with self.Errors_Lock:
+                    self.Errors.append(e)
+            finally:
+                self.Queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        self.Queue.put((func, args, kwargs))
+
+    def write_image(self, file_ext, img, file_to_save, params=None):
+        self.submit(_write_image_file, file_ext, img, file_to_save, params)
+
+    def save_pil_image(self, img, file_to_save, file_format):
+        self.submit(img.save, file_to_save, file_format)
+
+    def flush(self):
+        self.Queue.join()
+
+        with self.Errors_Lock:
+            errors = self.Errors
+            self.Errors = []
+
+        if len(errors) > 0:
+            raise OSError(
+                "{}: {} file(s) failed to be written. First error: {}".format(
+                    self.Name, len(errors), errors[0]
+                )
+            )
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for _ in self.Workers:
+                self.Queue.put(None)
+            for worker in self.Workers:
+                worker.join()
+            self.Workers = []
+
+
+# cv2.imwrite() doesn't support Chinese characters in the path,
+# so encode to memory then write to the file
+def _write_image_file(file_ext, img, file_to_save, params=None):
+    if params is None:
+        is_success, buffer = cv2.imencode(file_ext, img)
+    else:
+        is_success, buffer = cv2.imencode(file_ext, img, params)
+
+    if not is_success:
+        raise OSError("Failed to encode {}".format(file_to_save))
+
+    buffer.tofile(file_to_save)
+
+
+_output_writer = None
+_output_writer_lock = threading.Lock()
+
+
+# The worker threads are not copied to a forked process (the process
+# detection backend), so a new writer is created there when needed.
+def _reset_output_writer_after_fork():
+    global _output_writer, _output_writer_lock
+
+    _output_writer = None
+    _output_writer_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_output_writer_after_fork)
+
+
+# The shared output writer for the whole session. None if it is disabled
+# in the settings (writing synchronously).
+def get_output_writer():
+    global _output_writer
+
+    if settings.OUTPUT_WRITER_WORKERS <= 0:
+        return None
+
+    with _output_writer_lock:
+        if _output_writer is None:
+            _output_writer = OutputWriter(
+                settings.OUTPUT_WRITER_WORKERS,
+                settings.OUTPUT_WRITER_QUEUE_SIZE,
+            )
+        return _output_writer
+
+
+# Replacement of "cv2.imencode(file_ext, img)[1].tofile(file_to_save)".
+# Goes through the shared output writer when it is enabled.
+def write_image(file_ext, img, file_to_save, params=None):
+    output_writer = get_output_writer()
+    if output_writer is None:
+        _write_image_file(file_ext, img, file_to_save, params)
+    else:
+        output_writer.write_image(file_ext, img, file_to_save, params)
+
+
+# Replacement of "img.save(file_to_save, file_format)" for PIL images
+def save_pil_image(img, file_to_save, file_format):
+    output_writer = get_output_writer()
+    if output_writer is None:
+        img.save(file_to_save, file_format)
+    else:
+        output_writer.save_pil_image(img, file_to_save, file_format)
+
+
+# Wait until all the files submitted are written. To be called at the end
+# of each processing stage, before the output files are used by the next
+# stage.
+def flush():
+    output_writer = get_output_writer()
+    if output_writer is not None:
+        output_writer.flush()
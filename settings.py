@@ -10,6 +10,70 @@ DETECTION_LINE_THRESHOLD = 20
 DETECTION_LINE_MIN_LINE_LENGTH = 30
 DETECTION_LINE_MAX_LINE_GAP = 7
 
+# Cluster the HoughLinesP() output with NumPy arrays, instead of comparing
+# the lines one by one. Set to False to use the original implementation
+# (for comparison).
+DETECTION_HOUGH_BUNDLER_VECTORIZED = True
+
+# Coarse-to-fine detection. The lines are first detected on a downsampled
+# image, then only the areas around them are checked again with the full
+# resolution image. Much faster for big images, but faint meteors could be
+# missed. Use compare_coarse_to_fine.py to check the result on your photos.
+# - PYRAMID_LEVEL: 0 = full resolution only (as before)
+#                  1 = downsample by 2x, 2 = by 4x
+# - PYRAMID_ROI_MARGIN: extra pixels (full resolution) around each line
+#                       found in the downsampled image
+DETECTION_PYRAMID_LEVEL = 0
+DETECTION_PYRAMID_ROI_MARGIN = 64
+
+# Tile detection. An image bigger than the tile size is split to tiles, and
+# the blur and the gradients (for the edge detection) of the tiles are done
+# in parallel. The edges are then traced on the whole image, so they are the
+# same as without the tiles. Helps when there are only a few (but big)
+# photos, since the multi-thread detection is done by photos.
+# - TILE_SIZE   : in pixels. 0 means no tiles
+# - TILE_OVERLAP: extra pixels on each side of a tile, so that the gradients
+#                 near the tile borders are the same as from the whole image
+# - TILE_WORKERS: max number of threads to detect the tiles of a frame. Only
+#                 the cores not used by the other detection threads/processes
+#                 are used. With no free core, the tiles are not used.
+DETECTION_TILE_SIZE = 2048
+DETECTION_TILE_OVERLAP = 64
+DETECTION_TILE_WORKERS = 4
+
+# Pre-screen. Before the whole detection, check a heavily downsampled
+# difference image to see if there could be anything in it. The frames
+# that clearly contain nothing are skipped (taken as no line detected).
+# - PRESCREEN_SCALE      : downsample factor
+# - PRESCREEN_NOISE_SIGMA: pixels brighter than (median + sigma * noise)
+#                          are taken as "above noise"
+# - PRESCREEN_MIN_AREA   : connected groups of the above-noise pixels smaller
+#                          than this (in the downsampled image) are ignored
+# - PRESCREEN_MIN_ENERGY : a frame is skipped if no group has its energy
+#                          (brightness above noise, summed) reaching this
+# - PRESCREEN_BORDERLINE_RATIO: skipped frames with score above
+#                          MIN_ENERGY * ratio are listed in the report
+# - PRESCREEN_AUDIT      : still run the whole detection for the skipped
+#                          frames, and report those that would have lines
+#                          detected. Use it to tune the threshold.
+DETECTION_PRESCREEN_ENABLED = False
+DETECTION_PRESCREEN_SCALE = 8
+DETECTION_PRESCREEN_NOISE_SIGMA = 4
+DETECTION_PRESCREEN_MIN_AREA = 2
+DETECTION_PRESCREEN_MIN_ENERGY = 20
+DETECTION_PRESCREEN_BORDERLINE_RATIO = 0.5
+DETECTION_PRESCREEN_AUDIT = False
+
+# Set to False to not save the full size image to '01_detection' for the
+# frames without any detection (the '_detection_0' files).
+DETECTION_SAVE_NO_DETECTION_IMAGES = True
+
+# The scale of the images saved to '01_detection' (with the detection
+# boxes drawn). Like 0.25 to save the memory and disk space for the big
+# photos. The boxes are drawn on a downscaled copy of the frame then.
+# 1.0 means the full size.
+DETECTION_ANNOTATION_SCALE = 1.0
+
 # DETECTION_CROP_IMAGE_BOX_SIZE = 640
 DETECTION_CROP_IMAGE_BOX_SIZE = 256
 
@@ -36,6 +100,18 @@ DETECTION_CROP_IMAGE_BOX_FACTOR = 3.0
 # BOX_OVERLAP_THRESHOLD = 0.5
 BOX_OVERLAP_THRESHOLD = 0.2
 
+# How the overlapped detection boxes are merged:
+#   "union_find": Keep merging the overlapped boxes until no more can be
+#                 merged. One long meteor gives one cropped image.
+#   "single_pass": The original method. Each box is only compared with the
+#                  boxes after it, once.
+DETECTION_BOX_MERGE_METHOD = "union_find"
+
+# Two boxes would not be merged if the merged box is bigger than this ratio
+# of the image size (the shorter side). To avoid the landscape objects and
+# the meteors to be merged to one big image.
+BOX_MERGE_MAX_SIZE_RATIO = 0.5
+
 # =============================================================================
 # For checking false detection
 #
@@ -86,6 +162,11 @@ LINE_JOINT_ANGEL_DELTA_THRESHOLD = 0.4
 LINE_VERTICAL_DISTANCE_FOR_SATELLITE_THRESHOLD = 12
 LINE_DISTANCE_FOR_SATELLITE_THRESHOLD = 300
 
+# Use a grid index to find out the lines to be compared when merging lines
+# and checking satellites, instead of comparing every two lines. Much faster
+# when there are lots of lines detected. The result is the same.
+DETECTION_USE_LINE_SPATIAL_INDEX = True
+
 # =============================================================================
 # For meteor object extraction
 #
@@ -103,6 +184,26 @@ LINE_DISTANCE_FOR_SATELLITE_THRESHOLD = 300
 #   within 80).
 EXTRACT_RGB_VALUE_THRESHOLD = 48
 
+# If set to True, the alpha channel of the extracted meteor object is taken
+# from the mask brightness (soft edge), instead of being fully opaque.
+# Keep it False to get the same output as before.
+EXTRACT_SOFT_ALPHA = False
+
+# =============================================================================
+# For combining the extracted meteor objects to the final image
+#
+# How the meteor objects are blended together:
+#   "alpha"  : Put one over another, with transparency (same as before)
+#   "lighten": The brighter pixel wins
+#   "max"    : Maximum value of each color channel
+FINAL_COMBINE_BLEND_MODE = "alpha"
+
+# The final image is combined from the small extracted objects directly.
+# Set this to True if the full photo size file for each meteor object is
+# still needed (the '10_FINAL' and '10_FINAL_w_label' folders).
+# This would take much more time and disk space.
+FINAL_SAVE_FULL_SIZE_OBJECT_FILES = False
+
 # =============================================================================
 # For multi-thread processing
 # To avoid memory exhaustion sometimes we need to control the maximum core #
@@ -110,19 +211,188 @@ EXTRACT_RGB_VALUE_THRESHOLD = 48
 # 2021-8-18: It seems the exe will run fail if we needs over 12 threads.
 #            Don't know why but just limit the CPU # to 8 at present.
 #            But running in IDE environment is no problem.
+#
+# The # of threads is decided by the memory each thread needs (from the
+# photo size) and the memory available, see MEMORY_BUDGET_* below. It can
+# be lower than these upper limits, but never higher. Keep them at 12 for
+# the exe. 0 means no limit (all the CPU cores).
 MAX_CPU_FOR_DETECTION = 12
 MAX_CPU_FOR_MASK_EXTRACTION = 12
 
+# The memory which can be used by the processing:
+# - MEMORY_BUDGET_GB   : a fixed size in GB. 0 means to use the ratio below
+# - MEMORY_BUDGET_RATIO: the ratio of the memory available when the
+#                        processing starts
+# A thread waits before starting a photo if the budget would be exceeded.
+MEMORY_BUDGET_GB = 0
+MEMORY_BUDGET_RATIO = 0.8
+
+# How the detection is run in parallel:
+# - "thread" : in threads of one process (as before)
+# - "process": in separate processes. Faster on CPUs with many cores, as
+#              the line / box processing in Python doesn't share one core.
+# It can also be selected in the GUI, or by "--process" / "--thread" in
+# the command line.
+DETECTION_BACKEND = "thread"
+
+# The # of threads OpenCV can use in each detection process. Too many
+# would over-subscribe the CPU as all the processes run at the same time.
+# 0 means the OpenCV default (all the cores).
+DETECTION_PROCESS_CV2_THREADS = 1
+
+# The images are handed out to the detection threads/processes in runs of
+# this many adjacent images. A worker takes the next run when it is free,
+# so the slow images (clouds, landscape lights ...) don't leave the other
+# workers idle. Each run also loads the image before and the 2 images
+# after it, so a small value means more image loading.
+# 0 means the old way: one fixed sub-list for each thread/process.
+DETECTION_RUN_SIZE = 8
+
+# Each detection thread reads/decodes the next frames in background while
+# the current frame is being analysed.
+# - DEPTH  : how many frames can be decoded ahead (per detection thread).
+#            Each frame takes memory (~130MB for a 45M pixels photo).
+#            0 means no prefetching.
+# - READERS: how many frames can be read/decoded at the same time (per
+#            detection thread). Increase it if the photos are on a slow
+#            network drive.
+# Check the "starved" numbers printed at the end of each detection thread
+# to tune these values.
+DETECTION_PREFETCH_DEPTH = 2
+DETECTION_PREFETCH_READERS = 1
+
+# The output image files (detection boxes, cropped images, masks ...) are
+# encoded and written by a pool of writer threads, so that the processing
+# threads don't need to wait for the disk.
+# - WORKERS   : number of writer threads. 0 means writing synchronously in
+#               the processing threads (as before).
+# - QUEUE_SIZE: how many images can wait to be written. When it is full,
+#               the processing threads wait for the writers.
+OUTPUT_WRITER_WORKERS = 4
+OUTPUT_WRITER_QUEUE_SIZE = 16
+
+# =============================================================================
+# Session frame store
+#
+# If enabled, each original photo is decoded only once and stored to an
+# on-disk cache (.npy). Later steps read the pixels from the cache with
+# memory mapping. Helpful for RAW files which are slow to decode.
+FRAME_STORE_ENABLED = False
+
+# Where the cache files are put. Empty means the system temp folder
+FRAME_STORE_DIR = ""
+
+# Maximum disk space for the cache files. The least recently used files
+# will be removed when exceeded. Value is in GB.
+FRAME_STORE_MAX_SIZE_GB = 20
+
+# =============================================================================
+# Detection result cache
+#
+# If enabled, the detection lines of each photo are saved to the folder
+# "process/00_detection_cache". When the detection is run again on the
+# same folder, the photos not changed (and with the same photo used for
+# subtraction, and the same detection settings) are not detected again.
+# The boxes and the cropped images are still generated from the cached
+# lines.
+#
+# The cache can be checked or cleaned up by:
+#     python detection_cache.py <folder name> list|prune|clear
+DETECTION_CACHE_ENABLED = True
+
 # =============================================================================
 # The Neural Network
 CNN_IMAGE_SIZE = 256
 
+# The models (the CNN and the UNET++) are loaded once and kept in memory,
+# to be used by all the steps / folders processed in the session.
+# - "keep": keep the models until the program exits
+# - "step": release the models (and the Keras session) after each step,
+#           to give the memory back, and load them again for the next step
+MODEL_RELEASE_POLICY = "keep"
+
+# How the models are run:
+# - "keras" : the Keras models, full precision
+# - "tflite": the TensorFlow Lite models, faster on CPU. They need to be
+#             exported first by: python model_export.py all
+#             The Keras model is used if not exported.
+#             Check the results with check_inference_accuracy.py first.
+INFERENCE_BACKEND = "keras"
+
+# The weights of the TFLite models: "fp32", "fp16" or "int8"
+INFERENCE_TFLITE_QUANTIZATION = "fp16"
+
+# The # of CPU threads used by a TFLite model. 0 means all the cores
+INFERENCE_TFLITE_THREADS = 0
+
+# The max # of models kept at the same time. The least recently used one
+# is released to load another one. 0 means no limit
+MODEL_HOST_MAX_MODELS = 0
+
+# TensorFlow is loaded only when the models are needed (it takes seconds).
+# The GUI can load it in the background after the window is shown, while
+# the folder is being selected:
+# - "none"  : don't, load it when the filter / mask step needs it
+# - "import": load TensorFlow only
+# - "models": also load the models (with MODEL_RELEASE_POLICY = "keep")
+GUI_WARM_UP = "import"
+
+# The CNN model used to filter the detected objects:
+# - "cnn_11"    : the original model (CNN_SAVED_MODEL)
+# - "cnn_11_gap": the same convolution layers with a light classifier head
+#                 (global average pooling). ~7% of the parameters, loads
+#                 and runs faster. The weights (CNN_GAP_SAVED_MODEL) are
+#                 trained by train_cnn.py
+# Compare the two by: python benchmark_cnn_models.py <test folder>
+CNN_MODEL_TYPE = "cnn_11"
+
 # 2020-10-25: This model weight seems to have the best performance on one test set
 CNN_SAVED_MODEL = "./saved_model/cnn_star_256_20201025_1_cnn11_lre-4_.731-0.00002.hdf5"
 
+CNN_GAP_SAVED_MODEL = "./saved_model/cnn_star_256_cnn11_gap.weights.h5"
+
+# The # of cropped images classified by the CNN model at a time
+CNN_BATCH_SIZE = 32
+
+# When classifying the crops from '02_cropped', the crops are decoded and
+# resized by CNN_DECODE_THREADS threads, and CNN_PREFETCH_BATCHES batches
+# are prepared while the model is working on the current one.
+# 0 means decided by TensorFlow.
+CNN_DECODE_THREADS = 0
+CNN_PREFETCH_BATCHES = 2
+
+# Classify the cropped images in the background while the detection is
+# still going on. The crops are then written only once, directly to
+# '03_filtered/good' or '03_filtered/removed', instead of to '02_cropped'
+# first.
+# The crops are classified before being encoded to the files, so a few
+# borderline ones could be classified differently.
+# Only for the thread backend (settings.DETECTION_BACKEND).
+DETECTION_STREAM_TO_CLASSIFIER = False
+
+# Max # of crops waiting to be classified. The detection waits when full.
+CNN_STREAM_QUEUE_SIZE = 64
+
 UNET_IMAGE_SIZE = 256
 
 # 2021-03-15: Newer trained model for UNET++. Test result is quite good
 UNET_SAVED_MODEL = (
     "./saved_model/unet++_meteor_gray256_20210314-3_wo_val.297-0.201.hdf5"
 )
+
+# The # of mosaic tiles predicted by the UNET++ at a time
+UNET_BATCH_SIZE = 8
+
+# When generating the masks from a folder of gray 256x256 images
+# (gen_meteor_mask_from_folder), the images are decoded by
+# UNET_DECODE_THREADS threads, and UNET_PREFETCH_BATCHES batches are
+# prepared while the model is working on the current one.
+# 0 means decided by TensorFlow.
+UNET_DECODE_THREADS = 0
+UNET_PREFETCH_BATCHES = 2
+
+# The mask generation works in memory, and writes only the final masks to
+# '08_mosaic_merged_back'. Set to True to also write the images in between
+# to '04_mosaic', '05_gray_256', '06_mask_256' and '07_mask_resize_back',
+# to check how the masks are made
+MASK_DEBUG_DUMP = False
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# Training of the CNN model used to filter the detected objects
+# (settings.CNN_MODEL_TYPE)
+#
+# The training data folder should be like this:
+#     <training data folder>/train/others      (not meteors)
+#     <training data folder>/train/star        (meteors)
+#     <training data folder>/validation/others
+#     <training data folder>/validation/star
+# The images can be the crops from '03_filtered/removed' (others) and
+# '03_filtered/good' (star) after they were checked by hand.
+#
+# For "cnn_11_gap", the convolution layers are initialized from the
+# cnn_11 weights (settings.CNN_SAVED_MODEL) if it can be found, so that
+# mostly the new classifier head needs to be trained.
+#
+# The best weights (by the validation accuracy) are saved to the weights
+# file of the model type (like settings.CNN_GAP_SAVED_MODEL). The original
+# cnn_11 weights are never overwritten.
+#
+# Usage:
+#     python train_cnn.py <training data folder> [epochs] [model type]
+#
+#     epochs    : 50 by default
+#     model type: cnn_11_gap (default) or cnn_11
+import os
+import sys
+
+from tensorflow import keras
+from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+import model_host
+import settings
+
+# The class index is the index in the scores: [0] others, [1] star
+CLASSES = ["others", "star"]
+
+BATCH_SIZE = 16
+LEARNING_RATE = 1e-4
+
+
+def get_data_generator(data_folder, augment):
+    if augment:
+        # The meteors can be in any direction
+        datagen = ImageDataGenerator(
+            rescale=1.0 / 255,
+            horizontal_flip=True,
+            vertical_flip=True,
+            rotation_range=90,
+        )
+    else:
+        datagen = ImageDataGenerator(rescale=1.0 / 255)
+
+    return datagen.flow_from_directory(
+        data_folder,
+        target_size=(settings.CNN_IMAGE_SIZE, settings.CNN_IMAGE_SIZE),
+        classes=CLASSES,
+        class_mode="categorical",
+        batch_size=BATCH_SIZE,
+        shuffle=augment,
+    )
+
+
+# Copy the weights of the convolution layers from the cnn_11 model. The
+# two models have the same convolution layers, in the same order.
+def init_conv_layers_from_cnn_11(cnn_model):
+    cnn_11_weights_file = settings.CNN_SAVED_MODEL
+    if not os.path.exists(cnn_11_weights_file):
+        print("{} not found, training from scratch".format(cnn_11_weights_file))
+        return
+
+    cnn_11_model = model_host.build_cnn_model("cnn_11")
+    cnn_11_model.load_weights(cnn_11_weights_file)
+
+    cnn_11_conv_layers = [
+        layer for layer in cnn_11_model.layers if isinstance(layer, keras.layers.Conv2D)
+    ]
+    conv_layers = [
+        layer for layer in cnn_model.layers if isinstance(layer, keras.layers.Conv2D)
+    ]
+    for layer, cnn_11_layer in zip(conv_layers, cnn_11_conv_layers):
+        layer.set_weights(cnn_11_layer.get_weights())
+
+    print(
+        "{} convolution layers initialized from {}".format(
+            len(conv_layers), cnn_11_weights_file
+        )
+    )
+
+
+def get_output_weights_file(model_type):
+    weights_file = getattr(settings, model_host.CNN_MODEL_TYPES[model_type][1])
+    if weights_file == settings.CNN_SAVED_MODEL:
+        # Don't overwrite the original weights
+        weights_file = os.path.join(
+            os.path.dirname(weights_file),
+            "cnn_star_256_{}_retrained.weights.h5".format(model_type),
+        )
+    return weights_file
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if len(argv) < 1:
+        print("\nUsage: train_cnn <training data folder> [epochs] [model type]")
+        print("    model type: {}".format(" / ".join(model_host.CNN_MODEL_TYPES)))
+        sys.exit(1)
+
+    training_data_folder = argv[0]
+    epochs = 50
+    if len(argv) > 1:
+        epochs = int(argv[1])
+    model_type = "cnn_11_gap"
+    if len(argv) > 2:
+        model_type = argv[2]
+
+    if model_type not in model_host.CNN_MODEL_TYPES:
+        print("Unknown model type: {}".format(model_type))
+        sys.exit(1)
+
+    train_folder = os.path.join(training_data_folder, "train")
+    validation_folder = os.path.join(training_data_folder, "validation")
+    for data_folder in [train_folder, validation_folder]:
+        for class_name in CLASSES:
+            class_folder = os.path.join(data_folder, class_name)
+            if not os.path.exists(class_folder):
+                print("No such directory: {}".format(class_folder))
+                sys.exit(1)
+
+    cnn_model = model_host.build_cnn_model(model_type)
+    if model_type == "cnn_11_gap":
+        init_conv_layers_from_cnn_11(cnn_model)
+
+    cnn_model.compile(
+        optimizer=keras.optimizers.Adam(learning_rate=LEARNING_RATE),
+        loss="binary_crossentropy",
+        metrics=["acc"],
+    )
+
+    weights_file = get_output_weights_file(model_type)
+    callbacks = [
+        keras.callbacks.ModelCheckpoint(
+            weights_file,
+            monitor="val_acc",
+            save_best_only=True,
+            save_weights_only=True,
+            verbose=1,
+        ),
+        keras.callbacks.ReduceLROnPlateau(monitor="val_loss", factor=0.5, patience=5),
+        keras.callbacks.EarlyStopping(
+            monitor="val_acc", patience=10, restore_best_weights=True
+        ),
+    ]
+
+    cnn_model.fit(
+        get_data_generator(train_folder, augment=True),
+        validation_data=get_data_generator(validation_folder, augment=False),
+        epochs=epochs,
+        callbacks=callbacks,
+    )
+
+    print("\nThe best weights were saved to: {}".format(weights_file))
+    print(
+        'Set CNN_MODEL_TYPE = "{}" (and {} if needed) in settings.py to use it.'.format(
+            model_type, model_host.CNN_MODEL_TYPES[model_type][1]
+        )
+    )
+    print("Compare it with the current model first by:")
+    print("    python benchmark_cnn_models.py <test folder>")
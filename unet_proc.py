@@ -1,11 +1,11 @@
 # -*- coding: utf-8 -*-
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
+import cv2
 import numpy as np
 import os
 import glob
-import skimage.io as io
-import skimage.transform as trans
-from skimage import img_as_ubyte
+
+# TensorFlow and skimage are imported by the functions using them, so
+# that importing this module (by gen_mask) is fast
 
 Sky = [128, 128, 128]
 Building = [128, 0, 0]
@@ -94,6 +94,8 @@ def trainGenerator(
     use the same seed for image_datagen and mask_datagen to ensure the transformation for image and mask is the same
     if you want to visualize the results of generator, set save_to_dir = "your path"
     """
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
     image_datagen = ImageDataGenerator(**aug_dict)
     mask_datagen = ImageDataGenerator(**aug_dict)
     image_generator = image_datagen.flow_from_directory(
@@ -131,6 +133,9 @@ def testGenerator(
     flag_multi_class=False,
     as_gray=True,
 ):
+    import skimage.io as io
+    import skimage.transform as trans
+
     photo_files = os.listdir(test_path)
     for photo_file in photo_files:
         file_to_open = os.path.join(test_path, photo_file)
@@ -147,6 +152,70 @@ def testGenerator(
             yield (img,)
 
 
+# The image files given to the UNET++ from a folder, in the same order as
+# testGenerator() gives them
+def get_test_file_list(test_path):
+    return [
+        os.path.join(test_path, photo_file)
+        for photo_file in os.listdir(test_path)
+        if os.path.isfile(os.path.join(test_path, photo_file))
+    ]
+
+
+# One gray image as the UNET++ input: (height, width, 1) in float32 0~1.
+# Same as testGenerator() gives, but with OpenCV in float32 instead of
+# skimage in float64. The image is resized only if it is not target_size
+# already (the '05_gray_256' images are)
+def load_test_image(filename_w_path, target_size=(256, 256)):
+    img = cv2.imdecode(
+        np.fromfile(filename_w_path, dtype=np.uint8), cv2.IMREAD_GRAYSCALE
+    )
+    img = img.astype(np.float32) / 255
+
+    if img.shape != tuple(target_size):
+        img = cv2.resize(
+            img, (target_size[1], target_size[0]), interpolation=cv2.INTER_AREA
+        )
+    return img[:, :, np.newaxis]
+
+
+# The batched version of testGenerator(), as a tf.data pipeline:
+# - The images are decoded by decode_threads threads at the same time
+#   (0 means decided by TensorFlow)
+# - Put to batches of batch_size
+# - prefetch_batches batches are prepared while the model is predicting
+#   the current one (0 means decided by TensorFlow)
+def testDataset(
+    file_list,
+    batch_size=8,
+    target_size=(256, 256),
+    decode_threads=0,
+    prefetch_batches=0,
+):
+    import tensorflow as tf
+
+    def load_image(filename_w_path):
+        img = tf.numpy_function(
+            lambda f: load_test_image(f.decode("utf-8"), target_size),
+            [filename_w_path],
+            tf.float32,
+        )
+        img.set_shape(tuple(target_size) + (1,))
+        return img
+
+    dataset = tf.data.Dataset.from_tensor_slices(file_list)
+    dataset = dataset.map(
+        load_image,
+        num_parallel_calls=decode_threads if decode_threads > 0 else tf.data.AUTOTUNE,
+        deterministic=True,
+    )
+    dataset = dataset.batch(max(batch_size, 1))
+    dataset = dataset.prefetch(
+        prefetch_batches if prefetch_batches > 0 else tf.data.AUTOTUNE
+    )
+    return dataset
+
+
 def geneTrainNpy(
     image_path,
     mask_path,
@@ -157,6 +226,8 @@ def geneTrainNpy(
     image_as_gray=True,
     mask_as_gray=True,
 ):
+    import skimage.io as io
+
     image_name_arr = glob.glob(os.path.join(image_path, "%s*.png" % image_prefix))
     image_arr = []
     mask_arr = []
@@ -185,6 +256,8 @@ def labelVisualize(num_class, color_dict, img):
 
 
 def saveResult(save_path, npyfile, flag_multi_class=False, num_class=2):
+    import skimage.io as io
+
     for i, item in enumerate(npyfile):
         img = (
             labelVisualize(num_class, COLOR_DICT, item)
@@ -195,6 +268,9 @@ def saveResult(save_path, npyfile, flag_multi_class=False, num_class=2):
 
 
 def saveResult_V2(save_path, npyfile, file_list, flag_multi_class=False, num_class=2):
+    import skimage.io as io
+    from skimage import img_as_ubyte
+
     # print(file_list)
     # print(npyfile)
     for i, item in enumerate(npyfile):